@@ -42,10 +42,13 @@ class DiffRate(nn.Module):
         return kept_token_number
         
     def get_token_probability(self):
-        token_probability =  torch.zeros((self.patch_number+self.class_token_num), device=self.selected_probability_softmax.device) 
-        for kept_token_number, prob in zip(self.kept_token_candidate, self.selected_probability_softmax):
-            token_probability[: int(kept_token_number+self.class_token_num)] += prob
-        return token_probability
+        # token i is kept by every candidate keeping more than i tokens, so its probability is a
+        # reversed cumulative sum of the candidate probabilities bucketed at their last kept token
+        token_number = self.patch_number + self.class_token_num
+        last_kept = (self.kept_token_candidate + self.class_token_num - 1).long().clamp(max=token_number - 1)
+        token_probability = self.selected_probability_softmax.new_zeros(token_number)
+        token_probability = token_probability.index_add(0, last_kept, self.selected_probability_softmax)
+        return token_probability.flip(0).cumsum(0).flip(0)
     
     def get_token_mask(self, token_number=None):
         # self.update_kept_token_number()
@@ -14,9 +14,9 @@ import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 
 
-from .timm import DiffRateBlock, DiffRateAttention
+from .timm import DiffRateBlock, DiffRateAttention, StaticDiffRateBlock, make_static_diffrate_class
 
-from ..utils import ste_min
+from ..utils import ste_min, load_kept_num
 
 
 def make_diffrate_class(transformer_class):
@@ -53,7 +53,7 @@ def make_diffrate_class(transformer_class):
                 x = blk(x)
 
             if self.global_pool:
-                if self.training:
+                if self.training and self._info["mask"] is not None:
                     mask = self._info["mask"][...,None]  # [B, N, 1]
                     num = (self._info["size"] * mask)[:, 1:, :].sum(dim=1) # [B,1]
                     x = (x * self._info["size"] * mask)[:, 1:, :].sum(dim=1) / num.detach()
@@ -166,14 +166,20 @@ def make_diffrate_class(transformer_class):
 
 
 def apply_patch(
-    model: VisionTransformer, trace_source: bool = False, prune_granularity=1, merge_granularity=1
+    model: VisionTransformer, trace_source: bool = False, prune_granularity=1, merge_granularity=1, kept_num=None
 ):
     """
     Applies DiffRate to this transformer.
+    kept_num: a json schedule exported by utils.save_kept_num (or a (prune_kept_num, merge_kept_num)
+    pair) to run with a fixed compression rate, without DiffRate modules or architecture parameters.
     """
+    if isinstance(kept_num, str):
+        kept_num = load_kept_num(kept_num)
     DiffRateVisionTransformer = make_diffrate_class(model.__class__)
 
     print('use', 'diffrate')
+    if kept_num is not None:
+        DiffRateVisionTransformer = make_static_diffrate_class(DiffRateVisionTransformer)
     model.__class__ = DiffRateVisionTransformer
     model._info = {
         "size": None,
@@ -188,10 +194,14 @@ def apply_patch(
     non_compressed_block_index = [0, len(model.blocks)-1]
     for module in model.modules():
         if isinstance(module, Block):
-            module.__class__ = DiffRateBlock
-            if block_index in non_compressed_block_index:
+            if kept_num is not None:
+                module.__class__ = StaticDiffRateBlock
+                module.introduce_kept_num(kept_num[0][block_index], kept_num[1][block_index])
+            elif block_index in non_compressed_block_index:
+                module.__class__ = DiffRateBlock
                 module.introduce_diffrate(model.patch_embed.num_patches, model.patch_embed.num_patches+1, model.patch_embed.num_patches+1)
             else:
+                module.__class__ = DiffRateBlock
                 module.introduce_diffrate(model.patch_embed.num_patches, prune_granularity, merge_granularity)
             block_index += 1
             module._info = model._info
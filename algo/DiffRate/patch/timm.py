@@ -14,6 +14,7 @@ from typing import Tuple
 import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 import torch.nn as nn
+import torch.nn.functional as F
 # import DiffRate.ddp as ddp
 from ..ddp import DiffRate
 from ..merge import get_merge_func
@@ -25,9 +26,14 @@ class DiffRateBlock(Block):
      - Apply DiffRate between the attention and mlp blocks
      - Compute and propogate token size and potentially the token sources.
     """
+    searching = True
+
     def introduce_diffrate(self,patch_number, prune_granularity, merge_granularity):
         self.prune_ddp = DiffRate(patch_number,prune_granularity)
         self.merge_ddp = DiffRate(patch_number,merge_granularity)
+
+    def kept_num(self):
+        return self.prune_ddp.kept_token_number, self.merge_ddp.kept_token_number
         
     def _drop_path1(self, x):
         return self.drop_path1(x) if hasattr(self, "drop_path1") else self.drop_path(x)
@@ -54,12 +60,13 @@ class DiffRateBlock(Block):
         # sorting
         x = torch.gather(x, dim=1, index=idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
         self._info["size"] = torch.gather(self._info["size"], dim=1, index=idx.unsqueeze(-1))
-        mask = torch.gather( mask, dim=1, index=idx)
+        if mask is not None:
+            mask = torch.gather( mask, dim=1, index=idx)
         if self._info["trace_source"]:
             self._info["source"] = torch.gather(self._info["source"], dim=1, index=idx.unsqueeze(-1).expand(-1, -1, self._info["source"].shape[-1]))
 
         
-        if self.training:
+        if self.training and self.searching:
             # pruning, pruning only needs to generate masks during training
             last_token_number = mask[0].sum().int()
             prune_kept_num = self.prune_ddp.update_kept_token_number()      # expected prune compression rate, has gradiet
@@ -91,7 +98,7 @@ class DiffRateBlock(Block):
             
         else:
             # pruning
-            prune_kept_num = self.prune_ddp.kept_token_number
+            prune_kept_num, merge_kept_num = self.kept_num()
             x = x[:, :prune_kept_num]
             self._info["size"] = self._info["size"][:, :prune_kept_num]
             if self._info["trace_source"]:
@@ -99,7 +106,6 @@ class DiffRateBlock(Block):
                 
             
             # merging
-            merge_kept_num = self.merge_ddp.kept_token_number
             if merge_kept_num < prune_kept_num:
                 merge,node_max = get_merge_func(x.detach(), kept_number=merge_kept_num)
                 x = merge(x,mode='mean')
@@ -113,12 +119,68 @@ class DiffRateBlock(Block):
         return x
                 
 
+class StaticDiffRateBlock(DiffRateBlock):
+    """
+    DiffRateBlock with a fixed, exported compression rate: no DiffRate proxies, no
+    architecture parameters and no STE, the kept token numbers are plain ints.
+    """
+    searching = False
+
+    def introduce_kept_num(self, prune_kept_num, merge_kept_num):
+        self._prune_kept_num = int(prune_kept_num)
+        self._merge_kept_num = int(merge_kept_num)
+
+    def kept_num(self):
+        return self._prune_kept_num, self._merge_kept_num
+
+
+def make_static_diffrate_class(diffrate_class):
+    class StaticDiffRateVisionTransformer(diffrate_class):
+        def forward(self, x, return_flop=True) -> torch.Tensor:
+            B = x.shape[0]
+            N = self.patch_embed.num_patches + 1
+            self._info["size"] = torch.ones([B, N, 1], device=x.device)
+            self._info["mask"] = None
+            if self._info["trace_source"]:
+                self._info["source"] = torch.eye(N, device=x.device)[None, ...].expand(B, N, N)
+            x = super(diffrate_class, self).forward(x)
+            if return_flop:
+                return x, self.calculate_flop_inference()
+            return x
+
+        def get_kept_num(self):
+            prune_kept_num, merge_kept_num = zip(*[block.kept_num() for block in self.blocks])
+            return list(prune_kept_num), list(merge_kept_num)
+
+        def set_kept_num(self, prune_kept_numbers, merge_kept_numbers):
+            assert len(prune_kept_numbers) == len(self.blocks) and len(merge_kept_numbers) == len(self.blocks)
+            for block, prune_kept_number, merge_kept_number in zip(self.blocks, prune_kept_numbers, merge_kept_numbers):
+                block.introduce_kept_num(prune_kept_number, merge_kept_number)
+
+        def calculate_flop_inference(self):
+            C = self.embed_dim
+            N = self.patch_embed.num_patches + 1
+            flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
+            for block in self.blocks:
+                prune_kept_number, merge_kept_number = block.kept_num()
+                flops += 4*N*C*C + 2*N*N*C
+                N = min(N, prune_kept_number, merge_kept_number)
+                flops += 8*N*C*C
+            flops += C*self.num_classes
+            return flops
+
+    return StaticDiffRateVisionTransformer
+
+
 class DiffRateAttention(Attention):
     """
     Modifications:
      - Apply proportional attention
      - Return the mean of k over heads from attention
+     - At inference, only the class token attention row is materialized for ranking,
+       the full attention goes through the fused kernel
     """
+    fused_attn = hasattr(F, "scaled_dot_product_attention")
 
     def softmax_with_policy(self, attn, policy, eps=1e-6):
         B, N = policy.size()
@@ -149,13 +211,25 @@ class DiffRateAttention(Attention):
             qkv[2],
         )  # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-
         # Apply proportional attention
-        if size is not None:
-            attn = attn + size.log()[:, None, None, :, 0]
+        bias = size.log()[:, None, None, :, 0].to(q.dtype) if size is not None else None
+
+        if not self.training and self.fused_attn:
+            # (B, H, 1, N) class token row, enough for the token ranking in DiffRateBlock
+            cls_attn = (q[:, :, :1] @ k.transpose(-2, -1)) * self.scale
+            if bias is not None:
+                cls_attn = cls_attn + bias
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias, scale=self.scale)
+            x = x.transpose(1, 2).reshape(B, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, cls_attn.softmax(dim=-1)
+
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        if bias is not None:
+            attn = attn + bias
         
-        if self.training:
+        if self.training and mask is not None:
             attn = self.softmax_with_policy(attn, mask)
         else:
             attn = attn.softmax(dim=-1)
@@ -2,6 +2,7 @@
 This file is modified based on https://github.com/facebookresearch/ToMe/blob/main/tome/utils.py
 '''
 
+import json
 import time
 from typing import List, Tuple, Union
 
@@ -34,6 +35,32 @@ ste_ceil = STE_Ceil.apply
 ste_min = STE_Min.apply
 
 
+def save_kept_num(model: torch.nn.Module, path: str, **meta) -> dict:
+    """
+    Export the searched per-block prune / merge kept token numbers of a DiffRate
+    model to a json schedule. Extra keyword arguments (e.g. model name, target
+    flops) are stored alongside for bookkeeping.
+    """
+    prune_kept_num, merge_kept_num = model.get_kept_num()
+    schedule = {
+        **meta,
+        "prune_kept_num": [int(n) for n in prune_kept_num],
+        "merge_kept_num": [int(n) for n in merge_kept_num],
+    }
+    with open(path, "w") as f:
+        json.dump(schedule, f, indent=2)
+    return schedule
+
+
+def load_kept_num(path: str) -> Tuple[List[int], List[int]]:
+    """
+    Read a schedule written by save_kept_num, returns (prune_kept_num, merge_kept_num).
+    """
+    with open(path) as f:
+        schedule = json.load(f)
+    return schedule["prune_kept_num"], schedule["merge_kept_num"]
+
+
 def benchmark(
     model: torch.nn.Module,
     device: torch.device = 0,
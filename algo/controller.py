@@ -0,0 +1,126 @@
+import json
+import time
+from collections import deque
+from typing import Callable
+
+import torch
+import torch.nn as nn
+
+
+class LatencyController(nn.Module):
+    """
+    Wraps a patched model and adjusts its keep-ratio between batches to hold a latency target.
+
+    Every forward is timed. Once `window` batches were run at the current ratio, the `quantile`
+    (p95 by default) of their wall times is compared with target_ms: above
+    target_ms * (1 + hysteresis) the ratio is lowered by step, below target_ms * (1 - hysteresis)
+    it is raised by step, always within [min_ratio, max_ratio]. Inside the band the ratio is
+    kept, so it does not flip on every batch. The latencies are reset after every change, since
+    they were measured at the old ratio.
+
+    The ratio every batch ran with is logged in self.log (and appended as json lines to
+    log_path if set), so the accuracy impact can be audited afterwards. The log file is opened
+    at the first batch and kept open until close().
+
+    Args:
+     - model: the patched model, called as is
+     - target_ms: the latency target in milliseconds
+     - set_ratio: sets the ratio on the model, model.ratio = ratio by default. Pass e.g.
+       Engine.set_ratio or a setter on a sub-module (bert.encoder)
+     - ratio: the initial ratio, max_ratio by default
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        target_ms: float,
+        min_ratio: float = 0.5,
+        max_ratio: float = 1.0,
+        step: float = 0.025,
+        hysteresis: float = 0.1,
+        quantile: float = 0.95,
+        window: int = 10,
+        ratio: float = None,
+        set_ratio: Callable[[float], None] = None,
+        log_path: str = None,
+    ):
+        super().__init__()
+        assert min_ratio <= max_ratio, "min_ratio must not exceed max_ratio"
+        self.model = model
+        self.target_ms = target_ms
+        self.min_ratio, self.max_ratio = min_ratio, max_ratio
+        self.step = step
+        self.hysteresis = hysteresis
+        self.quantile = quantile
+        self.latencies = deque(maxlen=window)
+        self.set_ratio = set_ratio if set_ratio is not None else lambda r: setattr(model, "ratio", r)
+        self.log_path = log_path
+        self._log_file = None
+        self.log = []
+        self.ratio = None
+        self._use_ratio(max_ratio if ratio is None else ratio)
+
+    def _use_ratio(self, ratio: float):
+        # rounded so that schedules cached per ratio are reused
+        ratio = round(min(max(ratio, self.min_ratio), self.max_ratio), 6)
+        if ratio != self.ratio:
+            self.ratio = ratio
+            self.set_ratio(ratio)
+            self.latencies.clear()
+
+    def _sync(self):
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def percentile(self) -> float:
+        """
+        The quantile of the latencies measured at the current ratio, in milliseconds.
+        """
+        return torch.tensor(list(self.latencies), dtype=torch.float64).quantile(self.quantile).item()
+
+    def update(self, latency_ms: float, batch_size: int = None) -> float:
+        """
+        Records the latency of a batch run at self.ratio and picks the ratio of the next batch.
+        """
+        self.latencies.append(latency_ms)
+        entry = {
+            "batch": len(self.log),
+            "ratio": self.ratio,
+            "latency_ms": latency_ms,
+            "batch_size": batch_size,
+            "quantile_ms": None,
+        }
+        if len(self.latencies) == self.latencies.maxlen:
+            p = entry["quantile_ms"] = self.percentile()
+            if p > self.target_ms * (1 + self.hysteresis):
+                self._use_ratio(self.ratio - self.step)
+            elif p < self.target_ms * (1 - self.hysteresis):
+                self._use_ratio(self.ratio + self.step)
+        self.log.append(entry)
+        if self.log_path is not None:
+            if self._log_file is None:
+                # line buffered: every batch is on disk without reopening the file
+                self._log_file = open(self.log_path, "a", buffering=1)
+            self._log_file.write(json.dumps(entry) + "\n")
+        return self.ratio
+
+    def close(self):
+        """
+        Closes the log file, a later batch opens it again.
+        """
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def __del__(self):
+        if getattr(self, "_log_file", None) is not None:
+            self._log_file.close()
+
+    def forward(self, x, *args, **kwargs):
+        self._sync()
+        start = time.perf_counter()
+        out = self.model(x, *args, **kwargs)
+        self._sync()
+        batch_size = x.shape[0] if torch.is_tensor(x) else None
+        self.update((time.perf_counter() - start) * 1000, batch_size=batch_size)
+        return out
@@ -11,6 +11,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from ..plan import MergePlan
 
 
 
@@ -23,7 +24,22 @@ def crossget(
     metric: torch.Tensor, 
     ratio:float=1.0,
     class_token: bool = False,
+    return_plan: bool = False,
+    chunk_size: int = 256,
+    legacy: bool = False,
 ):
+        """
+        Cross-guided matching. Rows and columns of the similarity matrix are
+        ranked by their maxima and a row may only match columns ranked after it.
+        Instead of materialising the doubly permuted matrix and a tril mask, the
+        mask is applied in place on the unpermuted similarity, chunk_size rows at
+        a time, by comparing row and column ranks.
+        The r tokens with the best masked row maximum are merged, each into the
+        kept token of highest masked similarity: only the r source rows are
+        gathered for that. legacy reproduces the earlier matching bit for bit,
+        which ranked the permuted rows as if they were tokens and merged every
+        source into the first kept token.
+        """
         with torch.no_grad():
             if class_token:
                 metric=metric[:,1:,:]
@@ -34,21 +50,41 @@ def crossget(
                 return do_nothing, do_nothing
             metric = F.normalize(metric, p=2, dim=-1) 
 
-
-            D = metric@metric.transpose(-1,-2) - torch.eye(T, device=metric.device)[None, ...] 
-            A_s = torch.argsort(torch.max(D, dim=-1, keepdim=True)[0], dim=-2, descending=True)
-            A_d = torch.argsort(torch.max(D, dim=-2, keepdim=True)[0], dim=-1, descending=True)
-
-            D = D.gather(dim=-2, index=A_s.expand(B, T, T)) 
-            D = D.gather(dim=-1, index=A_d.expand(B, T, T))
-
-            D = D -  1e9*torch.tril((torch.ones_like(D)))
-
-            A = torch.argsort(torch.max(D, dim=-1)[0], dim=-1, descending=True)[..., None]
-            unm_idx = A[..., r:, :]  # Unmerged Tokens
-            src_idx = A[..., :r, :]  # Merged Tokens
-            scores = D.gather(dim=-1, index=src_idx.expand(B, r, D.shape[-1])) 
-            dst_idx = scores.argmax(dim=-1)[..., None]
+            D = metric@metric.transpose(-1,-2)
+            D.diagonal(dim1=-2, dim2=-1).sub_(1.0)
+            A_s = torch.argsort(D.amax(dim=-1), dim=-1, descending=True)
+            A_d = torch.argsort(D.amax(dim=-2), dim=-1, descending=True)
+            # rank of every original row / column in the sorted order
+            row_rank = torch.argsort(A_s, dim=-1)
+            col_rank = torch.argsort(A_d, dim=-1)
+
+            # entry (i, j) is kept iff col_rank[j] > row_rank[i]
+            for start in range(0, T, chunk_size):
+                rows = D[:, start:start + chunk_size]
+                mask = col_rank[:, None, :] <= row_rank[:, start:start + chunk_size, None]
+                rows.masked_fill_(mask, -1e9)
+
+            if legacy:
+                # row scores in sorted-row order, as in the permuted formulation
+                row_scores = D.amax(dim=-1).gather(dim=-1, index=A_s)
+                A = torch.argsort(row_scores, dim=-1, descending=True)[..., None]
+                unm_idx = A[..., r:, :]  # Unmerged Tokens
+                src_idx = A[..., :r, :]  # Merged Tokens
+                dst_idx = src_idx.new_zeros(B, r, 1)
+            else:
+                A = torch.argsort(D.amax(dim=-1), dim=-1, descending=True)[..., None]
+                unm_idx = A[..., r:, :]  # Unmerged Tokens
+                src_idx = A[..., :r, :]  # Merged Tokens
+                scores = D.gather(dim=-2, index=src_idx.expand(B, r, T))
+                scores = scores.gather(dim=-1, index=unm_idx[..., 0][:, None, :].expand(B, r, T - r))
+                dst_idx = scores.argmax(dim=-1)[..., None]
+
+        if return_plan:
+            offset = 1 if class_token else 0
+            keep_idx = unm_idx[..., 0] + offset
+            if class_token:
+                keep_idx = torch.cat([keep_idx.new_zeros(B, 1), keep_idx], dim=-1)
+            return MergePlan.from_indices(keep_idx, src_idx[..., 0] + offset, dst_idx[..., 0] + offset, T + offset)
         
         
         def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
@@ -77,6 +77,62 @@ def benchmark(
     return throughput
 
 
+def peak_memory(fn, *args, device: torch.device = "cpu", **kwargs) -> int:
+    """
+    Peak number of bytes allocated by torch while running fn(*args, **kwargs),
+    relative to the memory held before the call. CUDA uses the allocator
+    statistics, CPU replays the allocation events of the profiler.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn(*args, **kwargs)
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn(*args, **kwargs)
+    # allocations are attributed to the innermost op, frees show up as
+    # standalone "[memory]" events
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    current, peak = 0, 0
+    for e in events:
+        current += e.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark_memory(
+    batch_size: int = 64,
+    num_tokens: int = 197,
+    dim: int = 64,
+    ratio: float = 0.9,
+    class_token: bool = True,
+    device: torch.device = "cpu",
+    verbose: bool = False,
+) -> float:
+    """
+    Peak memory of one crossget matching step, expressed in multiples of a
+    single B x T x T float32 similarity matrix (the unavoidable floor).
+    """
+    from .merge import crossget
+
+    metric = torch.randn(batch_size, num_tokens, dim, device=device)
+    crossget(metric, ratio, class_token)  # warm up allocator / caches
+    peak = peak_memory(crossget, metric, ratio, class_token, device=device)
+    T = num_tokens - 1 if class_token else num_tokens
+    multiple = peak / (batch_size * T * T * 4)
+
+    if verbose:
+        print(f"Peak memory: {peak / 2**20:.2f} MiB ({multiple:.2f}x similarity)")
+
+    return multiple
+
+
 def parse_r(num_layers: int, r: Union[List[int], Tuple[int, float], int]) -> List[int]:
     """
     Process a constant r or r schedule into a list for use internally.
@@ -1,6 +1,10 @@
 import math
 import torch
 import numpy as np
+from functools import lru_cache
+
+# above this many tokens the O(T log T) FFT path beats the dense basis matmul
+MAX_BASIS_TOKENS = 1024
 
 def dct(x, norm=None):
     """
@@ -73,26 +77,38 @@ def idct(X, norm=None):
 
 
 
+@lru_cache(maxsize=64)
+def dct_basis(T:int, keep:int, dtype:torch.dtype, device:torch.device):
+    """
+    Low-pass projection matrix of shape (keep, T) equal to
+    idct_keep(truncate_keep(dct_T(.))) with orthonormal scaling. Built once in
+    float64 through the FFT implementation above and cached per
+    (T, keep, dtype, device), so dc_transform reduces to a single matmul.
+    """
+    eye = torch.eye(T, dtype=torch.float64)
+    basis = dct(eye, norm='ortho')[:, :keep]
+    basis = idct(basis, norm='ortho')
+    return basis.t().contiguous().to(dtype=dtype, device=device)
+
+
 def dc_transform(x, ratio:float=None,  class_token:bool=True ):
     if class_token:
-        x_cls = x[:,0,:].unsqueeze_(1)
+        x_cls = x[:,:1,:]
         x = x[:,1:,:]
-    x = x.type(torch.float32).permute(1,0,2)
-    x_dct = dct(x.transpose(0,2), norm='ortho').transpose(0,2)
-    T, B, C = x_dct.size()
-
-    # feel free to play with any method here
-    if ratio is not None: 
-        x_dct = x_dct[:math.ceil(T * ratio), :, :]
+    B, T, C = x.size()
+    keep = T if ratio is None else math.ceil(T * ratio)
+    dtype = x.dtype
+
+    if T <= MAX_BASIS_TOKENS:
+        # half matmul is not supported (or slow) on cpu, accumulate in float32 there
+        compute_dtype = torch.float32 if x.device.type == 'cpu' else dtype
+        basis = dct_basis(T, keep, compute_dtype, x.device)
+        x = torch.matmul(basis, x.to(compute_dtype)).to(dtype)
     else:
-        x_dct = x_dct[:T-k, :, :]
+        x = x.type(torch.float32).transpose(1,2)
+        x_dct = dct(x, norm='ortho')[..., :keep]
+        x = idct(x_dct, norm='ortho').transpose(1,2).to(dtype)
 
-    x = idct(x_dct.transpose(0,2), norm='ortho').transpose(0,2).type(torch.half).permute(1,0,2)
-    
     if class_token:
         return torch.cat([x_cls, x], dim=1)
     return x
-    
-
-
-
@@ -8,6 +8,7 @@
 import math
 import torch
 from typing import Callable, List, Tuple, Union
+from ..plan import MergePlan, bipartite_plan
 
 
 def mctf(x, info,attn=None, ratio=1.0, r=0, class_token=False):
@@ -41,6 +42,7 @@ def bipartite_soft_matching(
         bidirection:  int=True,
         size   : torch.Tensor=None,
         attn   : torch.Tensor=None,
+        return_plan: bool=False,
 ) -> Tuple[Callable, Callable]:
 
     
@@ -120,6 +122,17 @@ def bipartite_soft_matching(
         src_idx2 = edge_idx2[..., :r2, :]  # Merged Tokens   (12, 8, 1)
         dst_idx2 = node_idx2[..., None].gather(dim=-2, index=src_idx2)  # (12, 8, 1)
 
+    if return_plan:
+        # first step merges a into b with layout [unm, dst], the second one merges dst back into unm
+        plan = bipartite_plan(unm_idx, src_idx, dst_idx, T)
+        num_unm = t1 - r1
+        keep_idx2 = torch.cat([
+            torch.arange(num_unm, device=metric.device)[None, :].expand(B, num_unm),
+            unm_idx2[..., 0] + num_unm,
+        ], dim=-1)
+        plan2 = MergePlan.from_indices(keep_idx2, src_idx2[..., 0] + num_unm, dst_idx2[..., 0], num_unm + t2)
+        return plan.compose(plan2)
+
     def dim_match(src, dim=1, dim_num=5):
         while len(src.shape) < dim_num:
             src = src.unsqueeze(dim)
@@ -153,8 +166,38 @@ def bipartite_soft_matching(
     return merge
 
 
+def merge_attention(
+        merge: Callable, attn: torch.Tensor, weight: torch.Tensor, norm: torch.Tensor,
+        head_chunk: int = 1, head_average: bool = False,
+    ) -> torch.Tensor:
+    """
+    One step ahead attention: merges the keys (sum) then the queries (weighted
+    sum) of a (B, H, T, T) attention map. Heads are processed head_chunk at a
+    time into a preallocated output so only one chunk of temporaries is alive.
+    With head_average the map is averaged over heads first and merged once, the
+    result is broadcast back over H (exact for the head mean, approximate per head).
+    """
+    B, H = attn.shape[:2]
+    if head_average:
+        attn = attn.mean(dim=1, keepdim=True)
+        head_chunk = 1
+
+    out = None
+    for h in range(0, attn.shape[1], head_chunk):
+        chunk = merge(attn[:, h:h + head_chunk, ..., None], mode="sum").squeeze(-1)
+        chunk = merge(chunk * weight[:, None], mode="sum") / norm[:, None]
+        if out is None:
+            out = chunk.new_empty(B, attn.shape[1], *chunk.shape[-2:])
+        out[:, h:h + head_chunk] = chunk
+
+    if head_average:
+        out = out.expand(B, H, *out.shape[-2:])
+    return out
+
+
 def merge_wavg(
         merge: Callable, x: torch.Tensor, attn:torch.Tensor, size: torch.Tensor = None, one_step_ahead=0,
+        head_chunk: int = 1, head_average: bool = False,
     ):
     """
     Applies the merge function by taking a weighted average based on token size.
@@ -173,9 +216,10 @@ def merge_wavg(
         norm = merge(attn_m * (size / size_max), mode="sum") # (1, 197, 1)
 
     if one_step_ahead:
-        attn_n = merge(attn[..., None], mode="sum").squeeze(-1)  # (6(B), 6(H), 197(T_Q), 181(T_K))
-        attn_n = merge(attn_n * attn_m[:, None] * (size / size_max)[:, None], mode="sum").squeeze(-1) # (1(B), 6(H), 181(T_Q), 181(T_K))
-        attn_n = attn_n / norm[:, None]
+        attn_n = merge_attention(
+            merge, attn, attn_m * (size / size_max), norm,
+            head_chunk=head_chunk, head_average=head_average,
+        )  # (1(B), 6(H), 181(T_Q), 181(T_K))
 
     x = merge(x * attn_m * (size / size_max), mode="sum")
     with torch.no_grad():
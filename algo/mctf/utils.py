@@ -103,3 +103,50 @@ def parse_r(num_layers: int, r: Union[List[int], Tuple[int, float], int]) -> Lis
     step = (max_val - min_val) / (num_layers - 1)
 
     return [int(min_val + step * i) for i in range(num_layers)]
+
+
+def benchmark_one_step_ahead(
+    batch_size: int = 64,
+    num_heads: int = 6,
+    num_tokens: int = 197,
+    dim: int = 64,
+    ratio: float = 0.9,
+    head_chunk: int = 1,
+    device: torch.device = "cpu",
+    verbose: bool = False,
+) -> dict:
+    """
+    Compare the one step ahead attention merge of merge_wavg on random inputs:
+    all heads at once (reference), chunked by head and the head-averaged
+    approximation. Returns the wall time of each variant and the error of the
+    chunked and approximate outputs against the reference.
+    """
+    from .merge import bipartite_soft_matching, merge_wavg
+
+    metric = torch.randn(batch_size, num_tokens, dim, device=device)
+    attn = torch.randn(batch_size, num_heads, num_tokens, num_tokens, device=device).softmax(dim=-1)
+    merge = bipartite_soft_matching(metric, class_token=True, ratio=ratio, attn=attn, tau_info=20)
+
+    variants = {
+        "reference": dict(head_chunk=num_heads),
+        "chunked": dict(head_chunk=head_chunk),
+        "head_average": dict(head_average=True),
+    }
+    outputs, results = {}, {}
+    with torch.no_grad():
+        for name, kwargs in variants.items():
+            start = time.time()
+            _, _, outputs[name] = merge_wavg(merge, metric, attn, one_step_ahead=1, **kwargs)
+            results[name + "_time"] = time.time() - start
+
+    ref = outputs["reference"]
+    for name in ("chunked", "head_average"):
+        diff = outputs[name] - ref
+        results[name + "_max_abs_err"] = diff.abs().max().item()
+        results[name + "_rel_err"] = (diff.norm() / ref.norm()).item()
+
+    if verbose:
+        for k, v in results.items():
+            print(f"{k}: {v:.4g}")
+
+    return results
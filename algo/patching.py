@@ -0,0 +1,139 @@
+import functools
+import importlib
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import torch.nn as nn
+
+
+def _state(module: nn.Module):
+    attrs = dict(module.__dict__)
+    return module.__class__, attrs, {k: dict(v) for k, v in attrs.items() if isinstance(v, dict)}
+
+
+def _diff(module: nn.Module, cls, attrs: dict, dicts: dict) -> dict:
+    """
+    What a patch changed on module: its class, the attributes it replaced or removed (and the
+    ones it had before), and the same for the entries of dict attributes (_parameters, _modules,
+    forward hooks, ...).
+    """
+    now = module.__dict__
+    record = {
+        "module": module,
+        "class": cls if module.__class__ is not cls else None,
+        "keys": set(attrs) | {"_patch_history"},
+        "old": {k: v for k, v in attrs.items() if k not in now or now[k] is not v},
+        "entries": {},
+    }
+    for name, entries in dicts.items():
+        if name in record["old"]:
+            continue
+        current = now[name]
+        added = [k for k in current if k not in entries]
+        old = {k: v for k, v in entries.items() if k not in current or current[k] is not v}
+        if added or old:
+            record["entries"][name] = (added, old)
+    return record
+
+
+def _undo(record: dict):
+    module = record["module"]
+    if record["class"] is not None:
+        module.__class__ = record["class"]
+    # attributes set while patched (by the patch or its forward, e.g. total_flop) are dropped
+    for k in [k for k in module.__dict__ if k not in record["keys"]]:
+        del module.__dict__[k]
+    module.__dict__.update(record["old"])
+    for name, (added, old) in record["entries"].items():
+        entries = module.__dict__[name]
+        for k in added:
+            entries.pop(k, None)
+        entries.update(old)
+
+
+def reversible(apply_patch: Callable) -> Callable:
+    """
+    Wraps an apply_patch function so that unpatch(model) can undo it: the classes and
+    attributes of every module are compared before and after patching and the changes are
+    recorded in model._patch_history.
+    """
+    if getattr(apply_patch, "reversible", False):
+        return apply_patch
+
+    @functools.wraps(apply_patch)
+    def patch(model: nn.Module, *args, **kwargs):
+        before = [(module, _state(module)) for module in model.modules()]
+        out = apply_patch(model, *args, **kwargs)
+        records = [_diff(module, *state) for module, state in before]
+        model.__dict__.setdefault("_patch_history", []).append(records)
+        return out
+
+    patch.reversible = True
+    return patch
+
+
+def get_patch(algo: str, name: str) -> Callable:
+    """
+    Looks up the apply_patch of an algorithm (pitome, tome, tofu, dct, mctf, crossget, DiffRate)
+    for a model family (deit, mae, bert, ...) and makes it reversible, e.g.
+
+        get_patch("tome", "deit")(model)
+        ...
+        unpatch(model)
+    """
+    return reversible(getattr(importlib.import_module(f"{__package__}.{algo}.patch"), name))
+
+
+def unpatch(model: nn.Module, keep: int = 0) -> nn.Module:
+    """
+    Undoes the reversible patches applied to model (through get_patch, patched, sweep or a
+    reversible(apply_patch)), latest first, until only the first keep remain: the original
+    classes come back and the attributes added by the patches are removed.
+    The weights are untouched, so a loaded model can be patched again with another algorithm.
+    """
+    history = model.__dict__.get("_patch_history", [])
+    while len(history) > keep:
+        for record in reversed(history.pop()):
+            _undo(record)
+    if not history:
+        model.__dict__.pop("_patch_history", None)
+    return model
+
+
+@contextmanager
+def patched(model: nn.Module, apply_patch: Callable, ratio: float = None, **kwargs):
+    """
+    Patches model in place for the duration of the block and restores it afterwards, e.g.
+
+        with patched(model, tome.patch.deit, ratio=0.9):
+            evaluate(data_loader_val, model)
+    """
+    keep = len(model.__dict__.get("_patch_history", []))
+    reversible(apply_patch)(model, **kwargs)
+    if ratio is not None:
+        model.ratio = ratio
+    try:
+        yield model
+    finally:
+        unpatch(model, keep=keep)
+
+
+def sweep(
+    model: nn.Module,
+    patches: Dict[str, Callable],
+    ratios: List[float],
+    evaluate: Callable[[nn.Module], dict],
+    **kwargs,
+) -> List[dict]:
+    """
+    Runs evaluate(model) for every algorithm in patches (name -> apply_patch) and every ratio
+    on a single loaded model. Returns one row per run with its "algo", "ratio" and the
+    metrics returned by evaluate.
+    """
+    rows = []
+    for name, apply_patch in patches.items():
+        with patched(model, apply_patch, **kwargs):
+            for ratio in ratios:
+                model.ratio = ratio
+                rows.append({"algo": name, "ratio": ratio, **evaluate(model)})
+    return rows
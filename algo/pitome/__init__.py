@@ -5,8 +5,8 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
-from . import merge, patch, utils
+from . import export, merge, patch, utils
 from .vis import make_visualization
 
-__all__ = ["utils", "merge", "patch", "make_visualization"]
+__all__ = ["utils", "merge", "patch", "export", "make_visualization"]
 
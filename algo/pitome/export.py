@@ -0,0 +1,193 @@
+# --------------------------------------------------------
+# ONNX export of PiToMe patched models for onnxruntime CPU serving.
+# --------------------------------------------------------
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple, Union
+
+import torch
+import torch.nn as nn
+
+
+class ExportWrapper(nn.Module):
+    """
+    Calls a patched model with the keyword arguments that make its output a plain tensor:
+    return_flop=False for the vision models, return_dict=False for the transformers models.
+    Returns the first output (logits, pooled features or last hidden state).
+    """
+
+    def __init__(self, model: nn.Module, **kwargs):
+        super().__init__()
+        self.model = model
+        self.kwargs = kwargs
+
+    def forward(self, *inputs):
+        out = self.model(*inputs, **self.kwargs)
+        while isinstance(out, (tuple, list)):
+            out = out[0]
+        return out
+
+
+def _output_kwargs(model: nn.Module, kwargs: dict) -> dict:
+    # transformers models have a config, the patched vision models a return_flop argument
+    if "return_flop" not in kwargs and "return_dict" not in kwargs:
+        kwargs = {**kwargs, ("return_dict" if hasattr(model, "config") else "return_flop"): False}
+    return kwargs
+
+
+def _patched_modules(model: nn.Module):
+    # the modules whose forward reads model.token_schedule (the vision model or the bert encoder)
+    return [m for m in model.modules() if hasattr(m, "token_schedule") and hasattr(m, "_info")]
+
+
+@contextmanager
+def export_mode(model: nn.Module, *inputs, ratio: float = None, **kwargs):
+    """
+    Prepares a patched model for tracing and restores it afterwards:
+     - the token schedule is fixed: the static_ratio schedule if the model was patched with
+       one, else the schedule a forward of inputs at ratio (or model.ratio) runs with
+     - fused scaled_dot_product_attention is turned off, its export fails on torch 2.2
+    """
+    patched = _patched_modules(model)
+    assert len(patched) > 0, "export needs a model patched with pitome"
+    schedules = [(m, m.token_schedule, m.ratio) for m in patched]
+    fused = [(m, m.__dict__.get("fused_attn")) for m in model.modules() if hasattr(m, "fused_attn")]
+    try:
+        dynamic = [m for m in patched if m.token_schedule is None]
+        if len(dynamic) > 0:
+            for m in dynamic:
+                m.ratio = m.ratio if ratio is None else ratio
+            with torch.no_grad():
+                model(*inputs, **kwargs)
+            for m in dynamic:
+                m.token_schedule = m._info["schedule"]
+        for m, _ in fused:
+            m.fused_attn = False
+        yield model
+    finally:
+        for m, schedule, ratio in schedules:
+            m.token_schedule, m.ratio = schedule, ratio
+        for m, value in fused:
+            if value is None:
+                m.__dict__.pop("fused_attn", None)
+            else:
+                m.fused_attn = value
+
+
+def export_onnx(
+    model: nn.Module,
+    path: str,
+    inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]],
+    ratio: float = None,
+    input_names: Tuple[str, ...] = None,
+    opset_version: int = 17,
+    dynamic_batch: bool = True,
+    **kwargs,
+) -> str:
+    """
+    Exports a pitome patched deit / mae (patch.deit, patch.mae) or a transformers model with a
+    patched bert encoder (patch.bert) to ONNX, with a fixed token schedule (see export_mode).
+
+    Merging is traced into plain gather / TopK / ScatterElements(add) ops that onnxruntime
+    runs: the plans are built with return_plan and MergePlan.merge uses scatter_add while
+    exporting. The sequence length is fixed by the schedule, the batch size stays dynamic.
+
+    Args:
+     - model: the patched model, e.g. a timm deit or a BertForSequenceClassification
+     - path: the .onnx file to write
+     - inputs: the example input(s), (images,) or (input_ids, attention_mask)
+     - ratio: the ratio to fix the schedule at, when the model was not patched with static_ratio
+     - kwargs: extra keyword arguments of the forward, the vision models get return_flop=False
+       and the transformers models return_dict=False by default
+    Returns path.
+    """
+    inputs = (inputs,) if torch.is_tensor(inputs) else tuple(inputs)
+    if input_names is None:
+        input_names = ("x",) if len(inputs) == 1 else ("input_ids", "attention_mask", "token_type_ids")[:len(inputs)]
+    kwargs = _output_kwargs(model, kwargs)
+    wrapper = ExportWrapper(model, **kwargs).eval()
+    dynamic_axes = {name: {0: "batch"} for name in list(input_names) + ["output"]} if dynamic_batch else None
+    with export_mode(model, *inputs, ratio=ratio, **kwargs), torch.no_grad():
+        torch.onnx.export(
+            wrapper, inputs, path,
+            input_names=list(input_names),
+            output_names=["output"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+    return path
+
+
+def onnx_session(path: str, num_threads: int = None):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    # the traced shapes of a few Identity outputs disagree with the runtime ones, which
+    # onnxruntime warns about on every run
+    options.log_severity_level = 3
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def _feed(session, inputs: Tuple[torch.Tensor, ...]) -> dict:
+    return {i.name: x.cpu().numpy() for i, x in zip(session.get_inputs(), inputs)}
+
+
+def onnx_parity(
+    model: nn.Module,
+    path: str,
+    inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]],
+    ratio: float = None,
+    **kwargs,
+) -> float:
+    """
+    Max absolute difference between onnxruntime and eager PyTorch on inputs, with the same
+    fixed schedule as export_onnx. Note that the energy ranking is a sort: tokens with exactly
+    equal energy may be ordered differently by onnxruntime's TopK and merged differently.
+    """
+    inputs = (inputs,) if torch.is_tensor(inputs) else tuple(inputs)
+    kwargs = _output_kwargs(model, kwargs)
+    wrapper = ExportWrapper(model, **kwargs).eval()
+    with export_mode(model, *inputs, ratio=ratio, **kwargs), torch.no_grad():
+        expected = wrapper(*inputs)
+    session = onnx_session(path)
+    out = session.run(None, _feed(session, inputs))[0]
+    return (torch.from_numpy(out) - expected.float()).abs().max().item()
+
+
+def benchmark_onnx(
+    model: nn.Module,
+    path: str,
+    inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]],
+    ratio: float = None,
+    runs: int = 20,
+    throw_out: float = 0.25,
+    num_threads: int = None,
+    **kwargs,
+) -> Dict[str, float]:
+    """
+    CPU throughput (samples / second) of the eager patched model and of its ONNX export under
+    onnxruntime, on the same inputs and the same fixed schedule.
+    """
+    inputs = (inputs,) if torch.is_tensor(inputs) else tuple(inputs)
+    kwargs = _output_kwargs(model, kwargs)
+    wrapper = ExportWrapper(model, **kwargs).eval()
+    session = onnx_session(path, num_threads=num_threads)
+    feed = _feed(session, inputs)
+    batch_size = inputs[0].shape[0]
+    warm_up = int(runs * throw_out)
+
+    def timed(fn) -> float:
+        for _ in range(warm_up):
+            fn()
+        start = time.perf_counter()
+        for _ in range(runs - warm_up):
+            fn()
+        return batch_size * (runs - warm_up) / (time.perf_counter() - start)
+
+    with export_mode(model, *inputs, ratio=ratio, **kwargs), torch.no_grad():
+        torch_throughput = timed(lambda: wrapper(*inputs))
+    onnx_throughput = timed(lambda: session.run(None, feed))
+    return {"torch": torch_throughput, "onnxruntime": onnx_throughput}
@@ -6,11 +6,13 @@
 # --------------------------------------------------------
 
 import math
-from typing import Callable, Tuple
+from functools import lru_cache
+from typing import Callable, List, Tuple, Union
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from ..plan import MergePlan, TokenSource
 
 
 def do_nothing(x, mode=None):
@@ -83,13 +85,173 @@ def bipartite_soft_matching(
         return torch.cat([unm, dst], dim=1)
     return merge
 
+
+def pitome_plan(
+    protected_idx: torch.Tensor,
+    a_idx: torch.Tensor,
+    b_idx: torch.Tensor,
+    dst_idx: torch.Tensor,
+    class_token: bool = False,
+) -> MergePlan:
+    """
+    Builds the MergePlan equivalent to the merge closure of pitome_vision / pitome_text.
+    The output layout is [cls, protected, dst], same as the closure.
+    """
+    offset = 1 if class_token else 0
+    B, T_p = protected_idx.shape
+    keep_idx = torch.cat([protected_idx, b_idx], dim=-1) + offset
+    if class_token:
+        keep_idx = torch.cat([keep_idx.new_zeros(B, 1), keep_idx], dim=-1)
+    num_in = T_p + a_idx.shape[-1] + b_idx.shape[-1] + offset
+    return MergePlan.from_indices(keep_idx, a_idx + offset, dst_idx + T_p + offset, num_in)
+
+
+def energy_score_chunked(
+    metric: torch.Tensor,
+    margin:torch.Tensor=0.5,
+    alpha=1.0,
+    chunk_size:int=256,
+) -> torch.Tensor:
+    """
+    Computes the same energy score as pitome_vision, but row block by row block so
+    that only a (B, chunk_size, T) slice of the similarity matrix is alive at a time.
+    metric is expected to be l2 normalized already.
+    """
+    B,T,_ = metric.shape
+    energy_score = metric.new_empty(B, T)
+    metric_t = metric.transpose(-1,-2)
+    for start in range(0, T, chunk_size):
+        end = min(start + chunk_size, T)
+        sim = F.elu((metric[:, start:end, :]@metric_t - margin)/0.01, alpha=alpha)
+        energy_score[:, start:end] = sim.mean(dim=-1)
+    return energy_score
+
+
+def vision_energy_score(
+    metric: torch.Tensor,
+    margin:torch.Tensor=0.5,
+    class_token: bool = False,
+    alpha=1.0,
+    chunk_size:int=None,
+) -> torch.Tensor:
+    """
+    Returns the (B, T) energy score pitome_vision ranks the tokens with (class token excluded).
+    """
+    with torch.no_grad():
+        if class_token:
+            metric=metric[:,1:,:]
+        metric = F.normalize(metric, p=2, dim=-1) 
+        if chunk_size is not None:
+            return energy_score_chunked(metric, margin=margin, alpha=alpha, chunk_size=chunk_size)
+        return F.elu((metric@metric.transpose(-1,-2) - margin)/0.01, alpha=alpha).mean(dim=-1)
+
+
+def adaptive_r(
+    energy_score: torch.Tensor,
+    threshold: float = 0.0,
+    budget: int = None,
+) -> torch.Tensor:
+    """
+    Energy-threshold mode: the (B,) number of tokens every sample merges. Tokens with an energy 
+    score above threshold have many close neighbours (redundant), half of them are merged away, 
+    at most budget. A flat image merges up to the budget, a dense scene merges few tokens.
+    """
+    r = torch.div((energy_score > threshold).sum(dim=-1), 2, rounding_mode="floor")
+    if budget is not None:
+        r = r.clamp(max=budget)
+    return r
+
+
+def energy_drift(
+    metric: torch.Tensor,
+    energy_score: torch.Tensor,
+    margin:torch.Tensor=0.5,
+    class_token: bool = False,
+    alpha=1.0,
+    num_samples:int=32,
+) -> float:
+    """
+    Cheap estimate of how much the energy ranking moved since energy_score was computed.
+    The exact energy of num_samples evenly spaced tokens is computed against all tokens,
+    O(num_samples*T*C) instead of O(T*T*C), and compared by rank with energy_score.
+    Returns 1 - spearman correlation averaged over the batch, 0 means the ranking is unchanged.
+    Ranks are used since the margin, and so the scale of the energy, changes across layers.
+    """
+    with torch.no_grad():
+        if class_token:
+            metric=metric[:,1:,:]
+        B,T,_ = metric.shape
+        k = min(num_samples, T)
+        if k < 2:
+            return 0.0
+        sample_idx = torch.linspace(0, T-1, k, device=metric.device).long()
+        metric = F.normalize(metric, p=2, dim=-1) 
+        sim = F.elu((metric[:, sample_idx, :]@metric.transpose(-1,-2) - margin)/0.01, alpha=alpha)
+        new_rank = sim.mean(dim=-1).argsort(dim=-1).argsort(dim=-1).float()
+        old_rank = energy_score[:, sample_idx].argsort(dim=-1).argsort(dim=-1).float()
+        corr = 1 - 6*((new_rank - old_rank)**2).sum(dim=-1)/(k*(k**2 - 1))
+        return (1 - corr.mean()).item()
+
+
+def reuse_energy_score(
+    info: dict,
+    metric: torch.Tensor,
+    margin:torch.Tensor=0.5,
+    class_token: bool = False,
+    chunk_size:int=None,
+) -> torch.Tensor:
+    """
+    Cross-layer reuse of the energy ranking. Returns the energy score carried over from the
+    previous merge (info["energy"]) when its ranking drifted less than info["drift_threshold"]
+    on a sampled subset of tokens and counts it in info["plan_reused"]; otherwise computes a
+    fresh one.
+    """
+    energy_score = info["energy"]
+    T = metric.shape[1] - 1 if class_token else metric.shape[1]
+    if energy_score is not None and energy_score.shape[-1] == T:
+        drift = energy_drift(metric, energy_score, margin=margin, class_token=class_token)
+        if drift <= info["drift_threshold"]:
+            info["plan_reused"] += 1
+            return energy_score
+    return vision_energy_score(metric, margin=margin, class_token=class_token, chunk_size=chunk_size)
+
+
+def merge_energy(
+    plan: MergePlan, energy_score: torch.Tensor, class_token: bool = False
+) -> torch.Tensor:
+    """
+    Carries a (B, T) energy score through a merge so it can rank the tokens of the next layer. 
+    Merged tokens get the mean energy of their group.
+    """
+    if class_token:
+        energy_score = torch.cat([energy_score.new_zeros(energy_score.shape[0], 1), energy_score], dim=-1)
+    energy_score = plan.merge(energy_score[..., None], mode="mean")[..., 0]
+    if class_token:
+        energy_score = energy_score[:, 1:]
+    return energy_score
+
+
 def pitome_vision(
     metric: torch.Tensor, 
     ratio:float=1.0,
     margin:torch.Tensor=0.5,
     class_token: bool = False,
-    alpha=1.0
+    alpha=1.0,
+    chunk_size:int=None,
+    return_plan:bool=False,
+    energy_score:torch.Tensor=None,
+    r:int=None,
 ):
+    """
+    chunk_size: if set, the energy score is computed in row blocks of this size and only the 
+    r x r similarities between the mergeable tokens are materialized, so peak memory is 
+    O(B*T*chunk_size) instead of O(B*T*T). The result is the same as the dense path.
+    return_plan: return a MergePlan instead of the merge closure.
+    energy_score: a precomputed (B, T) energy score (without the class token) to rank the 
+    tokens with, e.g. the one carried over from the previous layer. Only the r x r 
+    similarities between the mergeable tokens are computed in that case.
+    r: a fixed number of tokens to merge, overrides ratio (static shape / torch.compile mode).
+    """
     # if margin >= 0.45:
         # return bipartite_soft_matching(metric=metric, ratio=ratio, class_token=class_token)
    
@@ -97,15 +259,21 @@ def pitome_vision(
         if class_token:
             metric=metric[:,1:,:]
         B,T,C = metric.shape
-        if ratio < 1.0:
+        if r is None:
+            if ratio >= 1.0:
+                return do_nothing, do_nothing
             r = math.floor(T- T*ratio)
-        else:
-            return do_nothing, do_nothing
 
         # calculate energy score  
         metric = F.normalize(metric, p=2, dim=-1) 
-        sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01, alpha=alpha)
-        energy_score = sim.mean(dim=-1) 
+        sim = None
+        if energy_score is not None:
+            pass
+        elif chunk_size is not None:
+            energy_score = energy_score_chunked(metric, margin=margin, alpha=alpha, chunk_size=chunk_size)
+        else:
+            sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01, alpha=alpha)
+            energy_score = sim.mean(dim=-1) 
         indices =  torch.argsort(energy_score, descending=True)
         # seperate protected token and mergeable tokens  
         merge_idx = indices[..., :2*r]
@@ -114,9 +282,17 @@ def pitome_vision(
         a_idx, b_idx = merge_idx[..., ::2], merge_idx[..., 1::2] 
 
         # get similarity scores between mergeable tokens
-        scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
-        scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
+        if sim is None:
+            a = metric.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, C))
+            b = metric.gather(dim=-2, index=b_idx.unsqueeze(-1).expand(B, r, C))
+            scores = F.elu((a@b.transpose(-1,-2) - margin)/0.01, alpha=alpha)
+        else:
+            scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
+            scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
         _, dst_idx = scores.max(dim=-1) 
+
+    if return_plan:
+        return pitome_plan(protected_idx, a_idx, b_idx, dst_idx, class_token=class_token)
     
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         if class_token:
@@ -137,12 +313,466 @@ def pitome_vision(
     return merge
 
 
+def grid_positions(
+    batch_size: int, height: int, width: int, prefix_tokens: int = 0, device=None
+) -> torch.Tensor:
+    """
+    (B, T, 2) (row, col) position of every patch token on the patch grid, in the row major 
+    order of patch_embed. The prefix_tokens prefix tokens (class / distill token, the model's 
+    num_prefix_tokens) are placed at (0, 0) and never windowed.
+    """
+    rows = torch.arange(height, device=device).repeat_interleave(width)
+    cols = torch.arange(width, device=device).repeat(height)
+    pos = torch.stack([rows, cols], dim=-1).float()
+    pos = torch.cat([pos.new_zeros(prefix_tokens, 2), pos], dim=0)
+    return pos[None, ...].expand(batch_size, -1, -1)
+
+
+def window_ids(pos: torch.Tensor, window_size: int, shift: bool = False) -> torch.Tensor:
+    """
+    (B, T) id of the window_size x window_size window every token falls into. Merged tokens 
+    are placed at the size weighted centroid of their patches. With shift, the window grid is 
+    moved by half a window (as in Swin) so that merges can cross the previous window borders.
+    """
+    offset = window_size // 2 if shift else 0
+    cell = torch.div(pos + offset, window_size, rounding_mode="floor").long()
+    return cell[..., 0] * (1 << 16) + cell[..., 1]
+
+
+def window_band(x: torch.Tensor, window_tokens: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Cuts x (B, T, *) into chunks of window_tokens tokens, returns the padded (B, n, w, *) chunks 
+    and the (B, n, 3w, *) keys made of the previous, current and next chunk (zero padded at 
+    the borders). 
+    """
+    B, T = x.shape[:2]
+    pad = (-T) % window_tokens
+    if pad > 0:
+        x = torch.cat([x, x.new_zeros(B, pad, *x.shape[2:])], dim=1)
+    n = x.shape[1] // window_tokens
+    chunks = x.view(B, n, window_tokens, *x.shape[2:])
+    empty = torch.zeros_like(chunks[:, :1])
+    prev = torch.cat([empty, chunks[:, :-1]], dim=1)
+    following = torch.cat([chunks[:, 1:], empty], dim=1)
+    return chunks, torch.cat([prev, chunks, following], dim=2)
+
+
+def window_energy_score(
+    metric: torch.Tensor,
+    win_ids: torch.Tensor,
+    window_tokens: int,
+    margin:torch.Tensor=0.5,
+    alpha=1.0,
+) -> torch.Tensor:
+    """
+    Energy score of pitome_vision where every token only sees the tokens of its own window.
+    Tokens are sorted by window id, so a window of at most window_tokens tokens spans at most 
+    two consecutive chunks and the band of the previous, current and next chunk covers it:
+    O(T * window_tokens * C) instead of O(T^2 * C).
+    """
+    B,T,C = metric.shape
+    order = win_ids.argsort(dim=-1)
+    sorted_metric = metric.gather(dim=-2, index=order.unsqueeze(-1).expand(B, T, C))
+    # padded tokens get the id -1 that no real window has
+    sorted_ids = win_ids.gather(dim=-1, index=order)
+    q, k = window_band(sorted_metric, window_tokens)
+    q_ids, k_ids = window_band(sorted_ids + 1, window_tokens)
+    same = (q_ids[..., :, None] == k_ids[..., None, :]) & (q_ids[..., :, None] > 0)
+    sim = F.elu((q@k.transpose(-1,-2) - margin)/0.01, alpha=alpha) * same
+    energy_sorted = (sim.sum(dim=-1) / same.sum(dim=-1).clamp(min=1)).view(B, -1)[:, :T]
+    energy_score = torch.empty_like(energy_sorted)
+    energy_score.scatter_(dim=-1, index=order, src=energy_sorted)
+    return energy_score
+
+
+def window_match(
+    metric: torch.Tensor,
+    win_ids: torch.Tensor,
+    src_idx: torch.Tensor,
+    keep_idx: torch.Tensor,
+    window_tokens: int,
+    margin:torch.Tensor=0.5,
+    alpha=1.0,
+) -> torch.Tensor:
+    """
+    Picks dst for every src token among the window_tokens kept tokens that follow it in window 
+    order, which are all the kept tokens of its window. Kept tokens of other windows are only 
+    used when every token of the window is merged away. Returns dst_idx into keep_idx.
+    """
+    B,_,C = metric.shape
+    r, t_keep = src_idx.shape[-1], keep_idx.shape[-1]
+    k = min(window_tokens, t_keep)
+    ids_keep, order_keep = win_ids.gather(dim=-1, index=keep_idx).sort(dim=-1)
+    ids_src = win_ids.gather(dim=-1, index=src_idx)
+    start = torch.searchsorted(ids_keep, ids_src.contiguous()).clamp(max=t_keep - k)
+    pos = (start.unsqueeze(-1) + torch.arange(k, device=metric.device)).view(B, -1)
+    cand = order_keep.gather(dim=-1, index=pos)
+    src = metric.gather(dim=-2, index=src_idx.unsqueeze(-1).expand(B, r, C))
+    keep = metric.gather(dim=-2, index=keep_idx.gather(dim=-1, index=cand).unsqueeze(-1).expand(B, r*k, C))
+    scores = F.elu(((src.unsqueeze(-2) * keep.view(B, r, k, C)).sum(dim=-1) - margin)/0.01, alpha=alpha)
+    same = ids_keep.gather(dim=-1, index=pos).view(B, r, k) == ids_src.unsqueeze(-1)
+    # elu is bounded by 2/0.01, so any same window candidate wins over the other windows
+    scores = scores - 1e3 * (~same)
+    best = scores.argmax(dim=-1, keepdim=True)
+    return cand.view(B, r, k).gather(dim=-1, index=best).squeeze(-1)
+
+
+def pitome_window(
+    metric: torch.Tensor, 
+    pos: torch.Tensor,
+    ratio:float=1.0,
+    margin:torch.Tensor=0.5,
+    window_size:int=7,
+    shift:bool=False,
+    prefix_tokens: int = 0,
+    alpha=1.0,
+    return_plan:bool=False,
+    r:int=None,
+):
+    """
+    Windowed pitome_vision for high resolution patch grids: the energy score and the matching 
+    are computed within window_size x window_size windows of the patch grid, so the cost is 
+    O(T * window_size^2 * C) instead of O(T^2 * C). 
+    pos: (B, T, 2) grid position of every token (see grid_positions), including the 
+    prefix_tokens prefix tokens (class / distill token), which are kept as they are.
+    The src tokens are chosen from the energy ranking as in pitome_vision, but since a small 
+    window rarely holds a token of the global b set, they are merged into the most similar 
+    kept token (protected or b) of their window. The number of merged tokens and the output 
+    layout [prefix, protected, b] are the same as pitome_vision.
+    """
+    P = prefix_tokens
+    with torch.no_grad():
+        metric=metric[:,P:,:]
+        pos=pos[:,P:,:]
+        B,T,C = metric.shape
+        if r is None:
+            if ratio >= 1.0:
+                return do_nothing, do_nothing
+            r = math.floor(T- T*ratio)
+
+        metric = F.normalize(metric, p=2, dim=-1) 
+        win_ids = window_ids(pos, window_size, shift=shift)
+        window_tokens = window_size * window_size
+        energy_score = window_energy_score(metric, win_ids, window_tokens, margin=margin, alpha=alpha)
+        indices =  torch.argsort(energy_score, descending=True)
+        merge_idx = indices[..., :2*r]
+        protected_idx = indices[..., 2*r:]
+        a_idx, b_idx = merge_idx[..., ::2], merge_idx[..., 1::2] 
+        keep_idx = torch.cat([protected_idx, b_idx], dim=-1)
+        dst_idx = window_match(metric, win_ids, a_idx, keep_idx, window_tokens, margin=margin, alpha=alpha)
+
+    if return_plan:
+        prefix = torch.arange(P, device=keep_idx.device)[None, :].expand(B, P)
+        keep = torch.cat([prefix, keep_idx + P], dim=-1)
+        return MergePlan.from_indices(keep, a_idx + P, dst_idx + P, T + P)
+    
+    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
+        x_prefix=x[:,:P,:]
+        x=x[:,P:,:]
+
+        B, T, C = x.shape
+        batch_idx = torch.arange(B).unsqueeze_(1).to(metric.device)
+        src, dst = x[batch_idx, a_idx, :], x[batch_idx, keep_idx, :]
+
+        dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(2).expand(B, r, C), src, reduce=mode)
+
+        return torch.cat([x_prefix, dst], dim=1)
+
+    return merge
+
+
+def merge_positions(
+    plan: MergePlan, pos: torch.Tensor, size: torch.Tensor = None
+) -> torch.Tensor:
+    """
+    Moves the (B, T, 2) grid positions through a merge: merged tokens sit at the size weighted 
+    centroid of their group.
+    """
+    if size is None:
+        size = torch.ones_like(pos[..., 0, None])
+    pos = plan.merge(torch.cat([pos * size, size], dim=-1), mode="sum")
+    return pos[..., :2] / pos[..., 2:]
+
+
+def init_stream(temporal_window:int=2, threshold:float=0.9) -> dict:
+    """
+    State of a frame stream for temporal_merge, stored in info["stream"].
+    """
+    return {
+        "memory": None,
+        "temporal_window": temporal_window,
+        "threshold": threshold,
+        "num_tokens": [],
+    }
+
+
+def memory_groups(metric: torch.Tensor, threshold: float) -> torch.Tensor:
+    """
+    Groups the (B, M, C) l2 normalized memory tokens of a stream: every token whose most 
+    similar other token is above threshold joins the group of the lower of the two indices, 
+    the others are groups of their own. Returns the (B, M) group ids in [0, M).
+    """
+    M = metric.shape[1]
+    sim = metric@metric.transpose(-1,-2)
+    sim.diagonal(dim1=-2, dim2=-1).fill_(-2.0)
+    best, nearest = sim.max(dim=-1)
+    arange = torch.arange(M, device=metric.device)[None, :]
+    return torch.where(best > threshold, torch.minimum(arange, nearest), arange)
+
+
+def temporal_merge(
+    info: dict, x: torch.Tensor, metric: torch.Tensor
+) -> torch.Tensor:
+    """
+    Merges the patch tokens of the current frame across time, before the first block.
+    x: (B, P + N, C) tokens of the frame with P prefix (class / distill) tokens, metric: (B, N, C)
+    patch embeddings without the position embedding.
+
+    Every patch token is matched with the most similar token carried over from the previous 
+    frame (info["stream"]["memory"]). Tokens above the similarity threshold are static; the 
+    static tokens matched with the same group of memory tokens (see memory_groups) are merged 
+    together, so the per frame token count shrinks as a static scene goes on and the memory 
+    tokens get coarser. The same number of tokens is merged in every sample (the batch 
+    minimum). Static tokens are then averaged with their memory token, whose weight, the size 
+    it accumulated over the previous frames, is capped at temporal_window - 1 frames. 
+    Sets info["size"] (and info["source"], info["pos"]) and returns the merged x.
+    """
+    stream = info["stream"]
+    memory = stream["memory"]
+    B, N, C = metric.shape
+    P = x.shape[1] - N
+    with torch.no_grad():
+        metric = F.normalize(metric, p=2, dim=-1)
+        if memory is None:
+            stream["memory"] = {
+                "x": x[:, P:], "metric": metric, "weight": torch.ones_like(x[..., P:, :1]),
+                "group": memory_groups(metric, stream["threshold"]),
+            }
+            stream["num_tokens"].append(x.shape[1])
+            return x
+
+        M = memory["metric"].shape[1]
+        best, slot = (metric@memory["metric"].transpose(-1,-2)).max(dim=-1)
+        static = best > stream["threshold"]
+        arange = torch.arange(N, device=x.device)[None, :].expand(B, N)
+        # static tokens are grouped by the group of their memory slot, the others are groups of 
+        # their own
+        group = torch.where(static, memory["group"].gather(1, slot), M + arange)
+        # the most similar token of each group is kept, the other static ones are merged into it
+        order = best.argsort(dim=-1, descending=True)
+        rank = torch.empty_like(order).scatter_(1, order, arange)
+        first = rank.new_full((B, M + N), N).scatter_reduce(1, group, rank, reduce="amin")
+        rep = rank == first.gather(1, group)
+        candidate = static & ~rep
+        r = int(candidate.sum(dim=-1).min())
+
+        src_idx = torch.where(candidate, best, best.new_tensor(-2.0)).topk(r, dim=-1).indices
+        removed = torch.zeros_like(static).scatter_(1, src_idx, True)
+        keep_idx = (arange + N * removed).argsort(dim=-1)[:, :N - r]
+        # non representative tokens are written to a spare last column
+        rep_token = arange.new_zeros(B, M + N + 1).scatter_(1, torch.where(rep, group, M + N), arange)
+        position = torch.empty_like(arange).scatter_(1, keep_idx, arange[:, :N - r])
+        dst_pos = position.gather(1, rep_token.gather(1, group.gather(1, src_idx)))
+
+        prefix = torch.arange(P, device=x.device)[None, :].expand(B, P)
+        plan = MergePlan.from_indices(
+            torch.cat([prefix, keep_idx + P], dim=-1), src_idx + P, dst_pos + P, P + N
+        )
+
+    x, size, source = plan.merge_wavg(x, None, None, trace_source=info["trace_source"])
+    info["size"], info["source"] = size, source
+    if info.get("pos") is not None:
+        info["pos"] = merge_positions(plan, info["pos"])
+
+    # blend the static tokens with their memory token over the temporal window
+    size_p = size[:, P:]
+    keep_slot = slot.gather(1, keep_idx)
+    weight = memory["weight"].gather(1, keep_slot[..., None]) * static.gather(1, keep_idx)[..., None]
+    weight = torch.minimum(weight, (stream["temporal_window"] - 1) * size_p)
+    history = memory["x"].gather(1, keep_slot[..., None].expand(-1, -1, x.shape[-1]))
+    x_p = (x[:, P:] * size_p + history * weight) / (size_p + weight)
+    x = torch.cat([x[:, :P], x_p], dim=1)
+
+    metric = F.normalize(plan.merge(torch.cat([metric.new_zeros(B, P, C), metric], dim=1), mode="mean")[:, P:], p=2, dim=-1)
+    stream["memory"] = {
+        "x": x_p, "metric": metric, "weight": size_p + weight,
+        "group": memory_groups(metric, stream["threshold"]),
+    }
+    stream["num_tokens"].append(x.shape[1])
+    return x
+
+
+EXACT = 'exact'
+PROJECTION = 'projection'
+LSH = 'lsh'
+
+
+@lru_cache(maxsize=32)
+def random_matrix(in_dim: int, out_dim: int, seed: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Fixed gaussian (in_dim, out_dim) matrix, so every layer and every call sketches / hashes 
+    the tokens the same way.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(in_dim, out_dim, generator=generator).to(device=device, dtype=dtype)
+
+
+def random_projection(metric: torch.Tensor, proj_dim:int=16, seed:int=0) -> torch.Tensor:
+    """
+    Johnson-Lindenstrauss sketch of an l2 normalized metric, renormalized so that dot products 
+    are cosine similarities again.
+    """
+    proj = random_matrix(metric.shape[-1], proj_dim, seed, metric.device, metric.dtype)
+    return F.normalize(metric@proj, p=2, dim=-1)
+
+
+def simhash(metric: torch.Tensor, n_bits:int=8, seed:int=0) -> torch.Tensor:
+    """
+    Sign random projection hash of every token, returned as a (B, T) integer bucket code.
+    Tokens with a small angle between them share most of their bits.
+    """
+    planes = random_matrix(metric.shape[-1], n_bits, seed, metric.device, metric.dtype)
+    bits = (metric@planes > 0).long()
+    return (bits << torch.arange(n_bits, device=metric.device)).sum(dim=-1)
+
+
+def lsh_energy_score(
+    metric: torch.Tensor, codes: torch.Tensor, sigma: float, window:int=32, attention_mask: torch.Tensor=None
+) -> torch.Tensor:
+    """
+    kNN-only version of the gaussian kernel energy of pitome_text. Tokens are sorted by their 
+    hash code and cut into chunks of `window` tokens; every token only sums the kernel over its 
+    own and the previous chunk, and the far away tokens (whose kernel is close to 0) are skipped.
+    attention_mask: (B, T) 1 for real tokens, the pads are left out of the energy and sorted 
+    last, so the chunks of the real tokens do not depend on the padding.
+    """
+    B,T,C = metric.shape
+    if attention_mask is not None:
+        codes = torch.where(attention_mask.bool(), codes, codes.max() + 1)
+    order = codes.argsort(dim=-1, stable=True)
+    sorted_metric = metric.gather(dim=-2, index=order.unsqueeze(-1).expand(B, T, C))
+    if attention_mask is not None:
+        valid = attention_mask.gather(dim=-1, index=order).to(metric.dtype)
+    else:
+        valid = torch.ones(B, T, device=metric.device, dtype=metric.dtype)
+    num_valid = valid.sum(dim=-1, keepdim=True).clamp(min=1)
+    pad = (-T) % window
+    if pad > 0:
+        sorted_metric = F.pad(sorted_metric, (0, 0, 0, pad))
+        valid = F.pad(valid, (0, pad))
+    n = (T + pad) // window
+    chunks = sorted_metric.view(B, n, window, C)
+    valid = valid.view(B, n, 1, window)
+    if n > 1:
+        # the first chunk has no previous one, its rolled in keys (the last chunk) are masked
+        prev_valid = valid.roll(1, dims=1)
+        prev_valid[:, 0] = 0
+        keys = torch.cat([chunks.roll(1, dims=1), chunks], dim=-2)
+        valid = torch.cat([prev_valid, valid], dim=-1)
+    else:
+        keys = chunks
+    sim = chunks@keys.transpose(-1,-2)
+    kernel = torch.exp(-(((1 - sim)/sigma)**2 * 0.5)) * valid
+    energy_sorted = kernel.sum(dim=-1).view(B, -1)[:, :T] / num_valid
+    energy_score = torch.empty_like(energy_sorted)
+    energy_score.scatter_(dim=-1, index=order, src=energy_sorted)
+    return energy_score * 1/(sigma*math.sqrt(2*math.pi))
+
+
+def lsh_match(
+    metric: torch.Tensor, codes: torch.Tensor, a_idx: torch.Tensor, b_idx: torch.Tensor, window:int=32,
+    attention_mask: torch.Tensor=None,
+) -> torch.Tensor:
+    """
+    Approximate bipartite candidate search: every token of a is only compared with the `window`
+    tokens of b that are closest to it in hash code order. Returns dst_idx into b.
+    attention_mask: (B, T) 1 for real tokens. The pads of b are sorted last, the real tokens of 
+    a are only matched with the real tokens of b and the pads of a with the pads of b (unless b 
+    has none of them left).
+    """
+    B,_,C = metric.shape
+    r_a, r_b = a_idx.shape[-1], b_idx.shape[-1]
+    k = min(window, r_b)
+    codes_b = codes.gather(dim=-1, index=b_idx)
+    codes_a = codes.gather(dim=-1, index=a_idx)
+    if attention_mask is not None:
+        valid_a = attention_mask.gather(dim=-1, index=a_idx).bool()
+        valid_b = attention_mask.gather(dim=-1, index=b_idx).bool()
+        pad_code = codes.max() + 1
+        codes_a = torch.where(valid_a, codes_a, pad_code)
+        codes_b = torch.where(valid_b, codes_b, pad_code)
+        # windows of the real b tokens only, as far as there are k of them
+        max_start = torch.where(valid_a, (valid_b.sum(dim=-1, keepdim=True) - k).clamp(min=0), r_b - k)
+    else:
+        max_start = r_b - k
+    codes_b, order_b = codes_b.sort(dim=-1)
+    pos = torch.searchsorted(codes_b, codes_a.contiguous())
+    start = torch.minimum((pos - k//2).clamp(min=0), torch.as_tensor(max_start, device=pos.device))
+    cand = order_b.gather(dim=-1, index=(start.unsqueeze(-1) + torch.arange(k, device=metric.device)).view(B, -1))
+    a = metric.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r_a, C))
+    b = metric.gather(dim=-2, index=b_idx.unsqueeze(-1).expand(B, r_b, C))
+    b = b.gather(dim=-2, index=cand.unsqueeze(-1).expand(B, r_a*k, C)).view(B, r_a, k, C)
+    scores = (a.unsqueeze(-2) * b).sum(dim=-1)
+    if attention_mask is not None:
+        same = valid_b.gather(dim=-1, index=cand).view(B, r_a, k) == valid_a.unsqueeze(-1)
+        scores = scores.masked_fill(~same, -math.inf)
+    best = scores.argmax(dim=-1, keepdim=True)
+    return cand.view(B, r_a, k).gather(dim=-1, index=best).squeeze(-1)
+
+
+def padded_ranking(energy_score: torch.Tensor, attention_mask: torch.Tensor, r: int) -> torch.Tensor:
+    """
+    The energy ranking of pitome_text for a padded batch: indices[:, :r] are merged into 
+    indices[:, r:2r] and the rest is protected. Every sample merges r_i = min(r, n_i // 2) of 
+    its n_i real tokens, by energy as usual, and fills the remaining r - r_i merges with pads, 
+    so that the real tokens are matched among themselves and the pads among themselves. 
+    """
+    B, T = energy_score.shape
+    n = attention_mask.sum(dim=-1, keepdim=True)
+    r_real = torch.clamp(n // 2, max=r)
+    r_pad = r - r_real
+    # real tokens rank first, then the pads
+    order = energy_score.masked_fill(attention_mask == 0, -math.inf).argsort(dim=-1, descending=True)
+    rank = torch.empty_like(order).scatter_(-1, order, torch.arange(T, device=order.device).expand(B, T))
+    pad_rank = rank - n
+    # slots: [real a, pad a | real b, pad b | protected real, remaining pads]
+    slot = torch.where(
+        attention_mask.bool(),
+        torch.where(rank < r_real, rank, torch.where(rank < 2 * r_real, rank - r_real + r, rank + 2 * r_pad)),
+        torch.where(pad_rank < r_pad, pad_rank + r_real, torch.where(pad_rank < 2 * r_pad, pad_rank + 2 * r_real, rank)),
+    )
+    return slot.argsort(dim=-1)
+
+
 def pitome_text(
     metric: torch.Tensor, 
     ratio:float=1.0,
     margin:torch.Tensor=0.5,
     class_token: bool = False,
+    return_plan:bool=False,
+    backend:str=EXACT,
+    proj_dim:int=16,
+    n_bits:int=8,
+    window:int=32,
+    r:int=None,
+    attention_mask:torch.Tensor=None,
 ):
+    """
+    r: a fixed number of tokens to merge, overrides ratio (static shape / torch.compile mode).
+    attention_mask: (B, T) 1 for real tokens and 0 for padding (class token included). Pads are 
+    left out of the energy, ranked last so they stay protected, and never used as dst of a real 
+    token. See pitome_text_varlen to drop the pads instead.
+    backend selects how the energy score and the bipartite candidates are computed:
+     - exact: all T x T gaussian kernel similarities, O(T^2 C).
+     - projection: the exact algorithm on a random projection of metric to proj_dim dimensions,
+       O(T^2 proj_dim). Cosine similarities are preserved up to O(1/sqrt(proj_dim)), so the 
+       ranking only changes between tokens of near identical energy. 
+     - lsh: tokens are bucketed by an n_bits simhash. The energy only sums the kernel over the 
+       2*window tokens nearest in bucket order, and every src token only looks for its dst 
+       among the window nearest b tokens, O(T window C). Tokens that are similar but land in 
+       far apart buckets are missed, so isolated tokens can be under-estimated; use it for long 
+       sequences (T >> window) where exact is too expensive.
+    """
     with torch.no_grad():
         if class_token:
             metric=metric[:,1:,:]
@@ -150,22 +780,47 @@ def pitome_text(
         if len(metric.shape) == 2:
             metric = metric[None,...]
         B,T,C = metric.shape
-        r = math.floor(T- T*ratio)
+        if r is None:
+            r = math.floor(T- T*ratio)
         metric = F.normalize(metric, p=2, dim=-1) 
+        if backend == PROJECTION:
+            metric = random_projection(metric, proj_dim=proj_dim)
         batch_idx = torch.arange(B).unsqueeze_(1).to(metric.device)
-        # calculate energy score for in this implementation we use gaussian kernel which show better performance than the equation (4) in the paper 
-        sim = metric@metric.transpose(-1,-2)
-        # sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01, alpha=alpha)
         sigma = 1 - margin 
-        energy_score = (torch.exp(-(((1 - sim)/sigma)**2 * 0.5))).mean(-1) *  1/(sigma*torch.sqrt(torch.tensor(2*torch.pi))) 
-        indices =  torch.argsort(energy_score , descending=True)
+        mask = attention_mask[:, -T:] if attention_mask is not None else None
+        if backend == LSH:
+            codes = simhash(metric, n_bits=n_bits)
+            energy_score = lsh_energy_score(metric, codes, sigma, window=window, attention_mask=mask)
+        else:
+            # calculate energy score for in this implementation we use gaussian kernel which show better performance than the equation (4) in the paper 
+            sim = metric@metric.transpose(-1,-2)
+            # sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01, alpha=alpha)
+            kernel = torch.exp(-(((1 - sim)/sigma)**2 * 0.5))
+            if attention_mask is not None:
+                valid = attention_mask[:, -T:, None].transpose(-1,-2).to(kernel.dtype)
+                energy_score = (kernel*valid).sum(-1) / valid.sum(-1).clamp(min=1)
+                # real tokens only merge into real tokens and pads into pads
+                sim = sim.masked_fill(valid != valid.transpose(-1,-2), -math.inf)
+            else:
+                energy_score = kernel.mean(-1)
+            energy_score = energy_score *  1/(sigma*torch.sqrt(torch.tensor(2*torch.pi))) 
+        if attention_mask is not None:
+            indices = padded_ranking(energy_score, mask, r)
+        else:
+            indices =  torch.argsort(energy_score , descending=True)
         merge_idx = indices[..., :2*r]
         protected_idx = indices[..., 2*r:]
         # Also instead of using odd and even indices since we choose to split based on higher and lower energy set which show significant better performance 
         a_idx, b_idx = merge_idx[..., :r], merge_idx[..., r:]
-        scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
-        scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
-        _, dst_idx = scores.max(dim=-1) 
+        if backend == LSH:
+            dst_idx = lsh_match(metric, codes, a_idx, b_idx, window=window, attention_mask=mask)
+        else:
+            scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
+            scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
+            _, dst_idx = scores.max(dim=-1) 
+
+    if return_plan:
+        return pitome_plan(protected_idx, a_idx, b_idx, dst_idx, class_token=class_token)
 
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         if class_token:
@@ -186,6 +841,127 @@ def pitome_text(
     return merge
 
 
+def pack_tokens(x: torch.Tensor, attention_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Drops the padding of a (B, T, C) batch: returns the (1, N, C) real tokens of all the samples 
+    one after the other and the (B + 1,) cu_seqlens offsets of every sample.
+    """
+    lengths = attention_mask.sum(dim=-1)
+    cu_seqlens = F.pad(lengths.cumsum(dim=0), (1, 0)).to(torch.int32)
+    return x[attention_mask.bool()][None, ...], cu_seqlens
+
+
+def unpack_tokens(
+    x: torch.Tensor, cu_seqlens: torch.Tensor, pad_value=0.0, attention_mask: torch.Tensor = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Inverse of pack_tokens: pads the (1, N, C) packed tokens to the longest sample.
+    Returns the (B, T, C) batch and its (B, T) attention mask. Pass the attention_mask of the 
+    padded layout when it is known already, to skip the host sync on the longest length.
+    """
+    if attention_mask is None:
+        lengths = (cu_seqlens[1:] - cu_seqlens[:-1]).long()
+        B, T = lengths.shape[0], int(lengths.max())
+        attention_mask = (torch.arange(T, device=x.device)[None, :] < lengths[:, None]).long()
+    B, T = attention_mask.shape
+    out = x.new_full((B, T, x.shape[-1]), pad_value)
+    out[attention_mask.bool()] = x[0]
+    return out, attention_mask
+
+
+def varlen_mask(cu_seqlens: torch.Tensor) -> torch.Tensor:
+    """
+    (B, T) attention mask of the padded layout of packed sequences, T the longest sequence.
+    """
+    lengths = (cu_seqlens[1:] - cu_seqlens[:-1]).long()
+    T = int(lengths.max())
+    return (torch.arange(T, device=cu_seqlens.device)[None, :] < lengths[:, None]).long()
+
+
+def pitome_text_varlen(
+    metric: torch.Tensor,
+    cu_seqlens: torch.Tensor,
+    r:Union[int, List[int]],
+    margin:torch.Tensor=0.5,
+    class_token: bool = False,
+    tokens: List[int] = None,
+    backend:str=EXACT,
+    proj_dim:int=16,
+    n_bits:int=8,
+    window:int=32,
+) -> Tuple[MergePlan, torch.Tensor]:
+    """
+    pitome_text over packed sequences (see pack_tokens): every sequence only merges its own real
+    tokens. r is the number of tokens merged in the longest sequence, shorter sequences merge 
+    proportionally fewer. For per-sample ratios r is a list with one r per sequence and tokens 
+    the number of tokens each r is meant for (the longest sequence by default).
+    All the sequences are matched in one batched call: the similarities are only taken within 
+    every sequence (the block diagonal of the packed similarity matrix), on the padded (B, T, C) 
+    layout with the pads masked out of the energy and of the matching. Within every sequence the 
+    plan has the [cls, protected, dst] layout of pitome_text.
+    Returns the MergePlan of the packed tokens and the new cu_seqlens.
+    """
+    offset = int(class_token)
+    lengths = (cu_seqlens[1:] - cu_seqlens[:-1]).long()
+    mask = varlen_mask(cu_seqlens)
+    B, T_in = mask.shape
+    device = metric.device
+    n = (lengths - offset)[:, None]
+    rs = torch.as_tensor(r if isinstance(r, (list, tuple)) else [r] * B, device=device)[:, None]
+    tokens = torch.as_tensor([T_in] * B if tokens is None else tokens, device=device)[:, None]
+    r = torch.minimum(rs * n // (tokens - offset).clamp(min=1), n // 2).clamp(min=0)
+    R = int(r.max())
+    if R == 0:
+        return MergePlan(torch.arange(metric.shape[1], device=device)[None, :], metric.shape[1]), cu_seqlens
+
+    with torch.no_grad():
+        metric = unpack_tokens(metric, cu_seqlens, attention_mask=mask)[0][:, offset:]
+        # one extra pad token that the unused b slots of the sequences with r < R point to
+        metric = F.pad(metric, (0, 0, 0, 1))
+        valid = F.pad(mask[:, offset:], (0, 1))
+        B, T, C = metric.shape
+        metric = F.normalize(metric, p=2, dim=-1)
+        if backend == PROJECTION:
+            metric = random_projection(metric, proj_dim=proj_dim)
+        sigma = 1 - margin
+        if backend == LSH:
+            codes = simhash(metric, n_bits=n_bits)
+            energy_score = lsh_energy_score(metric, codes, sigma, window=window, attention_mask=valid)
+        else:
+            sim = metric@metric.transpose(-1,-2)
+            kernel = torch.exp(-(((1 - sim)/sigma)**2 * 0.5))
+            keys = valid[:, None, :].to(kernel.dtype)
+            energy_score = (kernel*keys).sum(-1) / keys.sum(-1).clamp(min=1)
+            energy_score = energy_score * 1/(sigma*math.sqrt(2*math.pi))
+        energy_score = energy_score.masked_fill(valid == 0, -math.inf)
+        indices = torch.argsort(energy_score, descending=True)
+
+        # slot j < r of every sequence is a merged (a) token, the b tokens are the next r ranks
+        slots = torch.arange(R, device=device)[None, :]
+        merged = slots < r
+        a_idx = indices[:, :R]
+        b_idx = indices.gather(dim=-1, index=(r + slots).clamp(max=T - 1))
+        b_idx = torch.where(merged, b_idx, T - 1)
+        if backend == LSH:
+            dst_idx = lsh_match(metric, codes, a_idx, b_idx, window=window, attention_mask=valid)
+        else:
+            scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, R))
+            scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, R, R))
+            dst_idx = scores.masked_fill(~merged.unsqueeze(-2), -math.inf).argmax(dim=-1)
+
+        # output position of every token: protected (rank >= 2r) first, then b, a into its dst
+        rank = torch.empty_like(indices).scatter_(-1, indices, torch.arange(T, device=device).expand(B, T))
+        pos = torch.where(rank >= 2 * r, rank - 2 * r, n - 3 * r + rank)
+        pos = pos.scatter(-1, a_idx, torch.where(merged, n - 2 * r + dst_idx, pos.gather(-1, a_idx)))
+        group_idx = pos[:, :-1] + offset
+        if class_token:
+            group_idx = torch.cat([group_idx.new_zeros(B, 1), group_idx], dim=-1)
+
+    new_cu_seqlens = F.pad((lengths - r[:, 0]).cumsum(dim=0), (1, 0)).to(torch.int32)
+    group_idx = (group_idx + new_cu_seqlens[:-1, None])[mask.bool()]
+    return MergePlan(group_idx[None, :], int(new_cu_seqlens[-1])), new_cu_seqlens
+
+
 def merge_mean(
     merge: Callable, x: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -230,7 +1006,14 @@ def merge_source(
     """
     For source tracking. Source is an adjacency matrix between the initial tokens and final merged groups.
     x is used to find out how many tokens there are in case the source is None.
+    When merge is a MergePlan the source is kept as a compact TokenSource (see to_dense()).
     """
+    if isinstance(merge, MergePlan) and not isinstance(source, torch.Tensor):
+        if source is None:
+            source = TokenSource.identity(x.shape[0], x.shape[1], device=x.device)
+        return source.merge(merge)
+    if isinstance(source, TokenSource):
+        source = source.to_dense(x.dtype)
     if source is None:
         n, t, _ = x.shape
         source = torch.eye(t, device=x.device)[None, ...].expand(n, t, t)
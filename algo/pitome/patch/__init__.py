@@ -9,5 +9,6 @@ from .blip import apply_patch as blip
 from .blip2 import apply_patch as blip2
 from .clip import apply_patch as clip 
 from .clip_hf import apply_patch as clip_hf 
+from .unmerge import apply_patch as unmerge
 
-__all__ = ["deit", "swag", "mae", "aug", "bert", "distilbert",  "blip", "blip2", "clip", "clip_hf" ]
+__all__ = ["deit", "swag", "mae", "aug", "bert", "distilbert",  "blip", "blip2", "clip", "clip_hf", "unmerge" ]
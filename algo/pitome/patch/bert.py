@@ -13,7 +13,8 @@ import torch
 import torch.nn as nn
 from typing import Tuple
 from transformers.models.bert.modeling_bert import BertLayer, BertEncoder, BertSelfAttention, BertAttention, apply_chunking_to_forward
-from ..merge import merge_source, pitome_text, merge_mean, merge_wavg, merge_attention_mask
+from ..merge import merge_source, pitome_text, merge_mean, merge_wavg, merge_attention_mask, pitome_text_varlen, pack_tokens, unpack_tokens, varlen_mask
+from ..utils import schedule_for, ragged_for
 from transformers.modeling_utils import ModuleUtilsMixin 
 from typing import Optional, Union 
 import math
@@ -37,26 +38,46 @@ class PiToMeBertLayer(BertLayer):
             head_mask,
             output_attentions=output_attentions,
         )
-        ratio = self._info["ratio"].pop()
+        r = self._info["schedule"].r[self._layer]
+        ragged = self._info["ragged"]
+        if ragged is not None:
+            # one r per sample, merged on the packed real tokens of every sample
+            rs = ragged.expand(lambda group: group["schedule"].r[self._layer])
+            tokens = ragged.expand(lambda group: group["schedule"].tokens[self._layer])
+            r = max(rs)
         x = self_attention_outputs[0]
         key = self_attention_outputs[1]
         attn = self_attention_outputs[2]
 
     
-        if ratio < 1.0:
+        attention_mask = torch.where(attention_mask.squeeze(-2).squeeze(-2) >= 0, 1, 0)
+        if r > 0 and self._info["cu_seqlens"] is not None:
+            # x and key are packed (see pack_tokens): every sample merges its own real tokens
+            plan, self._info["cu_seqlens"] = pitome_text_varlen(
+                key, self._info["cu_seqlens"],
+                r=r if ragged is None else rs,
+                tokens=None if ragged is None else tokens,
+                margin=self.margin,
+                class_token=self._info["class_token"],
+                backend=self._info["backend"],
+                **self._info["backend_kwargs"],
+            )
+            x, self._info["size"], _ = plan.merge_wavg(x)
+            attention_mask = varlen_mask(self._info["cu_seqlens"])
+        elif r > 0:
             merge = pitome_text(
-                ratio=ratio,
+                r=r,
                 metric=key,
                 margin=self.margin,
                 class_token=self._info["class_token"],
+                backend=self._info["backend"],
+                attention_mask=attention_mask,
+                **self._info["backend_kwargs"],
             )
 
             x, self._info["size"] = merge_wavg(merge, x, None)
             B, T, _ = x.shape
-            attention_mask = torch.where(attention_mask.squeeze_(-2).squeeze_(-2) >= 0, 1, 0)
             attention_mask = merge_attention_mask(merge, attention_mask=attention_mask[..., None]).view(B, T)
-        else:
-            attention_mask = torch.where(attention_mask.squeeze_(-2).squeeze_(-2) >= 0, 1, 0)
 
         x = apply_chunking_to_forward(
             self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, x
@@ -98,6 +119,8 @@ class PiToMeBertAttention(BertAttention):
         return outputs
 
 class PiToMeBertSelfAttention(BertSelfAttention):
+   # fused scaled_dot_product_attention unless attention probabilities are requested
+   fused_attn = hasattr(nn.functional, "scaled_dot_product_attention")
 
    def forward(
         self,
@@ -110,12 +133,33 @@ class PiToMeBertSelfAttention(BertSelfAttention):
         output_attentions: Optional[bool] = False,
     ) -> Tuple[torch.Tensor]:
         mixed_query_layer = self.query(hidden_states)
+        mixed_key_layer = self.key(hidden_states)
+        mixed_value_layer = self.value(hidden_states)
+        packed = self._info["cu_seqlens"] is not None
+        if packed:
+            # the projections run on the packed real tokens, only the attention itself is padded
+            mask = torch.where(attention_mask.squeeze(-2).squeeze(-2) >= 0, 1, 0)
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = (
+                unpack_tokens(t, None, attention_mask=mask)[0]
+                for t in (mixed_query_layer, mixed_key_layer, mixed_value_layer)
+            )
 
-      
-        key_layer = self.transpose_for_scores(self.key(hidden_states))
-        value_layer = self.transpose_for_scores(self.value(hidden_states))
+        key_layer = self.transpose_for_scores(mixed_key_layer)
+        value_layer = self.transpose_for_scores(mixed_value_layer)
         query_layer = self.transpose_for_scores(mixed_query_layer)
 
+        if self.fused_attn and not output_attentions and self.position_embedding_type == "absolute":
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask.to(query_layer.dtype) if attention_mask is not None else None,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            context_layer = context_layer.view(new_context_layer_shape)
+            if packed:
+                return (pack_tokens(context_layer, mask)[0],), pack_tokens(key_layer.sum(1), mask)[0], None
+            return (context_layer,), key_layer.sum(1), None
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
@@ -156,11 +200,14 @@ class PiToMeBertSelfAttention(BertSelfAttention):
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(new_context_layer_shape)
 
+        key_layer = key_layer.sum(1)
+        if packed:
+            context_layer, key_layer = pack_tokens(context_layer, mask)[0], pack_tokens(key_layer, mask)[0]
         outputs = (context_layer, attention_probs) if output_attentions else (context_layer,)
         
 
     
-        return outputs, key_layer.sum(1), attention_probs
+        return outputs, key_layer, attention_probs
 
 
 def make_pitome_class(transformer_class):
@@ -183,22 +230,21 @@ def make_pitome_class(transformer_class):
             output_attentions: Optional[bool] = False,
             output_hidden_states: Optional[bool] = False,
         ): 
-            len_layers = len(self.layer)
-            # self._info["ratio"] = [self.ratio if i in [len_layers-1,len_layers-6] else 1.0 for i in range(len_layers) ]
-            # self._info["ratio"] = [self.ratio for _ in range(len_layers) ]
-            self._info["ratio"] = [self.ratio if i in [
-                len_layers - 1, 
-                len_layers - 2,
-                len_layers - 3,
-                # len_layers - 9,
-            ] else 1.0 for i in range(len_layers) ]
+            self._info["schedule"] = schedule_for(self, hidden_states.shape[1])
+            self._info["ragged"] = ragged_for(self, hidden_states.shape[1], device=hidden_states.device, batch_size=hidden_states.shape[0])
+            self._info["cu_seqlens"] = None
+            if self._info["varlen"] or self._info["ragged"] is not None:
+                # the real tokens stay packed from layer to layer, so the pads cost nothing
+                hidden_states, self._info["cu_seqlens"] = pack_tokens(
+                    hidden_states, torch.where(attention_mask.squeeze(-2).squeeze(-2) >= 0, 1, 0)
+                )
             all_hidden_states = () if output_hidden_states else None
             all_self_attentions = () if output_attentions else None
             flops = 0
 
             for i, layer_module in enumerate(self.layer):
                 if output_hidden_states:
-                    all_hidden_states = all_hidden_states + (hidden_states,)
+                    all_hidden_states = all_hidden_states + (self._unpack(hidden_states),)
 
    
                 layer_head_mask = head_mask[i] if head_mask is not None else None
@@ -209,18 +255,25 @@ def make_pitome_class(transformer_class):
                     layer_head_mask,
                     output_attentions,
                 )
-                B, T, _ = hidden_states.shape
+                B, T = layer_outputs[1].shape
 
                 hidden_states = layer_outputs[0]
                 attention_mask =   self.get_extended_attention_mask(
                     layer_outputs[1],
                     (B,T)
                 )
-                flops += self.calculate_block_flop(hidden_states.shape)
+                if self._info["cu_seqlens"] is None:
+                    flops += self.calculate_block_flop(hidden_states.shape)
+                else:
+                    # FLOPs per sample: every sample pays for its own real tokens
+                    lengths = layer_outputs[1].sum(dim=-1).tolist()
+                    flops += sum(self.calculate_block_flop((1, t, hidden_states.shape[-1])) for t in lengths) / B
 
                 if output_attentions:
                     all_self_attentions = all_self_attentions + (layer_outputs[2],)
 
+            hidden_states = self._unpack(hidden_states)
+            self._info["cu_seqlens"] = None
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
@@ -231,6 +284,12 @@ def make_pitome_class(transformer_class):
                 flops,
             )
     
+        def _unpack(self, hidden_states):
+            # packed hidden states are padded to the longest sample for the caller
+            if self._info["cu_seqlens"] is None:
+                return hidden_states
+            return unpack_tokens(hidden_states, self._info["cu_seqlens"])[0]
+
         def calculate_block_flop(self, shape):
             flops = 0
             _, N, C = shape
@@ -246,7 +305,8 @@ def make_pitome_class(transformer_class):
 
 
 def apply_patch(
-   model: BertEncoder, trace_source: bool = False, prop_attn: bool = True, margin=None, alpha=1.0, use_attn=False):
+   model: BertEncoder, trace_source: bool = False, prop_attn: bool = True, margin=None, alpha=1.0, use_attn=False,
+   backend="exact", proj_dim=16, n_bits=8, window=32, static_ratio=None, seq_len=None, varlen=False):
    
     PiToMeBertEncoder = make_pitome_class(model.__class__)
     print('using', 'pitome')
@@ -265,7 +325,16 @@ def apply_patch(
         "prop_attn": prop_attn,
         "class_token": True,
         "distill_token": False,
+        "backend": backend,
+        "backend_kwargs": {"proj_dim": proj_dim, "n_bits": n_bits, "window": window},
         "alpha": alpha,
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
+        "varlen": varlen,
+        "ragged": None,
+        "cu_seqlens": None,
     }
     current_layer = 0
     margin = margin 
@@ -275,15 +344,28 @@ def apply_patch(
     else:
         margins = [margin for i in range(num_layers)]
 
+    # ratio is applied to the first three layers
+    model._info["margins"] = margins
+    model._info["merge_layers"] = [0, 1, 2]
+    model.token_schedule = None
+    if static_ratio is not None:
+        # fix the schedule for inputs padded to seq_len, so that the patched forward has 
+        # static shapes
+        assert seq_len is not None, "static_ratio needs the padded input length seq_len"
+        model.ratio = static_ratio
+        model.token_schedule = schedule_for(model, seq_len)
+
 
     for module in model.modules():
         if isinstance(module, BertLayer):
             module.__class__ = PiToMeBertLayer
             module.init_margin(margins[current_layer])
             module._info = model._info
+            module._layer = current_layer
             current_layer +=1
         if isinstance(module, BertAttention):
             module.__class__ = PiToMeBertAttention 
         if isinstance(module, BertSelfAttention):
             module.__class__ = PiToMeBertSelfAttention 
+            module._info = model._info
 
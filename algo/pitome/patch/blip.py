@@ -1,6 +1,8 @@
 import torch
+import torch.nn.functional as F
 from lavis.models.vit import VisionTransformer, Attention, Block
 from ..merge import merge_source, pitome_vision, merge_wavg, prune
+from ..utils import schedule_for
 
 class PiToMeBlock(Block):
     """
@@ -13,13 +15,14 @@ class PiToMeBlock(Block):
         self.margin = margin
     
     def compress_x(self, metric, x):
-        ratio = self._info["ratio"].pop()
-        if ratio < 1.0:
+        r = self._info["schedule"].r[self._layer]
+        if r > 0:
             merge = pitome_vision(
-                ratio=ratio,
+                r=r,
                 metric=metric,
                 margin=self.margin,
                 class_token=self._info["class_token"],
+                return_plan=self._info["trace_source"],
             )
           
             if self._info["trace_source"]:
@@ -41,6 +44,11 @@ class PiToMeBlock(Block):
 
 
 class PiToMeAttention(Attention):
+    """
+    Modifications:
+     - Use the fused scaled_dot_product_attention kernel unless the attention map is saved
+    """
+    fused_attn = hasattr(F, "scaled_dot_product_attention")
 
     def forward_and_save_attn(self, x, register_hook=False):
         B, N, C = x.shape
@@ -55,6 +63,15 @@ class PiToMeAttention(Attention):
             qkv[2],
         )  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.fused_attn and not register_hook:
+            x = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0,
+            )
+            x = x.transpose(1, 2).reshape(B, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         attn = (q @ k.transpose(-2, -1)) * self.scale
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
@@ -76,7 +93,6 @@ def make_pitome_class(transformer_class):
         """
 
         def forward(self,x, register_blk=-1):
-            self._info["ratio"] =[1.0] + [self.ratio] * (len(self.blocks)-1)
             self._info["size"] = None
             self._info["source"] = None
             self._info["attn"] = []
@@ -94,6 +110,8 @@ def make_pitome_class(transformer_class):
             x = x + self.pos_embed[:, : x.size(1), :]
             x = self.pos_drop(x)
 
+            # every layer but the last one merges
+            self._info["schedule"] = schedule_for(self, x.shape[1], merge_layers=range(len(self.blocks) - 1))
             for i, blk in enumerate(self.blocks):
                 self.total_flop += self.calculate_block_flop(x.shape)
                 x = blk(x)
@@ -103,7 +121,6 @@ def make_pitome_class(transformer_class):
 
         def forward_features(self, x, register_blk=-1) -> torch.Tensor:
       
-            self._info["ratio"] = [self.ratio] * len(self.blocks) 
             self._info["size"] = None
             self._info["source"] = None
             self.total_flop = 0
@@ -120,6 +137,7 @@ def make_pitome_class(transformer_class):
             x = x + self.pos_embed[:, : x.size(1), :]
             x = self.pos_drop(x)
 
+            self._info["schedule"] = schedule_for(self, x.shape[1])
             for i, blk in enumerate(self.blocks):
                 self.total_flop += self.calculate_block_flop(x.shape)
                 x = blk(x) 
@@ -163,10 +181,16 @@ def apply_patch(
         "class_token": True,
         "distill_token": False,
         "alpha": alpha,
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
     }
     current_layer = 0
     num_layers = len(model.blocks)
     margins = [0.9 - 0.9*(i/num_layers) for i in range(num_layers)]
+    model._info["margins"] = margins
+    model.token_schedule = None
 
     if hasattr(model, "dist_token") and model.dist_token is not None:
         model._info["distill_token"] = True
@@ -176,6 +200,7 @@ def apply_patch(
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._info = model._info
+            module._layer = current_layer
             current_layer +=1
         elif isinstance(module, Attention):
             module.__class__ = PiToMeAttention
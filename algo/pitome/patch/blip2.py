@@ -3,6 +3,7 @@ import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from lavis.models.eva_vit import VisionTransformer, Block, Attention
 from ..merge import merge_source, pitome_vision, merge_wavg
+from ..utils import schedule_for
 
 class PiToMeBlock(Block):
     """
@@ -15,13 +16,14 @@ class PiToMeBlock(Block):
         self.margin = margin
     
     def compress_x(self, metric, x):
-        ratio = self._info["ratio"]
-        if ratio < 1.0:
+        r = self._info["schedule"].r[self._layer]
+        if r > 0:
             merge = pitome_vision(
-                ratio=ratio,
+                r=r,
                 metric=metric,
                 margin=self.margin,
-                class_token=self._info["class_token"]
+                class_token=self._info["class_token"],
+                return_plan=self._info["trace_source"],
             )
 
             if self._info["trace_source"]:
@@ -55,9 +57,18 @@ class PiToMeAttention(Attention):
     Modifications:
      - Apply proportional attention
      - Return the mean of k over heads from attention
+     - Use the fused scaled_dot_product_attention kernel unless the attention map is requested
     """
+    fused_attn = hasattr(F, "scaled_dot_product_attention")
 
-    def forward(self, x:torch.Tensor, isolation_score: torch.Tensor = None, rel_pos_bias=None):
+    def relative_bias(self):
+        relative_position_bias = \
+            self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+                self.window_size[0] * self.window_size[1] + 1,
+                self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def forward(self, x:torch.Tensor, isolation_score: torch.Tensor = None, rel_pos_bias=None, need_weights: bool = False):
         B, N, C = x.shape
         qkv_bias = None
         if self.q_bias is not None:
@@ -67,18 +78,32 @@ class PiToMeAttention(Attention):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
+        if self.fused_attn and not need_weights:
+            # every additive term is folded into a single float mask
+            bias = None
+            if isolation_score is not None:
+                bias = isolation_score.log()[:, None, None, :, 0].to(q.dtype)
+            if self.relative_position_bias_table is not None:
+                relative_position_bias = self.relative_bias().unsqueeze(0).to(q.dtype)
+                bias = relative_position_bias if bias is None else bias + relative_position_bias
+            if rel_pos_bias is not None:
+                bias = rel_pos_bias if bias is None else bias + rel_pos_bias
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=bias, scale=self.scale,
+                dropout_p=self.attn_drop.p if self.training else 0.0,
+            )
+            x = x.transpose(1, 2).reshape(B, N, -1)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, k.mean(1), None
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
         if isolation_score is not None:
             attn = attn +  isolation_score.log()[:, None, None, :, 0]
 
         if self.relative_position_bias_table is not None:
-            relative_position_bias = \
-                self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                    self.window_size[0] * self.window_size[1] + 1,
-                    self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-            attn = attn + relative_position_bias.unsqueeze(0)
+            attn = attn + self.relative_bias().unsqueeze(0)
 
         if rel_pos_bias is not None:
             attn = attn + rel_pos_bias
@@ -101,7 +126,6 @@ def make_pitome_class(transformer_class):
 
         def forward(self, x) -> torch.Tensor:
       
-            self._info["ratio"] = self.ratio
             self._info["size"] = None
             self._info["source"] = None
             self.total_flop = 0
@@ -121,6 +145,7 @@ def make_pitome_class(transformer_class):
             x = self.pos_drop(x)
 
             rel_pos_bias = self.rel_pos_bias() if self.rel_pos_bias is not None else None
+            self._info["schedule"] = schedule_for(self, x.shape[1])
             for blk in self.blocks:
                 if self.use_checkpoint:
                     x = checkpoint.checkpoint(blk, x, rel_pos_bias)
@@ -162,11 +187,17 @@ def apply_patch(
         "prop_attn": True,
         "class_token": True,
         "distill_token": False,
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
     }
     current_layer = 0
     margin = margin 
     num_layers = len(model.blocks)
     margins = [0.75 - 0.4*(i/num_layers) for i in range(num_layers)]
+    model._info["margins"] = margins
+    model.token_schedule = None
 
     if hasattr(model, "dist_token") and model.dist_token is not None:
         model._info["distill_token"] = True
@@ -177,6 +208,7 @@ def apply_patch(
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._info = model._info
+            module._layer = current_layer
             current_layer +=1
         elif isinstance(module, Attention):
             module.__class__ = PiToMeAttention
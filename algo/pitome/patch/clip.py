@@ -3,6 +3,7 @@ from typing import Optional, Callable
 import torch.nn as nn
 import torch
 from ..merge import merge_source, pitome_vision, merge_wavg
+from ..utils import schedule_for
 
 
 class PiToMeBlock(ResidualAttentionBlock):
@@ -11,14 +12,15 @@ class PiToMeBlock(ResidualAttentionBlock):
         self.margin = margin
 
     def compress_x(self, metric, x, attn):
-        ratio = self._info["ratio"].pop()
-        if ratio < 1.0:
+        r = self._info["schedule"].r[self._layer]
+        if r > 0:
             merge = pitome_vision(
-                ratio=ratio,
+                r=r,
                 metric=metric,
                 margin=self.margin,
                 # attn=attn if self.margin >= 0.45 else None,
-                class_token=self._info["class_token"]
+                class_token=self._info["class_token"],
+                return_plan=self._info["trace_source"],
             )
 
             if self._info["trace_source"]:
@@ -49,7 +51,8 @@ class PiToMeTransformer(Transformer):
 
 
     def forward(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
-        self._info["ratio"] = [self.ratio] * len(self.resblocks) 
+        # x is (N, B, C)
+        self._info["schedule"] = schedule_for(self, x.shape[0])
         self._info["size"] = None
         self._info["source"] = None
         self.total_flop = 0
@@ -87,12 +90,18 @@ def apply_patch(
         "prop_attn": prop_attn,
         "class_token": True,
         "distill_token": False,
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
     }
     current_layer = 0
     margin = margin 
     num_layers = len(model.resblocks)
     # margins = [margin - margin*(i/num_layers) for i in range(num_layers)]
     margins = [.95 - 0.95 *(i/num_layers) for i in range(num_layers)]
+    model._info["margins"] = margins
+    model.token_schedule = None
 
     if hasattr(model, "dist_token") and model.dist_token is not None:
         model._info["distill_token"] = True
@@ -103,6 +112,7 @@ def apply_patch(
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._info = model._info
+            module._layer = current_layer
             current_layer +=1
         # elif isinstance(module, Attention):
         #     module.__class__ = PiToMeAttention
@@ -1,5 +1,6 @@
-from transformers.models.clip.modeling_clip import CLIPEncoder, CLIPEncoderLayer 
-from ..merge import merge_source, pitome_vision, merge_mean 
+from transformers.models.clip.modeling_clip import CLIPAttention, CLIPEncoder, CLIPEncoderLayer 
+from ..merge import merge_source, pitome_vision, merge_mean, reuse_energy_score, merge_energy
+from ..utils import schedule_for
 from transformers.modeling_outputs import BaseModelOutput
 from typing import Optional, Tuple, Union
 import torch.nn as nn
@@ -7,6 +8,50 @@ import torch
 
 
 
+class PiToMeCLIPAttention(CLIPAttention):
+    """
+    Modifications:
+     - Return the key projection averaged over heads, the metric of metric="key".
+    """
+    def forward(self, hidden_states, attention_mask=None, causal_attention_mask=None, output_attentions=False):
+        bsz, tgt_len, embed_dim = hidden_states.size()
+        query_states = self._shape(self.q_proj(hidden_states) * self.scale, tgt_len, bsz)
+        key_states = self._shape(self.k_proj(hidden_states), tgt_len, bsz)
+        value_states = self._shape(self.v_proj(hidden_states), tgt_len, bsz)
+
+        attn_weights = query_states @ key_states.transpose(-1, -2)
+        # the masks are (B, 1, N, N) and broadcast over heads
+        if causal_attention_mask is not None:
+            attn_weights = attn_weights + causal_attention_mask
+        if attention_mask is not None:
+            attn_weights = attn_weights + attention_mask
+        attn_weights = attn_weights.softmax(dim=-1)
+        attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+
+        attn_output = (attn_probs @ value_states).transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+        attn_output = self.out_proj(attn_output)
+        return attn_output, attn_weights if output_attentions else None, key_states.mean(1)
+
+
+class PiToMeCLIPEncoderLayer(CLIPEncoderLayer):
+    """
+    Modifications:
+     - Return the key metric of the attention after the layer outputs.
+    """
+    def forward(self, hidden_states, attention_mask, causal_attention_mask, output_attentions=False):
+        residual = hidden_states
+        hidden_states, attn_weights, key = self.self_attn(
+            hidden_states=self.layer_norm1(hidden_states),
+            attention_mask=attention_mask,
+            causal_attention_mask=causal_attention_mask,
+            output_attentions=output_attentions,
+        )
+        hidden_states = residual + hidden_states
+        hidden_states = hidden_states + self.mlp(self.layer_norm2(hidden_states))
+        outputs = (hidden_states, attn_weights) if output_attentions else (hidden_states,)
+        return outputs + (key,)
+
+
 class PiToMeCLIPEncoder(CLIPEncoder):
     """
     Transformer encoder consisting of `config.num_hidden_layers` self attention layers. Each layer is a
@@ -20,14 +65,27 @@ class PiToMeCLIPEncoder(CLIPEncoder):
         self.margins = margins 
 
     def compress_x(self, metric, x, attn, idx):
-        ratio = self._info["ratio"].pop()
-        if ratio < 1.0:
+        r = self._info["schedule"].r[idx]
+        if r > 0:
+            energy_score = None
+            if self._info["reuse_plan"]:
+                energy_score = reuse_energy_score(
+                    self._info, metric,
+                    margin=self.margins[idx],
+                    class_token=self._info["class_token"],
+                    chunk_size=self._info["chunk_size"],
+                )
             merge = pitome_vision(
-                ratio=ratio,
+                r=r,
                 metric=metric,
                 margin=self.margins[idx],
-                class_token=self._info["class_token"]
+                class_token=self._info["class_token"],
+                chunk_size=self._info["chunk_size"],
+                return_plan=self._info["reuse_plan"] or self._info["trace_source"],
+                energy_score=energy_score,
             )
+            if self._info["reuse_plan"]:
+                self._info["energy"] = merge_energy(merge, energy_score, class_token=self._info["class_token"])
 
             if self._info["trace_source"]:
                 self._info["source"] = merge_source(
@@ -38,6 +96,13 @@ class PiToMeCLIPEncoder(CLIPEncoder):
 
 
 
+    def layer_metric(self, hidden_states, layer_outputs):
+        if self._info["metric"] != "key":
+            return hidden_states
+        # key projection returned by the attention of the layer, averaged over heads as in the
+        # other PiToMe patches
+        return layer_outputs[-1]
+
     def forward(
         self,
         inputs_embeds,
@@ -76,13 +141,14 @@ class PiToMeCLIPEncoder(CLIPEncoder):
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
         """
-        len_layers = len(self.layers)
-        # self._info["ratio"] = [self.ratio if i%2==0 else 1.0 for i in range(len_layers)]
-        # self._info["ratio"] = [self.ratio for i in range(len_layers) ]
-        self._info["ratio"] = [self.ratio] * len(self.layers) 
+        self._info["schedule"] = schedule_for(self, inputs_embeds.shape[1])
         self._info["size"] = None
         self._info["source"] = None
+        self._info["energy"] = None
+        self._info["plan_reused"] = 0
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+        # attentions are only requested when asked for, so transformers can keep its fused attention
+        output_attentions = output_attentions or self._info["output_attn"]
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
@@ -102,19 +168,20 @@ class PiToMeCLIPEncoder(CLIPEncoder):
                     hidden_states,
                     attention_mask,
                     causal_attention_mask,
-                    output_attentions=True,
+                    output_attentions=output_attentions,
                 )
             else:
                 layer_outputs = encoder_layer(
                     hidden_states,
                     attention_mask,
                     causal_attention_mask,
-                    output_attentions=True,
+                    output_attentions=output_attentions,
                 )
 
             hidden_states = layer_outputs[0]
             self.total_flops += self.calculate_block_flop(hidden_states.shape)
-            hidden_states= self.compress_x(hidden_states, hidden_states, layer_outputs[1],idx)
+            attn = layer_outputs[1] if output_attentions else None
+            hidden_states= self.compress_x(self.layer_metric(hidden_states, layer_outputs), hidden_states, attn, idx)
 
             if output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
@@ -140,7 +207,13 @@ class PiToMeCLIPEncoder(CLIPEncoder):
 
 
 def apply_patch(
-   model: CLIPEncoder, trace_source: bool = False, prop_attn: bool = True, margin=0.9, output_attn=False):
+   model: CLIPEncoder, trace_source: bool = False, prop_attn: bool = True, margin=0.9, output_attn=False, chunk_size=None, reuse_plan=False, drift_threshold=0.1,
+   metric="hidden"):
+    """
+    metric: "hidden" merges on the layer output, "key" on the key projection of the layer,
+    returned by the patched attention so no attention weights have to be returned.
+    """
+    assert metric in ("hidden", "key"), metric
 
     print('using', 'pitome')
 
@@ -158,7 +231,17 @@ def apply_patch(
         "class_token": True,
         "distill_token": False,
         "attn": [],
-        "output_attn": output_attn 
+        "output_attn": output_attn,
+        "chunk_size": chunk_size,
+        "reuse_plan": reuse_plan,
+        "drift_threshold": drift_threshold,
+        "energy": None,
+        "plan_reused": 0,
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
+        "metric": metric,
     }
     current_layer = 0
     margin = margin 
@@ -166,3 +249,10 @@ def apply_patch(
     # margins = [margin - margin*(i/num_layers) for i in range(num_layers)]
     margins = [.9 - .9*(i/num_layers) for i in range(num_layers)]
     model.init_margin(margins)
+    model._info["margins"] = margins
+    model.token_schedule = None
+
+    if metric == "key":
+        for layer in model.layers:
+            layer.__class__ = PiToMeCLIPEncoderLayer
+            layer.self_attn.__class__ = PiToMeCLIPAttention
@@ -14,9 +14,10 @@ from typing import Tuple
 import torch
 import torch.nn as nn
 from transformers.models.distilbert.modeling_distilbert import Transformer, TransformerBlock, MultiHeadSelfAttention
-from ..merge import merge_source, pitome_text,merge_wavg, merge_attention_mask
+from ..merge import merge_source, pitome_text,merge_wavg, merge_attention_mask, pitome_text_varlen, pack_tokens, unpack_tokens, varlen_mask
 from typing import Optional, Union 
 import math
+from ..utils import schedule_for, ragged_for
 from transformers.modeling_utils import ModuleUtilsMixin 
 
 
@@ -49,17 +50,39 @@ class PiToMeDistilBertBlock(TransformerBlock):
             head_mask=head_mask,
             output_attentions=True,
         )
-        ratio = self._info["ratio"].pop()
+        r = self._info["schedule"].r[self._layer]
+        ragged = self._info["ragged"]
+        if ragged is not None:
+            # one r per sample, merged on the packed real tokens of every sample
+            rs = ragged.expand(lambda group: group["schedule"].r[self._layer])
+            tokens = ragged.expand(lambda group: group["schedule"].tokens[self._layer])
+            r = max(rs)
         sa_output, metric ,sa_weights = sa_output  # (bs, seq_length, dim), (bs, n_heads, seq_length, seq_length)
     
         sa_output = self.sa_layer_norm(sa_output + x)  # (bs, seq_length, dim)
 
-        if ratio < 1.0:
+        if r > 0 and self._info["cu_seqlens"] is not None:
+            # sa_output and metric are packed (see pack_tokens): every sample merges its own real tokens
+            plan, self._info["cu_seqlens"] = pitome_text_varlen(
+                metric, self._info["cu_seqlens"],
+                r=r if ragged is None else rs,
+                tokens=None if ragged is None else tokens,
+                margin=self.margin,
+                class_token=self._info["class_token"],
+                backend=self._info["backend"],
+                **self._info["backend_kwargs"],
+            )
+            sa_output, self._info["size"], _ = plan.merge_wavg(sa_output)
+            attn_mask = varlen_mask(self._info["cu_seqlens"])
+        elif r > 0:
             merge = pitome_text(
-                ratio=ratio,
+                r=r,
                 metric=metric,
                 margin=self.margin,
-                class_token=self._info["class_token"]
+                class_token=self._info["class_token"],
+                backend=self._info["backend"],
+                attention_mask=attn_mask,
+                **self._info["backend_kwargs"],
             )
 
             sa_output, self._info["size"] = merge_wavg(merge, sa_output, None)
@@ -120,9 +143,17 @@ class PiToMeDistilBertAttention(MultiHeadSelfAttention):
             """group heads"""
             return x.transpose(1, 2).contiguous().view(bs, -1, self.n_heads * dim_per_head)
 
-        q = shape(self.q_lin(query))  # (bs, n_heads, q_length, dim_per_head)
-        k = shape(self.k_lin(key))  # (bs, n_heads, k_length, dim_per_head)
-        v = shape(self.v_lin(value))  # (bs, n_heads, k_length, dim_per_head)
+        q, k, v = self.q_lin(query), self.k_lin(key), self.v_lin(value)
+        packed = self._info["cu_seqlens"] is not None
+        if packed:
+            # the projections run on the packed real tokens, only the attention itself is padded
+            bs, k_length = mask.shape
+            mask_reshp = (bs, 1, 1, k_length)
+            real = mask
+            q, k, v = (unpack_tokens(t, None, attention_mask=real)[0] for t in (q, k, v))
+        q = shape(q)  # (bs, n_heads, q_length, dim_per_head)
+        k = shape(k)  # (bs, n_heads, k_length, dim_per_head)
+        v = shape(v)  # (bs, n_heads, k_length, dim_per_head)
 
         q = q / math.sqrt(dim_per_head)  # (bs, n_heads, q_length, dim_per_head)
         scores = torch.matmul(q, k.transpose(2, 3))  # (bs, n_heads, q_length, k_length)
@@ -140,12 +171,15 @@ class PiToMeDistilBertAttention(MultiHeadSelfAttention):
 
         context = torch.matmul(weights, v)  # (bs, n_heads, q_length, dim_per_head)
         context = unshape(context)  # (bs, q_length, dim)
+        metric = k.mean(1)
+        if packed:
+            context, metric = pack_tokens(context, real)[0], pack_tokens(metric, real)[0]
         context = self.out_lin(context)  # (bs, q_length, dim)
 
         if output_attentions:
-            return (context, k.mean(1), weights)
+            return (context, metric, weights)
         else:
-            return (context, k.mean(1))
+            return (context, metric)
 
 
 def make_tome_class(transformer_class):
@@ -164,23 +198,20 @@ def make_tome_class(transformer_class):
             return_dict: Optional[bool] = None,
         ): 
 
-            len_layers = len(self.layer)
-            self._info["ratio"] = [self.ratio if i in [
-                len_layers - 1, 
-                len_layers - 2,
-                len_layers - 3,
-                # len_layers - 6,
-                # len_layers - 9,
-            ] else 1.0 for i in range(len_layers) ]
-            # self._info["ratio"] = [self.ratio for i in range(len(self.layer))]
+            self._info["schedule"] = schedule_for(self, x.shape[1])
+            self._info["ragged"] = ragged_for(self, x.shape[1], device=x.device, batch_size=x.shape[0])
             all_hidden_states = () if output_hidden_states else None
             all_attentions = () if output_attentions else None
 
             hidden_state = x
+            self._info["cu_seqlens"] = None
+            if self._info["varlen"] or self._info["ragged"] is not None:
+                # the real tokens stay packed from layer to layer, so the pads cost nothing
+                hidden_state, self._info["cu_seqlens"] = pack_tokens(hidden_state, attn_mask)
             flops = 0
             for i, layer_module in enumerate(self.layer):
                 if output_hidden_states:
-                    all_hidden_states = all_hidden_states + (hidden_state,)
+                    all_hidden_states = all_hidden_states + (self._unpack(hidden_state),)
 
                 layer_outputs = layer_module(
                     x=hidden_state, attn_mask=attn_mask, head_mask=head_mask[i], output_attentions=output_attentions
@@ -192,8 +223,15 @@ def make_tome_class(transformer_class):
                 # print('mask',attn_mask.shape)
                 # print('x',hidden_state.shape)
                     
-                flops += self.calculate_block_flop(hidden_state.shape)
+                if self._info["cu_seqlens"] is None:
+                    flops += self.calculate_block_flop(hidden_state.shape)
+                else:
+                    # FLOPs per sample: every sample pays for its own real tokens
+                    lengths = attn_mask.sum(dim=-1).tolist()
+                    flops += sum(self.calculate_block_flop((1, t, hidden_state.shape[-1])) for t in lengths) / len(lengths)
 
+            hidden_state = self._unpack(hidden_state)
+            self._info["cu_seqlens"] = None
 
             # Add last layer
             if output_hidden_states:
@@ -201,6 +239,12 @@ def make_tome_class(transformer_class):
 
             return hidden_state, all_hidden_states, all_attentions, flops
         
+        def _unpack(self, hidden_state):
+            # packed hidden states are padded to the longest sample for the caller
+            if self._info["cu_seqlens"] is None:
+                return hidden_state
+            return unpack_tokens(hidden_state, self._info["cu_seqlens"])[0]
+
         def calculate_block_flop(self, shape):
             flops = 0
             _, N, C = shape
@@ -216,7 +260,8 @@ def make_tome_class(transformer_class):
 
 
 def apply_patch(
-   model: Transformer, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_attn=False):
+   model: Transformer, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_attn=False,
+   backend="exact", proj_dim=16, n_bits=8, window=32, varlen=False):
 
     PiToMeTransformers = make_tome_class(model.__class__)
     print('using', 'pitome')
@@ -235,19 +280,35 @@ def apply_patch(
         "prop_attn": prop_attn,
         "class_token": True,
         "distill_token": False,
+        "backend": backend,
+        "backend_kwargs": {"proj_dim": proj_dim, "n_bits": n_bits, "window": window},
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
+        "varlen": varlen,
+        "ragged": None,
+        "cu_seqlens": None,
     }
     current_layer = 0
     margin = margin 
     num_layers = len(model.layer)
     margins = [0.9 - 0.25*(i/num_layers) for i in range(num_layers)]
 
+    # ratio is applied to the first three layers
+    model._info["margins"] = margins
+    model._info["merge_layers"] = [0, 1, 2]
+    model.token_schedule = None
+
 
     for module in model.modules():
         if isinstance(module, TransformerBlock):
             module.__class__ = PiToMeDistilBertBlock 
             module.init_margin(margins[current_layer])
             module._info = model._info
+            module._layer = current_layer
             current_layer +=1
         if isinstance(module, MultiHeadSelfAttention):
-            module.__class__ = PiToMeDistilBertAttention 
+            module.__class__ = PiToMeDistilBertAttention
+            module._info = model._info 
 
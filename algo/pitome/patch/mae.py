@@ -13,7 +13,10 @@
 import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 from copy import copy
-from .timm import PiToMeBlock, PiToMeAttention, PiToMeBlock
+from ..merge import grid_positions, init_stream, temporal_merge
+from ..utils import schedule_for, ragged_for
+from ...state import call_info, forward_head, publish
+from .timm import PiToMeBlock, PiToMeAttention, PiToMeBlock, CALL_STATE
 import torch.nn as nn
 
 
@@ -25,40 +28,64 @@ def make_pitome_class(transformer_class):
         - For MAE: make global average pooling proportional to token size
         """
 
-        def forward(self, x, return_flop=True) -> torch.Tensor:
-            self._info["ratio"] = [self.ratio] * len(self.blocks) 
-            self._info["size"] = None
-            self._info["source"] = None
-            self._info["isolate_score"] = None
-            self.total_flop = 0
-
-            x = super().forward(x)
+        def forward(self, x, return_flop=True, info=None) -> torch.Tensor:
+            # pass info=call_info(...) to read the size / source / schedule of this call afterwards
+            info = call_info(self._info, CALL_STATE) if info is None else info
+            x = forward_head(self, self.forward_features(x, info))
+            publish(self._info, info)
             if return_flop:
-                return x, self.calculate_flop()
+                return x, info["total_flop"]
             else:
                 return x
 
-        def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        def forward_stream(self, frames, temporal_window=2, threshold=0.9, return_flop=True, stream=None):
+            """
+            Encodes a video frame by frame, merging the static tokens of each frame with the 
+            tokens carried over from the previous frames (see temporal_merge).
+            frames: a (B, F, 3, H, W) tensor or an iterable of (B, 3, H, W) frames.
+            stream: an init_stream() state to continue, e.g. to read its num_tokens afterwards.
+            Yields the output of forward for every frame.
+            """
+            if torch.is_tensor(frames):
+                frames = frames.unbind(1)
+            if stream is None:
+                stream = init_stream(temporal_window=temporal_window, threshold=threshold)
+            for frame in frames:
+                yield self.forward(frame, return_flop=return_flop, info=call_info(self._info, CALL_STATE, stream=stream))
+
+
+        def forward_features(self, x: torch.Tensor, info: dict = None) -> torch.Tensor:
+            info = call_info(self._info, CALL_STATE) if info is None else info
             # From the MAE implementation
             B = x.shape[0]
             T = x.shape[1]
 
             x = self.patch_embed(x)
+            metric = x
 
             cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
             x = torch.cat((cls_tokens, x), dim=1)
             x = x + self.pos_embed
             x = self.pos_drop(x)
-
+            if info["window_size"] is not None:
+                H, W = self.patch_embed.grid_size
+                info["pos"] = grid_positions(x.shape[0], H, W, prefix_tokens=info["prefix_tokens"], device=x.device)
+            if info["stream"] is not None:
+                x = temporal_merge(info, x, metric)
+
+            info["schedule"] = schedule_for(self, x.shape[1])
+            info["ragged"] = ragged_for(self, x.shape[1], device=x.device, batch_size=x.shape[0])
             for blk in self.blocks:
-                self.total_flop += self.calculate_block_flop(x.shape) 
-                x = blk(x)
+                # realized FLOPs per image: with a ragged batch every sample pays for its own tokens
+                shapes = [x.shape] if info["ragged"] is None else [(1, t, x.shape[-1]) for t in info["ragged"].tokens()]
+                info["total_flop"] += sum(self.calculate_block_flop(shape) for shape in shapes) / len(shapes)
+                x = blk(x, info)
 
             if self.global_pool:
                 # ---- ToMe changes this ----
                 # Global average pool proportional to token size
-                if self._info["size"] is not None:
-                    x = (x * self._info["size"])[:, 1:, :].sum(dim=1) / T
+                if info["size"] is not None:
+                    x = (x * info["size"])[:, 1:, :].sum(dim=1) / T
                 else:
                     x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
                 # ---- End of change ----
@@ -86,7 +113,7 @@ def make_pitome_class(transformer_class):
             patch_number = float(self.patch_embed.num_patches)
             N = torch.tensor(patch_number+1).to('cuda')
             flops = 0
-            flops += self.total_flop 
+            flops += self._info["total_flop"] 
             return flops
         
 
@@ -94,7 +121,8 @@ def make_pitome_class(transformer_class):
 
 
 def apply_patch(
-    model: VisionTransformer, trace_source: bool = False, prop_attn: bool = False, margin=0.9
+    model: VisionTransformer, trace_source: bool = False, prop_attn: bool = False, margin=0.9, chunk_size=None, reuse_plan=False, drift_threshold=0.1,
+    window_size=None, shift_window=False, static_ratio=None, threshold=None
 ):
 
 
@@ -112,6 +140,25 @@ def apply_patch(
         "prop_attn": False,
         "class_token": model.cls_token is not None,
         "distill_token": False,
+        "chunk_size": chunk_size,
+        "reuse_plan": reuse_plan,
+        "drift_threshold": drift_threshold,
+        "energy": None,
+        "plan_reused": 0,
+        "window_size": window_size,
+        "shift_window": shift_window,
+        "pos": None,
+        "window_layer": 0,
+        "stream": None,
+        "margins": None,
+        "merge_layers": None,
+        "schedules": {},
+        "schedule": None,
+        "ragged": None,
+        # energy-threshold mode: merge only the tokens with energy above threshold, model.ratio
+        # is then the per layer budget
+        "threshold": threshold,
+        "total_flop": 0,
     }
     current_layer = 0
     num_layers = len(model.blocks)
@@ -121,12 +168,26 @@ def apply_patch(
 
     if hasattr(model, "dist_token") and model.dist_token is not None:
         model._info["distill_token"] = True
+    # class / distill tokens in front of the patch tokens (num_tokens in older timm versions)
+    model._info["prefix_tokens"] = getattr(
+        model, "num_prefix_tokens",
+        getattr(model, "num_tokens", int(model._info["class_token"]) + int(model._info["distill_token"])),
+    )
+
+    model._info["margins"] = margins
+    model.token_schedule = None
+    if static_ratio is not None:
+        # fix the schedule at patch time so that the patched forward has static shapes
+        num_tokens = model.patch_embed.num_patches + int(model._info["class_token"]) + int(model._info["distill_token"])
+        model.ratio = static_ratio
+        model.token_schedule = schedule_for(model, num_tokens)
 
     for module in model.modules():
         if isinstance(module, Block):
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._info = model._info
+            module._layer = current_layer
             current_layer +=1
         elif isinstance(module, Attention):
             module.__class__ = PiToMeAttention
\ No newline at end of file
@@ -13,10 +13,17 @@ from typing import Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.vision_transformer import Attention, Block
-from ..merge import merge_source, pitome_vision, merge_wavg, merge_mean, prune
+from ..merge import merge_source, pitome_vision, merge_wavg, merge_mean, prune, reuse_energy_score, merge_energy, pitome_window, merge_positions, vision_energy_score, adaptive_r
 
 
+# per-forward state of the patched models, reset at every call (see call_info)
+CALL_STATE = {
+    "size": None, "source": None, "energy": None, "plan_reused": 0, "pos": None, "window_layer": 0,
+    "isolate_score": None, "schedule": None, "ragged": None, "total_flop": 0,
+}
+
 
 class PiToMeBlock(Block):
     """
@@ -34,26 +41,99 @@ class PiToMeBlock(Block):
     def _drop_path2(self, x):
         return self.drop_path2(x) if hasattr(self, "drop_path2") else self.drop_path(x)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        attn_size = self._info["size"] if self._info["prop_attn"] else None
+    def _adaptive_split(self, ragged, metric: torch.Tensor, info: dict) -> list:
+        """
+        Energy-threshold mode: splits the ragged batch by the number of tokens every sample 
+        merges (see adaptive_r), capped by the r of its schedule. Returns the energy score of 
+        every sample, reused to build the plans.
+        """
+        r, energy = [0] * ragged.batch_size, [None] * ragged.batch_size
+        for group in ragged.groups:
+            idx, tokens = group["idx"], group["tokens"]
+            energy_score = vision_energy_score(
+                metric[idx, :tokens],
+                margin=self.margin,
+                class_token=info["class_token"],
+                chunk_size=info["chunk_size"],
+            )
+            r_g = adaptive_r(energy_score, info["threshold"], budget=group["schedule"].r[self._layer])
+            for j, i in enumerate(idx.tolist()):
+                r[i], energy[i] = int(r_g[j]), energy_score[j]
+        ragged.split(r, "r")
+        return energy
+
+    def forward(self, x: torch.Tensor, info: dict = None) -> torch.Tensor:
+        # info: the per-call state passed down by the model (see call_info)
+        info = self._info if info is None else info
+        ragged = info["ragged"]
+        attn_size = info["size"] if info["prop_attn"] else None
+        if attn_size is None and ragged is not None and ragged.padded(x.shape[1]):
+            # padding tokens have size 0, log(0) masks them out as keys
+            attn_size = info["size"].clamp(max=1)
         x_attn, metric, _ = self.attn(self.norm1(x), attn_size)
         x = x + self._drop_path1(x_attn)
 
-        ratio = self._info["ratio"].pop(0)
-        if ratio < 1.0:
-            merge = pitome_vision(
-                ratio=ratio,
-                metric=metric,
-                margin=self.margin,
-                class_token=self._info["class_token"]
+        r = info["schedule"].r[self._layer]
+        if ragged is not None:
+            energy = None
+            if info["threshold"] is not None:
+                energy = self._adaptive_split(ragged, metric, info)
+
+            # one ratio per sample: every group of samples merges its own real tokens
+            def plan_fn(group, metric):
+                r = group["schedule"].r[self._layer] if energy is None else group["r"]
+                if r > 0:
+                    return pitome_vision(
+                        metric=metric,
+                        margin=self.margin,
+                        class_token=info["class_token"],
+                        chunk_size=info["chunk_size"],
+                        return_plan=True,
+                        energy_score=None if energy is None else torch.stack([energy[i] for i in group["idx"].tolist()]),
+                        r=r,
+                    )
+
+            x, info["size"], info["source"] = ragged.merge(
+                x, info["size"], metric, plan_fn, source=info["source"], trace_source=info["trace_source"]
             )
-
-            if self._info["trace_source"]:
-                self._info["source"] = merge_source(
-                    merge, x, self._info["source"]
+        elif r > 0:
+            energy_score = None
+            if info["reuse_plan"] and info["window_size"] is None:
+                energy_score = reuse_energy_score(
+                    info, metric, 
+                    margin=self.margin, 
+                    class_token=info["class_token"], 
+                    chunk_size=info["chunk_size"],
                 )
-
-            x, self._info["size"] = merge_wavg(merge, x,  self._info["size"] )
+            if info["window_size"] is not None:
+                plan = pitome_window(
+                    metric=metric,
+                    pos=info["pos"],
+                    margin=self.margin,
+                    window_size=info["window_size"],
+                    shift=info["shift_window"] and info["window_layer"] % 2 == 1,
+                    prefix_tokens=info["prefix_tokens"],
+                    return_plan=True,
+                    r=r,
+                )
+                info["pos"] = merge_positions(plan, info["pos"], info["size"])
+                info["window_layer"] += 1
+            else:
+                plan = pitome_vision(
+                    metric=metric,
+                    margin=self.margin,
+                    class_token=info["class_token"],
+                    chunk_size=info["chunk_size"],
+                    return_plan=True,
+                    energy_score=energy_score,
+                    r=r,
+                )
+            # x, size and source are merged in a single pass
+            x, info["size"], info["source"] = plan.merge_wavg(
+                x, info["size"], info["source"], trace_source=info["trace_source"]
+            )
+            if info["reuse_plan"] and info["window_size"] is None:
+                info["energy"] = merge_energy(plan, energy_score, class_token=info["class_token"])
           
 
         x = x + self._drop_path2(self.mlp(self.norm2(x)))
@@ -67,10 +147,12 @@ class PiToMeAttention(Attention):
     Modifications:
     - Apply proportional attention
     - Return the mean of k over heads from attention
+    - Use the fused scaled_dot_product_attention kernel unless the attention map is requested
     """
+    fused_attn = hasattr(F, "scaled_dot_product_attention")
 
     def forward(
-        self, x: torch.Tensor, size: torch.Tensor = None
+        self, x: torch.Tensor, size: torch.Tensor = None, need_weights: bool = False
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         # Note: this is copied from timm.models.vision_transformer.Attention with modifications.
         B, N, C = x.shape
@@ -85,6 +167,18 @@ class PiToMeAttention(Attention):
             qkv[2],
         )  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.fused_attn and not need_weights:
+            # proportional attention enters as an additive float mask
+            bias = size.log()[:, None, None, :, 0].to(q.dtype) if size is not None else None
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=bias, scale=self.scale,
+                dropout_p=self.attn_drop.p if self.training else 0.0,
+            )
+            x = x.transpose(1, 2).reshape(B, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, k.mean(1), None
+
         attn = (q @ k.transpose(-2, -1)) * self.scale
 
         # Apply proportional attention
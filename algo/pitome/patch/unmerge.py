@@ -0,0 +1,64 @@
+import inspect
+
+import torch
+import torch.nn as nn
+from ..merge import pitome_vision, pitome_text
+
+
+def make_unmerge_class(module_class):
+    class PiToMeUnmergeModule(module_class):
+        """
+        Modifications:
+         - Merge the tokens of the first input with PiToMe before running the module
+         - Pass the merged token size to the module if it takes one (proportional attention)
+         - Unmerge its output back to the original tokens, so the result stays on the
+           input token layout (e.g. a spatial feature grid)
+        """
+
+        def forward(self, x: torch.Tensor, *args, **kwargs):
+            info = self._unmerge_info
+            if info["ratio"] >= 1.0:
+                return super().forward(x, *args, **kwargs)
+            match = pitome_text if info["text"] else pitome_vision
+            plan = match(
+                metric=x,
+                ratio=info["ratio"],
+                margin=info["margin"],
+                class_token=info["class_token"],
+                return_plan=True,
+            )
+
+            x, size, _ = plan.merge_wavg(x)
+            if info["prop_attn"]:
+                kwargs["size"] = size
+            out = super().forward(x, *args, **kwargs)
+            if isinstance(out, tuple):
+                return (plan.unmerge(out[0]),) + out[1:]
+            return plan.unmerge(out)
+
+    return PiToMeUnmergeModule
+
+
+def apply_patch(
+    module: nn.Module, ratio: float = 0.5, margin: float = 0.5, class_token: bool = False, text: bool = False,
+    prop_attn: bool = True):
+    """
+    Wraps any token-wise module (an attention or MLP sublayer, a whole block, ...) taking
+    (B, T, C) tokens as first input: tokens are merged before it and its (B, T', C) output is
+    unmerged back to (B, T, C). Use it where the output must stay on the original tokens.
+    With prop_attn, a module whose forward takes a size argument (e.g. the PiToMe attention)
+    gets the (B, T', 1) size of the merged tokens. At ratio 1.0 the module runs as is.
+    """
+    if hasattr(module, "_unmerge_info"):
+        takes_size = module._unmerge_info["takes_size"]
+    else:
+        takes_size = "size" in inspect.signature(module.forward).parameters
+        module.__class__ = make_unmerge_class(module.__class__)
+    module._unmerge_info = {
+        "ratio": ratio,
+        "margin": margin,
+        "class_token": class_token,
+        "text": text,
+        "takes_size": takes_size,
+        "prop_attn": prop_attn and takes_size,
+    }
@@ -5,11 +5,13 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
+import math
 import time
 from typing import List, Tuple, Union
 
 import torch
 from tqdm import tqdm
+from ..plan import RaggedBatch, per_sample
 
 
 def benchmark(
@@ -21,7 +23,9 @@ def benchmark(
     throw_out: float = 0.25,
     use_fp16: bool = False,
     verbose: bool = False,
-) -> float:
+    input: torch.Tensor = None,
+    return_flops: bool = False,
+) -> Union[float, Tuple[float, float]]:
     """
     Benchmark the given model with random inputs at the given batch size.
 
@@ -34,21 +38,28 @@ def benchmark(
      - throw_out: the percentage of runs to throw out at the start of testing
      - use_fp16: whether or not to benchmark with float16 and autocast
      - verbose: whether or not to use tqdm to print progress / print throughput at end
+     - input: a (batch_size, *input_size) batch to use instead of random inputs
+     - return_flops: also return the average FLOPs per image the model reports, e.g. the 
+       realized FLOPs of the energy-threshold mode
 
     Returns:
-     - the throughput measured in images / second
+     - the throughput measured in images / second (and the average FLOPs with return_flops)
     """
     if not isinstance(device, torch.device):
         device = torch.device(device)
     is_cuda = torch.device(device).type == "cuda"
 
     model = model.eval().to(device)
-    input = torch.rand(batch_size, *input_size, device=device)
+    if input is None:
+        input = torch.rand(batch_size, *input_size, device=device)
+    input = input.to(device)
+    batch_size = input.shape[0]
     if use_fp16:
         input = input.half()
 
     warm_up = int(runs * throw_out)
     total = 0
+    flops = []
     start = time.time()
 
     with torch.autocast(device.type, enabled=use_fp16):
@@ -60,8 +71,10 @@ def benchmark(
                     total = 0
                     start = time.time()
 
-                model(input)
+                out = model(input)
                 total += batch_size
+                if return_flops and isinstance(out, tuple):
+                    flops.append(float(out[-1]))
 
     if is_cuda:
         torch.cuda.synchronize()
@@ -74,6 +87,80 @@ def benchmark(
     if verbose:
         print(f"Throughput: {throughput:.2f} im/s")
 
+    if return_flops:
+        flops = sum(flops) / max(len(flops), 1)
+        if verbose:
+            print(f"FLOPs: {flops/1e9:.3f} G/im")
+        return throughput, flops
+    return throughput
+
+
+def benchmark_stream(
+    model: torch.nn.Module,
+    device: torch.device = "cpu",
+    input_size: Tuple[int] = (3, 224, 224),
+    num_frames: int = 16,
+    batch_size: int = 1,
+    runs: int = 8,
+    throw_out: float = 0.25,
+    noise: float = 0.05,
+    temporal_window: int = 2,
+    threshold: float = 0.9,
+    verbose: bool = False,
+) -> float:
+    """
+    Benchmark a patched model on a synthetic video through model.forward_stream. 
+    Every clip is a random frame plus a small random perturbation per frame, so the scene is 
+    mostly static.
+
+    Args:
+     - model: the patched module to benchmark (must have forward_stream)
+     - device: the device to use for benchmarking
+     - input_size: the frame size (channels, h, w)
+     - num_frames: the number of frames per clip
+     - batch_size: the number of clips streamed together
+     - runs: the number of clips to stream
+     - throw_out: the percentage of runs to throw out at the start of testing
+     - noise: the std of the per frame perturbation
+     - temporal_window, threshold: passed to forward_stream
+     - verbose: whether or not to use tqdm to print progress / print throughput at end
+
+    Returns:
+     - the throughput measured in frames / second
+    """
+    if not isinstance(device, torch.device):
+        device = torch.device(device)
+    is_cuda = device.type == "cuda"
+
+    model = model.eval().to(device)
+    base = torch.rand(batch_size, 1, *input_size, device=device)
+    frames = base + noise * torch.randn(batch_size, num_frames, *input_size, device=device)
+
+    warm_up = int(runs * throw_out)
+    total = 0
+    flops = []
+    start = time.time()
+
+    with torch.no_grad():
+        for i in tqdm(range(runs), disable=not verbose, desc="Benchmarking"):
+            if i == warm_up:
+                if is_cuda:
+                    torch.cuda.synchronize()
+                total = 0
+                start = time.time()
+
+            for _ in model.forward_stream(frames, temporal_window=temporal_window, threshold=threshold):
+                total += batch_size
+
+    if is_cuda:
+        torch.cuda.synchronize()
+
+    elapsed = time.time() - start
+    throughput = total / elapsed
+
+    if verbose:
+        print(f"Throughput: {throughput:.2f} frames/s")
+
     return throughput
 
 
@@ -103,3 +190,178 @@ def parse_r(num_layers: int, r: Union[List[int], Tuple[int, float], int]) -> Lis
     step = (max_val - min_val) / (num_layers - 1)
 
     return [int(min_val + step * i) for i in range(num_layers)]
+
+
+class TokenSchedule:
+    """
+    Per layer token budget of a patched model for one input length: how many tokens every layer
+    merges (r), keeps (keep) and sees (tokens), and the margin it merges with. 
+    Computed once per model and input length (see schedule_for) and read by every block, so the 
+    token counts and FLOPs are known before the forward pass.
+
+    Args:
+     - r: the number of tokens merged by every layer
+     - margins: the margin of every layer
+     - num_tokens: the number of tokens entering the first layer, prefix tokens included
+     - prefix_tokens: the number of tokens that are never merged (class token)
+    """
+
+    def __init__(self, r: List[int], margins: List[float], num_tokens: int, prefix_tokens: int = 1):
+        assert len(r) == len(margins), "one merge count and one margin per layer"
+        self.margins = list(margins)
+        self.num_tokens = num_tokens
+        self.prefix_tokens = prefix_tokens
+        self.r, self.tokens = [], []
+        T = num_tokens
+        for r_i in r:
+            # a layer can not merge more than half of its mergeable tokens
+            r_i = max(min(r_i, (T - prefix_tokens) // 2), 0)
+            self.tokens.append(T)
+            self.r.append(r_i)
+            T -= r_i
+        self.keep = [t - r_i for t, r_i in zip(self.tokens, self.r)]
+
+    @classmethod
+    def from_ratio(
+        cls, 
+        num_tokens: int, 
+        ratio: float, 
+        margins: List[float], 
+        merge_layers: List[int] = None, 
+        prefix_tokens: int = 1,
+    ) -> "TokenSchedule":
+        """
+        Every layer in merge_layers (all by default) keeps ratio of its mergeable tokens, with 
+        the floor(T - T*ratio) rule of pitome_vision / pitome_text.
+        """
+        num_layers = len(margins)
+        merge_layers = range(num_layers) if merge_layers is None else merge_layers
+        r, T = [], num_tokens - prefix_tokens
+        for i in range(num_layers):
+            r_i = min(math.floor(T - T*ratio), T // 2) if i in merge_layers and ratio < 1.0 else 0
+            r.append(r_i)
+            T -= r_i
+        return cls(r, margins, num_tokens, prefix_tokens=prefix_tokens)
+
+    @classmethod
+    def from_r(
+        cls, 
+        num_tokens: int, 
+        r: Union[List[int], Tuple[int, float], int], 
+        margins: List[float], 
+        prefix_tokens: int = 1,
+    ) -> "TokenSchedule":
+        """
+        Fixed number of merged tokens per layer, r takes any form accepted by parse_r.
+        """
+        return cls(parse_r(len(margins), r), margins, num_tokens, prefix_tokens=prefix_tokens)
+
+    def __len__(self) -> int:
+        return len(self.r)
+
+    def __repr__(self) -> str:
+        return f"TokenSchedule(tokens={self.tokens}, r={self.r})"
+
+    def flops(self, embed_dim: int) -> List[float]:
+        """
+        FLOPs of every layer at the number of tokens it sees, with the same formula as 
+        calculate_block_flop of the patched models.
+        """
+        C = embed_dim
+        return [4*N*C*C + 2*N*N*C + 8*N*C*C for N in self.tokens]
+
+    def total_flops(self, embed_dim: int) -> float:
+        return sum(self.flops(embed_dim))
+
+
+def schedule_for(model: torch.nn.Module, num_tokens: int, merge_layers: List[int] = None, ratio: float = None) -> TokenSchedule:
+    """
+    Returns the TokenSchedule a patched model runs inputs of num_tokens tokens with. 
+    model.token_schedule is used as is when it is set (static mode); otherwise the schedule is 
+    derived from model.ratio (or ratio), model._info["margins"] and model._info["merge_layers"] 
+    (or merge_layers) and cached per ratio and input length. With per-sample ratios this is the 
+    schedule of the smallest one, see ragged_for for the per-sample schedules.
+    """
+    if model.token_schedule is not None:
+        return model.token_schedule
+    info = model._info
+    ratio = model.ratio if ratio is None else ratio
+    if per_sample(ratio):
+        ratio = round(min(torch.as_tensor(ratio, dtype=torch.float).flatten().tolist()), 6)
+    merge_layers = info["merge_layers"] if merge_layers is None else merge_layers
+    key = (ratio, num_tokens, None if merge_layers is None else tuple(merge_layers))
+    if key not in info["schedules"]:
+        info["schedules"][key] = TokenSchedule.from_ratio(
+            num_tokens, ratio, info["margins"], 
+            merge_layers=merge_layers, 
+            prefix_tokens=int(info["class_token"]),
+        )
+    return info["schedules"][key]
+
+
+def ragged_for(
+    model: torch.nn.Module, num_tokens: int, device=None, merge_layers: List[int] = None, batch_size: int = None
+) -> RaggedBatch:
+    """
+    Returns a RaggedBatch grouping the samples by ratio when model.ratio holds one ratio per 
+    sample or the energy-threshold mode is on (None otherwise), every group carrying the 
+    "schedule" of its ratio. batch_size is needed for a single ratio in energy-threshold mode, 
+    a ValueError is raised when it does not match the number of per-sample ratios.
+    """
+    if model.token_schedule is not None:
+        return None
+    ratio = model.ratio
+    if not per_sample(ratio):
+        if model._info.get("threshold") is None:
+            return None
+        ratio = [ratio] * batch_size
+    ragged = RaggedBatch(ratio, num_tokens, device=device, batch_size=batch_size)
+    for group in ragged.groups:
+        group["schedule"] = schedule_for(model, num_tokens, merge_layers=merge_layers, ratio=group["ratio"])
+    return ragged
+
+
+def graph_breaks(model: torch.nn.Module, *args, **kwargs) -> Tuple[int, list]:
+    """
+    Traces model(*args, **kwargs) with torch._dynamo and returns the number of graph breaks 
+    and their reasons. A patched model in static mode should report 0 breaks.
+    """
+    import torch._dynamo as dynamo
+
+    dynamo.reset()
+    with torch.no_grad():
+        explanation = dynamo.explain(model)(*args, **kwargs)
+    return explanation.graph_break_count, [b.reason for b in explanation.break_reasons]
+
+
+def stress_test(
+    model: torch.nn.Module,
+    inputs: List[torch.Tensor],
+    num_threads: int = 8,
+    repeats: int = 4,
+) -> bool:
+    """
+    Calls one patched model from num_threads threads at once, every thread running all inputs
+    repeats times in a different order, and checks that every output is bit-identical to the
+    one of a sequential run. Returns True when they all match.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    model = model.eval()
+    with torch.no_grad():
+        expected = [model(x) for x in inputs]
+
+    def run(thread: int) -> bool:
+        order = [(i + thread) % len(inputs) for i in range(len(inputs))] * repeats
+        with torch.no_grad():
+            for i in order:
+                out, ref = model(inputs[i]), expected[i]
+                if isinstance(ref, tuple):
+                    if not all(torch.equal(o, r) if torch.is_tensor(r) else o == r for o, r in zip(out, ref)):
+                        return False
+                elif not torch.equal(out, ref):
+                    return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        return all(pool.map(run, range(num_threads)))
@@ -60,7 +60,8 @@ def make_visualization(
     """
 
     img = np.array(img.convert("RGB")) / 255.0
-    source = source.detach().cpu()
+    # dense (B, T, T_0) adjacency, also accepts a compact TokenSource
+    source = source.to_dense().detach().cpu()
 
     h, w, _ = img.shape
     ph = h // patch_size
@@ -0,0 +1,306 @@
+import torch
+from typing import List, Tuple
+
+
+class MergePlan:
+    """
+    A merge step expressed as a flat assignment of every input token to an output token.
+
+    All the matching functions (tome, tofu, crossget, mctf, pitome) end up doing the same
+    thing: gather the tokens that are kept, and scatter-reduce the merged tokens into their
+    destination. MergePlan stores that once as a single index of shape (B * T_in,) into the
+    flattened (B * T_out) output, so x, size and source can be merged together in one pass
+    instead of re-indexing protected/src/dst for every tensor.
+
+    The plan is also callable as plan(x, mode) so it can be passed anywhere a merge closure
+    is expected.
+    """
+
+    def __init__(self, group_idx: torch.Tensor, num_out: int):
+        """
+        Args:
+         - group_idx: (B, T_in) index of the output token every input token is merged into
+         - num_out: the number of output tokens T_out
+        """
+        B, T = group_idx.shape
+        self.group_idx = group_idx
+        self.num_in = T
+        self.num_out = num_out
+        offset = torch.arange(B, device=group_idx.device)[:, None] * num_out
+        self.flat_idx = (group_idx + offset).view(-1)
+
+    @classmethod
+    def from_indices(
+        cls, keep_idx: torch.Tensor, src_idx: torch.Tensor, dst_pos: torch.Tensor, num_in: int
+    ) -> "MergePlan":
+        """
+        Builds a plan from the usual gather / scatter description of a merge.
+
+        Args:
+         - keep_idx: (B, T_out) input token placed at each output position
+         - src_idx: (B, r) input tokens that are merged away
+         - dst_pos: (B, r) output position every src token is reduced into
+         - num_in: the number of input tokens T_in
+        """
+        B, T_out = keep_idx.shape
+        group_idx = keep_idx.new_empty(B, num_in)
+        out_pos = torch.arange(T_out, device=keep_idx.device)[None, :].expand(B, T_out)
+        group_idx.scatter_(1, keep_idx, out_pos)
+        group_idx.scatter_(1, src_idx, dst_pos)
+        return cls(group_idx, T_out)
+
+    def compose(self, other: "MergePlan") -> "MergePlan":
+        """
+        Returns the plan equivalent to applying self and then other.
+        Exact for sum and amax reductions.
+        """
+        return MergePlan(other.group_idx.gather(1, self.group_idx), other.num_out)
+
+    def __call__(self, x: torch.Tensor, mode="sum") -> torch.Tensor:
+        return self.merge(x, mode=mode)
+
+    def merge(self, x: torch.Tensor, mode="sum") -> torch.Tensor:
+        """
+        Reduces x of shape (B, T_in, C) into (B, T_out, C).
+        mode can be sum, mean, amax or amin. mean is the mean over the whole group.
+        """
+        B, T, C = x.shape
+        src = x.reshape(B * T, C)
+        out = x.new_zeros(B * self.num_out, C)
+        if mode == "sum" and torch.onnx.is_in_onnx_export():
+            # index_add exports to ScatterND, which does not reduce duplicated indices
+            out.scatter_add_(0, self.flat_idx[:, None].expand(B * T, C), src)
+        elif mode == "sum":
+            out.index_add_(0, self.flat_idx, src)
+        else:
+            out.index_reduce_(0, self.flat_idx, src, reduce=mode, include_self=False)
+        return out.view(B, self.num_out, C)
+
+    def unmerge(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Broadcasts x of shape (B, T_out, C) back to (B, T_in, C): every input token receives
+        the value of the output token it was merged into.
+        """
+        B, _, C = x.shape
+        return x.reshape(B * self.num_out, C).index_select(0, self.flat_idx).view(B, self.num_in, C)
+
+    def merge_wavg(
+        self, x: torch.Tensor, size: torch.Tensor = None, source: torch.Tensor = None, trace_source: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Fused merge_wavg + merge_source: a single reduction over [x*size | size | source].
+        Since every input token belongs to exactly one group, summing the source adjacency
+        matrix gives the same result as amax.
+        When tracing without a dense source, the source is a compact TokenSource instead.
+        Returns the merged tensor, the new token sizes and the new source (or None).
+        """
+        B, T, C = x.shape
+        if size is None:
+            size = torch.ones_like(x[..., 0, None])
+        payload = [x * size, size.to(x.dtype)]
+        dense_source = trace_source and isinstance(source, torch.Tensor)
+        if dense_source:
+            payload.append(source.to(x.dtype))
+        elif trace_source:
+            if source is None:
+                source = TokenSource.identity(B, T, device=x.device)
+            source = source.merge(self)
+
+        out = self.merge(torch.cat(payload, dim=-1), mode="sum")
+        size_out = out[..., C:C + 1]
+        x = out[..., :C] / size_out
+        if dense_source:
+            source = out[..., C + 1:].to(source.dtype)
+        return x, size_out.to(size.dtype), source
+
+
+class TokenSource:
+    """
+    Compact source tracking: for every original token, the index of the merged token it
+    currently belongs to. This replaces the dense (B, T, T_0) adjacency matrix, a merge
+    step is a single gather over the T_0 original tokens instead of an amax over T x T_0.
+    Use to_dense() for consumers that expect the adjacency matrix.
+    """
+
+    def __init__(self, group_idx: torch.Tensor, num_groups: int):
+        """
+        Args:
+         - group_idx: (B, T_0) int32 index of the current token every original token belongs to
+         - num_groups: the current number of tokens T
+        """
+        self.group_idx = group_idx
+        self.num_groups = num_groups
+
+    @classmethod
+    def identity(cls, batch_size: int, num_tokens: int, device=None) -> "TokenSource":
+        group_idx = torch.arange(num_tokens, dtype=torch.int32, device=device)
+        return cls(group_idx[None, :].expand(batch_size, num_tokens), num_tokens)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size((self.group_idx.shape[0], self.num_groups, self.group_idx.shape[1]))
+
+    def merge(self, plan: "MergePlan") -> "TokenSource":
+        group_idx = plan.group_idx.gather(1, self.group_idx.long())
+        return TokenSource(group_idx.to(torch.int32), plan.num_out)
+
+    def to_dense(self, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+        """
+        (B, T, T_0) adjacency matrix between the current tokens and the original ones.
+        """
+        B, T0 = self.group_idx.shape
+        dense = torch.zeros(B, self.num_groups, T0, dtype=dtype, device=self.group_idx.device)
+        return dense.scatter_(1, self.group_idx[:, None, :].long(), 1)
+
+
+def bipartite_plan(
+    unm_idx: torch.Tensor, src_idx: torch.Tensor, dst_idx: torch.Tensor, num_in: int
+) -> MergePlan:
+    """
+    Builds the MergePlan of a ToMe style bipartite merge where set a is x[..., ::2, :] and
+    set b is x[..., 1::2, :]. Indices are the (B, *, 1) tensors used by the merge closures,
+    the output layout is [unm, dst].
+    """
+    unm_idx, src_idx, dst_idx = unm_idx[..., 0], src_idx[..., 0], dst_idx[..., 0]
+    B, num_unm = unm_idx.shape
+    num_b = num_in // 2
+    b_idx = 2 * torch.arange(num_b, device=unm_idx.device)[None, :].expand(B, num_b) + 1
+    keep_idx = torch.cat([2 * unm_idx, b_idx], dim=-1)
+    return MergePlan.from_indices(keep_idx, 2 * src_idx, dst_idx + num_unm, num_in)
+
+
+def per_sample(ratio) -> bool:
+    """
+    True when ratio holds one merge ratio per sample (a list or a 1-d tensor) instead of a float.
+    """
+    if isinstance(ratio, torch.Tensor):
+        return ratio.dim() > 0
+    return isinstance(ratio, (list, tuple))
+
+
+class RaggedBatch:
+    """
+    Per-sample merge ratios within one batch. Samples are grouped by ratio and every group
+    merges the real tokens x[idx, :tokens] of its samples as a dense sub-batch, so each group
+    can build its plan with the usual matching functions. The batch is then padded back to the
+    longest group: the real tokens of every sample stay first, the padding tokens are zeros with
+    size 0, so the log(size) proportional attention bias masks them out as keys.
+
+    Every group is a dict with its "ratio", the "idx" of its samples, its current number of
+    real "tokens" and whatever the caller stores in it (e.g. a "schedule").
+    """
+
+    def __init__(self, ratios, num_tokens: int, device=None, batch_size: int = None):
+        # float32 ratios are rounded so that 0.9 and tensor(0.9) share a schedule
+        ratios = [round(r, 6) for r in torch.as_tensor(ratios, dtype=torch.float).flatten().tolist()]
+        if batch_size is not None and len(ratios) != batch_size:
+            raise ValueError(f"got {len(ratios)} per-sample ratios for a batch of {batch_size} samples")
+        self.batch_size = len(ratios)
+        self.groups = []
+        for ratio in sorted(set(ratios), reverse=True):
+            idx = [i for i, r in enumerate(ratios) if r == ratio]
+            self.groups.append({
+                "ratio": ratio,
+                "idx": torch.tensor(idx, device=device),
+                "tokens": num_tokens,
+            })
+
+    def merge(
+        self, x: torch.Tensor, size: torch.Tensor, metric: torch.Tensor, plan_fn,
+        source=None, trace_source: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Merges x (B, T, C) and its size (B, T, 1) group by group. plan_fn(group, metric) gets the
+        (n, tokens, C') metric of the group and returns a MergePlan, or anything else to skip
+        merging that group. When tracing, the source (dense or TokenSource, see merge_wavg) is
+        merged with the same plans and the padding tokens have no source token.
+        Returns the padded x, size and source (or None).
+        """
+        B, T, C = x.shape
+        if B != self.batch_size:
+            raise ValueError(f"got {self.batch_size} per-sample ratios for a batch of {B} samples")
+        if size is None:
+            size = torch.ones_like(x[..., 0, None])
+        if trace_source and source is None:
+            source = TokenSource.identity(B, T, device=x.device)
+        merged = []
+        for group in self.groups:
+            idx, tokens = group["idx"], group["tokens"]
+            x_g, size_g = x[idx, :tokens], size[idx, :tokens]
+            source_g = None
+            if isinstance(source, TokenSource):
+                source_g = TokenSource(source.group_idx[idx], tokens)
+            elif trace_source:
+                source_g = source[idx, :tokens]
+            plan = plan_fn(group, metric[idx, :tokens])
+            if isinstance(plan, MergePlan):
+                x_g, size_g, source_g = plan.merge_wavg(x_g, size_g, source_g, trace_source=trace_source)
+                group["tokens"] = plan.num_out
+            merged.append((idx, x_g, size_g, source_g))
+
+        T_out = max(group["tokens"] for group in self.groups)
+        x_out = x.new_zeros(B, T_out, C)
+        size_out = size.new_zeros(B, T_out, 1)
+        source_out = None
+        if isinstance(source, TokenSource):
+            source_out = TokenSource(source.group_idx.clone(), T_out)
+        elif trace_source:
+            source_out = source.new_zeros(B, T_out, source.shape[-1])
+        for idx, x_g, size_g, source_g in merged:
+            x_out[idx, :x_g.shape[1]] = x_g
+            size_out[idx, :x_g.shape[1]] = size_g
+            if isinstance(source_g, TokenSource):
+                source_out.group_idx[idx] = source_g.group_idx
+            elif trace_source:
+                source_out[idx, :x_g.shape[1]] = source_g
+        return x_out, size_out, source_out
+
+    def expand(self, fn) -> list:
+        """
+        Returns [fn(group) for the group of every sample], in batch order.
+        """
+        values = [None] * self.batch_size
+        for group in self.groups:
+            for i in group["idx"].tolist():
+                values[i] = fn(group)
+        return values
+
+    def tokens(self) -> List[int]:
+        """
+        Number of real tokens of every sample, in batch order.
+        """
+        return self.expand(lambda group: group["tokens"])
+
+    def split(self, values: list, key: str):
+        """
+        Regroups the samples by per-sample values (in batch order), e.g. a data dependent number 
+        of tokens to merge. Each new group stores its value under key. Samples of the same ratio 
+        that have the same number of tokens share a group again, even if an earlier split put 
+        them apart, so that the groups do not shrink down to single samples layer after layer.
+        """
+        groups = {}
+        for group in self.groups:
+            for i in group["idx"].tolist():
+                group_key = (group["ratio"], group["tokens"], values[i])
+                if group_key not in groups:
+                    groups[group_key] = dict(group, idx=[], **{key: values[i]})
+                groups[group_key]["idx"].append(i)
+        for group in groups.values():
+            group["idx"] = torch.tensor(sorted(group["idx"]), device=self.groups[0]["idx"].device)
+        self.groups = list(groups.values())
+
+    def padded(self, num_tokens: int) -> bool:
+        """
+        True when some sample has fewer than num_tokens real tokens.
+        """
+        return any(group["tokens"] < num_tokens for group in self.groups)
+
+    def mask(self, device=None) -> torch.Tensor:
+        """
+        (B, T) 1 for the real tokens of every sample and 0 for the padding.
+        """
+        T = max(group["tokens"] for group in self.groups)
+        tokens = torch.zeros(self.batch_size, dtype=torch.long, device=device)
+        for group in self.groups:
+            tokens[group["idx"].to(tokens.device)] = group["tokens"]
+        return (torch.arange(T, device=device)[None, :] < tokens[:, None]).long()
@@ -0,0 +1,115 @@
+import copy
+import time
+from typing import Callable, Iterable, List, Tuple
+
+import torch
+import torch.nn as nn
+
+
+# Linear layers of the transformer blocks: timm (qkv, proj, fc1, fc2), bert (query, key, value,
+# dense) and distilbert (q_lin, k_lin, v_lin, out_lin, lin1, lin2). The bert "dense" layers are
+# the attention output projection (BertSelfOutput) and the mlp (BertIntermediate, BertOutput),
+# the pooler's dense is excluded with the heads (see _quantizable).
+QUANT_LINEARS = (
+    "qkv", "proj", "fc1", "fc2",
+    "query", "key", "value", "dense",
+    "q_lin", "k_lin", "v_lin", "out_lin", "lin1", "lin2",
+)
+
+
+def _quantizable(model: nn.Module, names: Tuple[str, ...]) -> set:
+    modules = dict(model.named_modules())
+    spec = set()
+    for name, module in modules.items():
+        parent_name, _, leaf = name.rpartition(".")
+        if not isinstance(module, nn.Linear) or leaf not in names:
+            continue
+        parent = modules[parent_name]
+        # the eva_vit (blip2) attention reads qkv.weight and adds its q / v biases through
+        # F.linear, which a packed quantized module does not support
+        if leaf == "qkv" and hasattr(parent, "q_bias"):
+            continue
+        # BertPooler.dense feeds the classification head, which stays in float
+        if parent_name.split(".")[-1] == "pooler":
+            continue
+        spec.add(name)
+    return spec
+
+
+def quantize_dynamic(
+    model: nn.Module,
+    names: Tuple[str, ...] = QUANT_LINEARS,
+    dtype: torch.dtype = torch.qint8,
+    inplace: bool = False,
+) -> nn.Module:
+    """
+    Dynamic int8 quantization of the Linear layers of a (patched) model whose name is in names.
+    The weights are int8, the activations are quantized on the fly per batch and the layers
+    return float tensors, so the token merging (metric, energy, size weighted averages) stays
+    in float. The patch embedding, the pooler and heads, and the qkv of the eva_vit (blip2)
+    attention, which reads qkv.weight directly, are left in float.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, _quantizable(model, names), dtype=dtype, inplace=inplace)
+
+
+def _call(model: nn.Module, inputs):
+    if isinstance(inputs, dict):
+        out = model(**inputs)
+    elif isinstance(inputs, (tuple, list)):
+        out = model(*inputs)
+    else:
+        out = model(inputs)
+    # patched vision models return (logits, flops), transformers models an output with logits
+    if hasattr(out, "logits"):
+        return out.logits
+    while isinstance(out, (tuple, list)):
+        out = out[0]
+    return out
+
+
+def benchmark_quantized(
+    model: nn.Module,
+    data: Iterable,
+    ratios: Tuple[float, ...] = (1.0, 0.9),
+    set_ratio: Callable[[nn.Module, float], None] = None,
+    runs: int = 1,
+) -> List[dict]:
+    """
+    CPU throughput and top-1 accuracy of a patched model in float and with quantize_dynamic,
+    for every ratio, on a small eval set.
+
+    Args:
+     - model: the patched float model, left untouched (the int8 model is a copy)
+     - data: (inputs, labels) batches, inputs being a tensor, a tuple or a dict of kwargs
+     - set_ratio: set_ratio(model, ratio), model.ratio = ratio by default
+     - runs: the number of passes over data to time
+    Returns one row per precision and ratio with its "throughput" (samples / second),
+    "acc1" and the "speedup" over float at ratio 1.0.
+    """
+    data = list(data)
+    set_ratio = set_ratio if set_ratio is not None else lambda m, r: setattr(m, "ratio", r)
+    models = {"float": model.eval(), "int8": quantize_dynamic(model).eval()}
+    rows = []
+    with torch.no_grad():
+        for precision, m in models.items():
+            for ratio in ratios:
+                set_ratio(m, ratio)
+                _call(m, data[0][0])  # warm up
+                correct = total = 0
+                start = time.perf_counter()
+                for _ in range(runs):
+                    for inputs, labels in data:
+                        pred = _call(m, inputs).argmax(dim=-1)
+                        correct += (pred == labels).sum().item()
+                        total += labels.shape[0]
+                elapsed = time.perf_counter() - start
+                rows.append({
+                    "precision": precision,
+                    "ratio": ratio,
+                    "throughput": total / elapsed,
+                    "acc1": 100.0 * correct / total,
+                })
+    base = rows[0]["throughput"]
+    for row in rows:
+        row["speedup"] = row["throughput"] / base
+    return rows
@@ -0,0 +1,43 @@
+import torch
+
+
+def call_info(info: dict, state: dict, **kwargs) -> dict:
+    """
+    The _info of one forward call of a patched model: a plain dict with the patch configuration
+    of info and the per-forward merge state (token size, sources, the schedule of the call, ...)
+    reset to state, then kwargs.
+
+    The model builds it at the start of its forward and passes it down to its blocks, so that
+    concurrent forward calls from several threads never share their state. Being a plain dict
+    built inside the forward, torch.compile traces it without graph breaks.
+    """
+    return {**info, **state, **kwargs}
+
+
+# the per-forward state a caller may read back from model._info after a forward; never the
+# configuration (e.g. tome's ratio) nor the intermediate merge state of the call
+READOUT = ("size", "source", "total_flop", "plan_reused")
+
+
+def publish(info: dict, call: dict, keys=READOUT):
+    """
+    Copies the read-out state (the keys of keys) of a finished call back to the shared info,
+    e.g. for model._info["source"] after a forward. With concurrent calls this is the state of
+    any of them: pass an info= of your own to the forward to read the one of your call.
+    """
+    info.update({key: call[key] for key in keys if key in call})
+
+
+def forward_head(model, x):
+    """
+    The head of timm's VisionTransformer.forward, run on the output of forward_features
+    (forward_head in newer timm versions).
+    """
+    if hasattr(model, "forward_head"):
+        return model.forward_head(x)
+    if getattr(model, "head_dist", None) is not None:
+        x, x_dist = model.head(x[0]), model.head_dist(x[1])  # x must be a tuple
+        if model.training and not torch.jit.is_scripting():
+            return x, x_dist
+        return (x + x_dist) / 2
+    return model.head(x)
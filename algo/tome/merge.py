@@ -9,6 +9,7 @@ import math
 from typing import Callable, Tuple
 import torch
 import torch.nn.functional as F
+from ..plan import bipartite_plan
 
 
 def do_nothing(x, mode=None):
@@ -19,6 +20,7 @@ def bipartite_soft_matching(
     metric: torch.Tensor,
     ratio:float=1.0,    
     class_token: bool = False,
+    return_plan: bool = False,
 ) -> Tuple[Callable, Callable]:
     
     protected = 0
@@ -54,6 +56,9 @@ def bipartite_soft_matching(
         if class_token:
             unm_idx = unm_idx.sort(dim=1)[0]
 
+    if return_plan:
+        return bipartite_plan(unm_idx, src_idx, dst_idx, T)
+
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         if len(x.shape) == 2:
             x.unsqueeze_(0)
@@ -3,7 +3,9 @@ from typing import Tuple
 import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 # from timm.models.helpers import checkpoint_seq 
-from .timm import ToMeBlock, ToMeBlock, ToMeAttention 
+from ...plan import RaggedBatch, per_sample
+from ...state import call_info, forward_head, publish
+from .timm import ToMeBlock, ToMeBlock, ToMeAttention, CALL_STATE
 
 def make_tome_class(transformer_class):
     class ToMeVisionTransformer(transformer_class):
@@ -12,21 +14,19 @@ def make_tome_class(transformer_class):
         - Initialize r, token size, and token sources.
         """
 
-        def forward(self, x, return_flop=True) -> torch.Tensor:
-
-            self._info["ratio"] = [self.ratio] * len(self.blocks) 
-            self._info["size"] = None
-            self._info["source"] = None
-            self.total_flop = 0
-
-            x = super().forward(x)
+        def forward(self, x, return_flop=True, info=None) -> torch.Tensor:
+            # pass info=call_info(...) to read the size / source of this call afterwards
+            info = call_info(self._info, CALL_STATE, ratio=[self.ratio] * len(self.blocks)) if info is None else info
+            x = forward_head(self, self.forward_features(x, info))
+            publish(self._info, info)
             if return_flop:
-                return x, self.total_flop
+                return x, info["total_flop"]
             else:
                 return x
 
 
-        def forward_features(self, x):
+        def forward_features(self, x, info=None):
+            info = call_info(self._info, CALL_STATE, ratio=[self.ratio] * len(self.blocks)) if info is None else info
             x = self.patch_embed(x)
             cls_token = self.cls_token.expand(x.shape[0], -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
             if self.dist_token is None:
@@ -34,9 +34,10 @@ def make_tome_class(transformer_class):
             else:
                 x = torch.cat((cls_token, self.dist_token.expand(x.shape[0], -1, -1), x), dim=1)
             x = self.pos_drop(x + self.pos_embed)
+            info["ragged"] = RaggedBatch(self.ratio, x.shape[1], device=x.device, batch_size=x.shape[0]) if per_sample(self.ratio) else None
             for block in self.blocks:
-                self.total_flop += self.calculate_block_flop(x.shape) 
-                x = block(x)
+                info["total_flop"] += self.calculate_block_flop(x.shape) 
+                x = block(x, info)
             x = self.norm(x)
             if self.dist_token is None:
                 return self.pre_logits(x[:, 0])
@@ -64,7 +65,8 @@ def apply_patch(
     Applies ToMe to this transformer. Afterward, set r using model.r.
 
     If you want to know the source of each token (e.g., for visualization), set trace_source = true.
-    The sources will be available at model._info["source"] afterward.
+    The sources will be available at model._info["source"] afterward, as a compact TokenSource
+    (see TokenSource.to_dense for the adjacency matrix).
 
     For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
     the shelf. For trianing and for evaluating MAE models off the self set this to be False.
@@ -82,9 +84,11 @@ def apply_patch(
         "size": None,
         "source": None,
         "trace_source": trace_source,
+        "ragged": None,
         "prop_attn": prop_attn,
         "class_token": True,
         "distill_token": False,
+        "total_flop": 0,
     }
 
     if hasattr(model, "dist_token") and model.dist_token is not None:
@@ -14,7 +14,9 @@ import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 
 
-from .timm import ToMeAttention, ToMeBlock, ToMeBlock
+from ...plan import RaggedBatch, per_sample
+from ...state import call_info, forward_head, publish
+from .timm import ToMeAttention, ToMeBlock, ToMeBlock, CALL_STATE
 
 
 def make_tome_class(transformer_class):
@@ -25,18 +27,18 @@ def make_tome_class(transformer_class):
         - For MAE: make global average pooling proportional to token size
         """
 
-        def forward(self, x, return_flop=True) -> torch.Tensor:
-            self._info["ratio"] = [self.ratio] * len(self.blocks) 
-            self._info["size"] = None
-            self._info["source"] = None
-            self.total_flop = 0
-            x = super().forward(x)
+        def forward(self, x, return_flop=True, info=None) -> torch.Tensor:
+            # pass info=call_info(...) to read the size / source of this call afterwards
+            info = call_info(self._info, CALL_STATE, ratio=[self.ratio] * len(self.blocks)) if info is None else info
+            x = forward_head(self, self.forward_features(x, info))
+            publish(self._info, info)
             if return_flop:
-                return x, self.calculate_flop()
+                return x, info["total_flop"]
             else:
                 return x
 
-        def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        def forward_features(self, x: torch.Tensor, info: dict = None) -> torch.Tensor:
+            info = call_info(self._info, CALL_STATE, ratio=[self.ratio] * len(self.blocks)) if info is None else info
             # From the MAE implementation
             B = x.shape[0]
             x = self.patch_embed(x)
@@ -48,15 +50,16 @@ def make_tome_class(transformer_class):
             x = x + self.pos_embed
             x = self.pos_drop(x)
 
+            info["ragged"] = RaggedBatch(self.ratio, x.shape[1], device=x.device, batch_size=x.shape[0]) if per_sample(self.ratio) else None
             for blk in self.blocks:
-                self.total_flop += self.calculate_block_flop(x.shape) 
-                x = blk(x)
+                info["total_flop"] += self.calculate_block_flop(x.shape) 
+                x = blk(x, info)
 
             if self.global_pool:
                 # ---- ToMe changes this ----
                 # Global average pool proportional to token size
-                if self._info["size"] is not None:
-                    x = (x * self._info["size"])[:, 1:, :].sum(dim=1) / T
+                if info["size"] is not None:
+                    x = (x * info["size"])[:, 1:, :].sum(dim=1) / T
                 else:
                     x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
                 # ---- End of change ----
@@ -86,7 +89,7 @@ def make_tome_class(transformer_class):
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
             flops += patch_embedding_flops
-            flops += self.total_flop 
+            flops += self._info["total_flop"] 
             flops += classifier_flops
             return flops
         
@@ -108,9 +111,11 @@ def apply_patch(
         "size": None,
         "source": None,
         "trace_source": trace_source,
+        "ragged": None,
         "prop_attn": prop_attn,
         "class_token": False,
         "distill_token": False,
+        "total_flop": 0,
     }
 
     if hasattr(model, "dist_token") and model.dist_token is not None:
@@ -18,6 +18,9 @@ from copy import copy
 from ..merge import bipartite_soft_matching, merge_source, merge_wavg
 
 
+# per-forward state of the patched models, reset at every call (see call_info)
+CALL_STATE = {"ratio": None, "size": None, "source": None, "ragged": None, "total_flop": 0}
+
 
 class ToMeBlock(Block):
     """
@@ -32,24 +35,41 @@ class ToMeBlock(Block):
     def _drop_path2(self, x):
         return self.drop_path2(x) if hasattr(self, "drop_path2") else self.drop_path(x)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        attn_size = self._info["size"] if self._info["prop_attn"] else None
+    def forward(self, x: torch.Tensor, info: dict = None) -> torch.Tensor:
+        # info: the per-call state passed down by the model (see call_info)
+        info = self._info if info is None else info
+        ragged = info["ragged"]
+        attn_size = info["size"] if info["prop_attn"] else None
+        if attn_size is None and ragged is not None and ragged.padded(x.shape[1]):
+            # padding tokens have size 0, log(0) masks them out as keys
+            attn_size = info["size"].clamp(max=1)
         x_attn, metric = self.attn(self.norm1(x), attn_size)
         x = x + self._drop_path1(x_attn)
 
-        ratio = self._info["ratio"].pop(0)
-        if ratio < 1.0:
-            merge, _ = bipartite_soft_matching(
+        ratio = info["ratio"].pop(0)
+        if ragged is not None:
+            # one ratio per sample: every group of samples merges its own real tokens
+            x, info["size"], info["source"] = ragged.merge(
+                x, info["size"], metric,
+                lambda group, metric: bipartite_soft_matching(
+                    metric=metric,
+                    ratio=group["ratio"],
+                    class_token=info["class_token"],
+                    return_plan=True,
+                ),
+                source=info["source"],
+                trace_source=info["trace_source"],
+            )
+        elif ratio < 1.0:
+            plan = bipartite_soft_matching(
                 metric=metric,
                 ratio=ratio,
-                class_token=self._info["class_token"],
+                class_token=info["class_token"],
+                return_plan=True,
+            )
+            x, info["size"], info["source"] = plan.merge_wavg(
+                x, info["size"], info["source"], trace_source=info["trace_source"]
             )
-
-            if self._info["trace_source"]:
-                self._info["source"] = merge_source(
-                    merge, x, self._info["source"]
-                )
-            x, self._info["size"] = merge_wavg(merge, x, self._info["size"])
 
         x = x + self._drop_path2(self.mlp(self.norm2(x)))
         return x
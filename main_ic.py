@@ -36,6 +36,7 @@ from algo import (
     tofu,
     DiffRate
 )
+from algo.controller import LatencyController
 import os
 from accelerate import Accelerator
 from torch.utils.data import DataLoader
@@ -106,6 +107,8 @@ def get_args_parser():
     parser.add_argument('--batch-size', default=100, type=int)
     parser.add_argument('--epochs', default=10, type=int)
     parser.add_argument('--ratio', default=0.9125, type=float)
+    parser.add_argument('--latency_target', default=None, type=float,
+                        help='eval only: adjust the ratio between batches to hold this p95 latency (ms), --ratio is the lower bound')
     parser.add_argument('--reduced_token', default=8, type=int)
     parser.add_argument('--algo', default=PITOME) 
 
@@ -245,7 +248,8 @@ def get_args_parser():
 
     parser.add_argument('--target_flops', type=float, default=3.0)
     parser.add_argument('--granularity', type=int, default=4, help='the token number gap between each compression rate candidate')
-    parser.add_argument('--load_compression_rate', action='store_true', help='eval by exiting compression rate in compression_rate.json')
+    parser.add_argument('--load_compression_rate', nargs='?', default='', const='compression_rate.json',
+                        help='run DiffRate with the fixed compression rate exported to this json (default: compression_rate.json)')
     parser.add_argument('--warmup_compression_rate', action='store_true', default=False, help='inactive computational constraint in first epoch')
     return parser
 
@@ -262,13 +266,15 @@ def get_model(model, args):
 
 
 def get_diffrate_model(model, args):
+    kept_num = args.load_compression_rate or None
     if 'deit' in model_dict[args.model]:
-        DiffRate.patch.deit(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
+        DiffRate.patch.deit(model, prune_granularity=args.granularity, merge_granularity=args.granularity, kept_num=kept_num)
     elif 'mae' in model_dict[args.model]:
-        DiffRate.patch.mae(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
+        DiffRate.patch.mae(model, prune_granularity=args.granularity, merge_granularity=args.granularity, kept_num=kept_num)
     else:
         raise ValueError("only support deit, mae and caformer in this codebase")
-    model.init_kept_num_using_ratio(args.ratio)
+    if kept_num is None:
+        model.init_kept_num_using_ratio(args.ratio)
             
 
 def main(args):
@@ -393,6 +399,12 @@ def main(args):
         checkpoint_model['pos_embed'] = new_pos_embed
         model.load_state_dict(checkpoint_model, strict=False)
 
+    if args.eval and args.latency_target is not None and args.algo not in [DIFFRATE, NONE]:
+        # the ratio of every batch is logged to ratio_log.jsonl
+        model = LatencyController(
+            model, args.latency_target, min_ratio=args.ratio,
+            log_path=os.path.join(args.output_dir, 'ratio_log.jsonl'),
+        )
     
     model = accelerator.prepare(model)
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
@@ -476,6 +488,11 @@ def main(args):
                     'epoch': epoch,
                     'args': args,
                 }, checkpoint_path)
+            if args.algo == DIFFRATE and not args.load_compression_rate and accelerator.is_main_process:
+                DiffRate.utils.save_kept_num(
+                    accelerator.unwrap_model(model), output_dir / 'compression_rate.json',
+                    model_name=args.model, target_flops=args.target_flops, epoch=epoch,
+                )
 
         test_stats = evaluate(data_loader_val, model, accelerator)
         # lr_scheduler.step(test_stats['acc1'])
@@ -0,0 +1,33 @@
+import torch
+from transformers import CLIPVisionConfig, CLIPVisionModel
+
+from algo import pitome
+
+
+def _clip():
+    torch.manual_seed(0)
+    config = CLIPVisionConfig(hidden_size=64, intermediate_size=128, num_hidden_layers=4, num_attention_heads=4, image_size=64, patch_size=8)
+    return CLIPVisionModel(config).eval()
+
+
+def test_key_metric_is_returned_by_the_attention():
+    model = _clip()
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        expected = model(x).last_hidden_state
+    encoder = model.vision_model.encoder
+    pitome.patch.clip_hf(encoder, metric="key")
+    layer = encoder.layers[0]
+    hidden = torch.randn(2, 65, 64)
+    with torch.no_grad():
+        # without merging the patched layers match the original ones
+        torch.testing.assert_close(model(x).last_hidden_state, expected)
+        outputs = layer(hidden, None, None)
+        key = layer.self_attn.k_proj(layer.layer_norm1(hidden)).view(2, 65, 4, -1).mean(2)
+    torch.testing.assert_close(encoder.layer_metric(outputs[0], outputs), key)
+    encoder.ratio = 0.8
+    with torch.no_grad():
+        out = model(x).last_hidden_state
+    assert out.shape[1] < 65
+    # the key travels with the layer outputs, nothing is left on the shared info
+    assert "key" not in encoder._info
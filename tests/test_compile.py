@@ -0,0 +1,25 @@
+import timm
+import torch
+from transformers import BertConfig, BertModel
+
+from algo import pitome
+from algo.pitome.utils import graph_breaks
+
+
+def test_deit_static_has_no_graph_breaks():
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False).eval()
+    pitome.patch.deit(model, static_ratio=0.9)
+    count, reasons = graph_breaks(model, torch.randn(2, 3, 224, 224))
+    assert count == 0, reasons
+
+
+def test_bert_static_has_no_graph_breaks():
+    config = BertConfig(num_hidden_layers=4, hidden_size=64, num_attention_heads=4, intermediate_size=128)
+    model = BertModel(config).eval()
+    pitome.patch.bert(model.encoder, static_ratio=0.8, seq_len=40)
+    ids = torch.randint(0, config.vocab_size, (2, 40))
+    mask = model.get_extended_attention_mask(torch.ones_like(ids), ids.shape)
+    with torch.no_grad():
+        hidden_states = model.embeddings(ids)
+    count, reasons = graph_breaks(model.encoder, hidden_states, attention_mask=mask)
+    assert count == 0, reasons
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+import torch.nn as nn
+
+from algo.controller import LatencyController
+
+
+def _controller(**kwargs):
+    model = nn.Identity()
+    model.ratio = None
+    kwargs = {"target_ms": 10.0, "min_ratio": 0.5, "max_ratio": 1.0, "step": 0.1, "hysteresis": 0.1, "window": 3, **kwargs}
+    return model, LatencyController(model, **kwargs)
+
+
+def _drive(controller, latencies):
+    return [controller.update(latency) for latency in latencies]
+
+
+def test_ratio_trajectory():
+    model, controller = _controller()
+    assert model.ratio == 1.0
+    # slow: one step down per full window, the latencies are reset after every change
+    assert _drive(controller, [20] * 6) == pytest.approx([1.0, 1.0, 0.9, 0.9, 0.9, 0.8])
+    # inside the hysteresis band [9, 11] the ratio is kept
+    assert _drive(controller, [10.5, 9.5, 10] * 2) == pytest.approx([0.8] * 6)
+    # the window rolls over the batches in the band, so the first slow one already lowers the
+    # ratio; then clamped at min_ratio
+    assert _drive(controller, [20] * 12) == pytest.approx([0.7, 0.7, 0.7, 0.6, 0.6, 0.6, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5])
+    # fast: back up, the window still holds the slow batches run at min_ratio
+    assert _drive(controller, [1] * 3) == pytest.approx([0.5, 0.5, 0.6])
+    assert _drive(controller, [1] * 15) == pytest.approx([0.6, 0.6, 0.7, 0.7, 0.7, 0.8, 0.8, 0.8, 0.9, 0.9, 0.9, 1.0, 1.0, 1.0, 1.0])
+    assert model.ratio == 1.0
+
+
+def test_quantile_of_the_window():
+    # one slow batch out of three: its p95 is above the target, its median is below
+    _, p95 = _controller()
+    _, median = _controller(quantile=0.5, ratio=0.8)
+    assert _drive(p95, [5, 5, 50])[-1] == pytest.approx(0.9)
+    assert _drive(median, [5, 5, 50])[-1] == pytest.approx(0.9)
+    assert p95.log[-1]["quantile_ms"] == pytest.approx(45.5)
+    assert median.log[-1]["quantile_ms"] == pytest.approx(5.0)
+
+
+def test_log_file_is_opened_once(tmp_path):
+    path = tmp_path / "ratios.jsonl"
+    _, controller = _controller(log_path=str(path))
+    _drive(controller, [20] * 2)
+    log_file = controller._log_file
+    _drive(controller, [20] * 2)
+    assert controller._log_file is log_file
+    controller.close()
+    assert log_file.closed and controller._log_file is None
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [entry["ratio"] for entry in entries] == pytest.approx([1.0, 1.0, 1.0, 0.9])
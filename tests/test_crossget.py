@@ -0,0 +1,55 @@
+import torch
+import torch.nn.functional as F
+
+from algo.crossget.merge import crossget
+
+
+def _masked_similarity(metric):
+    # the dense reference: a row may only match the columns ranked after it
+    metric = F.normalize(metric, p=2, dim=-1)
+    B, T, _ = metric.shape
+    D = metric @ metric.transpose(-1, -2) - torch.eye(T)
+    row_rank = D.amax(dim=-1).argsort(dim=-1, descending=True).argsort(dim=-1)
+    col_rank = D.amax(dim=-2).argsort(dim=-1, descending=True).argsort(dim=-1)
+    return D.masked_fill(col_rank[:, None, :] <= row_rank[:, :, None], -1e9)
+
+
+def _reference_legacy(metric, ratio):
+    # the doubly permuted formulation crossget started from
+    metric = F.normalize(metric, p=2, dim=-1)
+    B, T, _ = metric.shape
+    r = int(T - T * ratio)
+    D = metric @ metric.transpose(-1, -2) - torch.eye(T)[None, ...]
+    A_s = torch.argsort(torch.max(D, dim=-1, keepdim=True)[0], dim=-2, descending=True)
+    A_d = torch.argsort(torch.max(D, dim=-2, keepdim=True)[0], dim=-1, descending=True)
+    D = D.gather(dim=-2, index=A_s.expand(B, T, T)).gather(dim=-1, index=A_d.expand(B, T, T))
+    D = D - 1e9 * torch.tril(torch.ones_like(D))
+    A = torch.argsort(torch.max(D, dim=-1)[0], dim=-1, descending=True)[..., None]
+    src_idx = A[..., :r, :]
+    scores = D.gather(dim=-1, index=src_idx.expand(B, r, D.shape[-1]))
+    return A[..., r:, 0], src_idx[..., 0], scores.argmax(dim=-1)
+
+
+def test_sources_merge_into_their_most_similar_kept_token():
+    torch.manual_seed(0)
+    metric = torch.randn(4, 50, 16)
+    plan = crossget(metric, ratio=0.7, return_plan=True, chunk_size=16)
+    D = _masked_similarity(metric)
+    src_idx = D.amax(dim=-1).argsort(dim=-1, descending=True)[:, :15]
+    kept = torch.ones(4, 50, dtype=torch.bool).scatter_(1, src_idx, False)
+    dst = D.masked_fill(~kept[:, None, :], -torch.inf).argmax(dim=-1)
+    # every source ends up in the output token of its dst, every kept token in its own
+    group = plan.group_idx
+    assert (group.gather(1, src_idx) == group.gather(1, dst.gather(1, src_idx))).all()
+    assert len(set(group.gather(1, src_idx).flatten().tolist())) > 1
+    assert plan.num_out == 35
+
+
+def test_legacy_matches_the_permuted_formulation():
+    torch.manual_seed(0)
+    metric = torch.randn(4, 50, 16)
+    unm_idx, src_idx, dst_idx = _reference_legacy(metric, 0.7)
+    plan = crossget(metric, ratio=0.7, return_plan=True, chunk_size=16, legacy=True)
+    group = plan.group_idx
+    assert (group.gather(1, unm_idx) == torch.arange(35)).all()
+    assert (group.gather(1, src_idx) == dst_idx).all()
@@ -0,0 +1,44 @@
+import math
+
+import pytest
+import torch
+
+from algo.dct import merge
+from algo.dct.merge import MAX_BASIS_TOKENS, dc_transform, dct, idct
+
+
+def _reference(x, ratio):
+    # the FFT path: truncated orthonormal DCT of the tokens, back to the token domain
+    x_cls, x = x[:, :1], x[:, 1:]
+    keep = math.ceil(x.shape[1] * ratio)
+    x_dct = dct(x.double().transpose(1, 2), norm="ortho")[..., :keep]
+    return torch.cat([x_cls.double(), idct(x_dct, norm="ortho").transpose(1, 2)], dim=1)
+
+
+# T counts the class token: MAX_BASIS_TOKENS + 1 is the last basis size, + 2 the first FFT one
+@pytest.mark.parametrize("T", [50, 197, MAX_BASIS_TOKENS + 1, MAX_BASIS_TOKENS + 2, MAX_BASIS_TOKENS + 77])
+def test_basis_matches_the_fft_path(T):
+    torch.manual_seed(0)
+    x = torch.randn(2, T, 8)
+    out = dc_transform(x, ratio=0.7)
+    assert out.shape == (2, math.ceil((T - 1) * 0.7) + 1, 8)
+    torch.testing.assert_close(out.double(), _reference(x, 0.7), atol=1e-5, rtol=1e-5)
+
+
+def test_both_paths_agree(monkeypatch):
+    torch.manual_seed(0)
+    x = torch.randn(2, 197, 8)
+    basis = dc_transform(x, ratio=0.5)
+    monkeypatch.setattr(merge, "MAX_BASIS_TOKENS", 0)
+    torch.testing.assert_close(basis, dc_transform(x, ratio=0.5), atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("T", [197, MAX_BASIS_TOKENS + 2])
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16, torch.float32, torch.float64])
+def test_output_dtype_follows_the_input(T, dtype):
+    torch.manual_seed(0)
+    x = torch.randn(2, T, 8).to(dtype)
+    out = dc_transform(x, ratio=0.5)
+    assert out.dtype == dtype
+    tol = {torch.float16: 1e-2, torch.bfloat16: 5e-2}.get(dtype, 1e-5)
+    torch.testing.assert_close(out.double(), _reference(x, 0.5), atol=tol, rtol=tol)
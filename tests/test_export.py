@@ -0,0 +1,64 @@
+from functools import partial
+
+import pytest
+import timm
+import torch
+import torch.nn as nn
+from transformers import BertConfig, BertForSequenceClassification
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from algo import pitome
+from algo.pitome.export import export_onnx, onnx_parity
+from tasks.ic.models_mae import VisionTransformer as MAEVisionTransformer
+
+
+# small inputs: few tokens per sample keep the energies of random weights far apart, so the
+# ranking does not flip between onnxruntime and PyTorch on rounding differences
+
+def _deit():
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False, img_size=64).eval()
+    pitome.patch.deit(model)
+    return model, model, model.blocks
+
+
+def _mae():
+    model = MAEVisionTransformer(
+        img_size=64, patch_size=16, embed_dim=192, depth=4, num_heads=3, norm_layer=partial(nn.LayerNorm, eps=1e-6)
+    ).eval()
+    pitome.patch.mae(model)
+    return model, model, model.blocks
+
+
+def _bert():
+    model = BertForSequenceClassification(BertConfig(num_hidden_layers=2)).eval()
+    pitome.patch.bert(model.bert.encoder)
+    return model, model.bert.encoder, model.bert.encoder.layer
+
+
+def _images(batch_size):
+    return torch.randn(batch_size, 3, 64, 64)
+
+
+def _text(batch_size):
+    return torch.randint(1000, 2000, (batch_size, 32)), torch.ones(batch_size, 32, dtype=torch.long)
+
+
+@pytest.mark.parametrize("build, inputs, ratio", [
+    (_deit, _images, 0.8),
+    (_mae, _images, 0.8),
+    (_bert, _text, 0.8),
+])
+def test_onnx_parity(build, inputs, ratio, tmp_path):
+    torch.manual_seed(0)
+    model, patched, blocks = build()
+    # with margin -1 the elu never saturates: random weights would otherwise give many exactly
+    # equal energies, whose order onnxruntime's TopK may break differently
+    for block in blocks:
+        block.margin = -1.0
+    path = export_onnx(model, str(tmp_path / "model.onnx"), inputs(2), ratio=ratio)
+    # the batch size stays dynamic
+    assert onnx_parity(model, path, inputs(4), ratio=ratio) < 1e-4
+    # the schedule fixed for the export is reset afterwards
+    assert patched.token_schedule is None
@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from algo.mctf.merge import bipartite_soft_matching, merge_wavg
+from algo.mctf.utils import benchmark_one_step_ahead
+
+
+def _inputs(B=4, H=6, T=197, C=32):
+    torch.manual_seed(0)
+    metric = torch.randn(B, T, C)
+    attn = torch.randn(B, H, T, T).softmax(dim=-1)
+    return metric, attn
+
+
+@pytest.mark.parametrize("head_chunk", [1, 4, 6])
+def test_head_chunks_match_all_heads(head_chunk):
+    metric, attn = _inputs()
+    merge = bipartite_soft_matching(metric, class_token=True, ratio=0.9, attn=attn, tau_info=20)
+    _, _, reference = merge_wavg(merge, metric, attn, one_step_ahead=1, head_chunk=attn.shape[1])
+    _, _, chunked = merge_wavg(merge, metric, attn, one_step_ahead=1, head_chunk=head_chunk)
+    assert chunked.shape == (4, 6, 178, 178)
+    torch.testing.assert_close(chunked, reference)
+
+
+def test_benchmark_chunked_error():
+    torch.manual_seed(0)
+    results = benchmark_one_step_ahead(batch_size=2, num_tokens=65, head_chunk=2)
+    assert results["chunked_max_abs_err"] < 1e-6
+    assert results["head_average_rel_err"] > results["chunked_rel_err"]
+
+
+def test_head_average_is_exact_for_the_head_mean():
+    metric, attn = _inputs()
+    merge = bipartite_soft_matching(metric, class_token=True, ratio=0.9, attn=attn, tau_info=20)
+    _, _, reference = merge_wavg(merge, metric, attn, one_step_ahead=1, head_chunk=attn.shape[1])
+    _, _, average = merge_wavg(merge, metric, attn, one_step_ahead=1, head_average=True)
+    assert average.shape == reference.shape
+    torch.testing.assert_close(average[:, 0], reference.mean(dim=1))
+
+
+@pytest.mark.parametrize("bidirection", [True, False])
+def test_plan_matches_the_closure(bidirection):
+    metric, attn = _inputs()
+    size = torch.rand(4, 197, 1) + 0.5
+    kwargs = dict(class_token=True, ratio=0.8, attn=attn, size=size, tau_info=20, bidirection=bidirection)
+    merge = bipartite_soft_matching(metric, **kwargs)
+    plan = bipartite_soft_matching(metric, return_plan=True, **kwargs)
+    assert plan.num_out == 197 - int(197 - 197 * 0.8)
+    torch.testing.assert_close(plan.merge(metric, mode="sum"), merge(metric, mode="sum"))
+    torch.testing.assert_close(plan.merge(size, mode="sum"), merge(size, mode="sum"))
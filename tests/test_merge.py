@@ -0,0 +1,105 @@
+import timm
+import torch
+import torch.nn.functional as F
+
+from algo import pitome
+from algo.pitome.merge import grid_positions, lsh_energy_score, pitome_text, pitome_window, simhash
+from algo.pitome.patch.timm import CALL_STATE
+from algo.state import call_info
+
+
+def _exact_energy(metric, sigma, neighbours):
+    # the gaussian kernel energy over the given (B, T, T) neighbourhood
+    sim = metric @ metric.transpose(-1, -2)
+    kernel = torch.exp(-(((1 - sim) / sigma) ** 2 * 0.5)) * neighbours
+    return kernel.sum(-1) / metric.shape[1] / (sigma * (2 * torch.pi) ** 0.5)
+
+
+def test_lsh_energy_does_not_wrap_around():
+    torch.manual_seed(0)
+    metric = F.normalize(torch.randn(2, 96, 16), dim=-1)
+    codes = simhash(metric, n_bits=8)
+    window, sigma = 32, 0.5
+    # the neighbourhood of every token: its own and the previous chunk in hash code order
+    chunk = torch.empty_like(codes)
+    chunk.scatter_(-1, codes.argsort(-1), torch.arange(96).div(window, rounding_mode="floor").expand(2, -1))
+    diff = chunk[:, :, None] - chunk[:, None, :]
+    neighbours = ((diff == 0) | (diff == 1)).float()
+    energy = lsh_energy_score(metric, codes, sigma, window=window)
+    torch.testing.assert_close(energy, _exact_energy(metric, sigma, neighbours))
+
+
+def test_lsh_never_merges_into_padding():
+    torch.manual_seed(0)
+    B, T = 4, 128
+    metric = torch.randn(B, T, 16)
+    lengths = torch.tensor([128, 90, 70, 66])
+    attention_mask = (torch.arange(T)[None] < lengths[:, None]).long()
+    for backend in ("exact", "lsh"):
+        plan = pitome_text(metric, ratio=0.5, backend=backend, window=8, attention_mask=attention_mask, return_plan=True)
+        # a merged group never mixes real and padding tokens
+        real = plan.merge(attention_mask[..., None].float(), mode="mean")[..., 0]
+        assert ((real == 0) | (real == 1)).all(), backend
+
+
+def test_window_keeps_every_prefix_token():
+    torch.manual_seed(0)
+    pos = grid_positions(2, 4, 4, prefix_tokens=2)
+    # the patch tokens start after the class and distill token
+    assert pos.shape == (2, 18, 2) and (pos[:, 2] == 0).all() and (pos[:, 3] == torch.tensor([0., 1.])).all()
+    metric = torch.randn(2, 18, 16)
+    plan = pitome_window(metric, pos, window_size=2, prefix_tokens=2, return_plan=True, r=4)
+    x = torch.randn(2, 18, 8)
+    out = plan.merge(x)
+    assert out.shape == (2, 14, 8)
+    torch.testing.assert_close(out[:, :2], x[:, :2])
+
+
+def test_windowed_distilled_deit():
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_distilled_patch16_224", pretrained=False, img_size=64).eval()
+    pitome.patch.deit(model, window_size=2)
+    model.ratio = 0.9
+    assert model._info["prefix_tokens"] == 2
+    with torch.no_grad():
+        out, _ = model(torch.randn(2, 3, 64, 64))
+    assert out.shape == (2, 1000)
+
+
+def test_reuse_energy_score_follows_the_drift_threshold():
+    torch.manual_seed(0)
+    metric = torch.randn(2, 65, 16)
+    fresh = pitome.merge.vision_energy_score(metric, margin=0.5, class_token=True)
+    plan = pitome.merge.pitome_vision(metric, r=8, margin=0.5, class_token=True, return_plan=True, energy_score=fresh)
+    merged = plan.merge(metric, mode="mean")
+    for threshold, reused in ((float("inf"), 1), (0.0, 0)):
+        info = {"energy": pitome.merge.merge_energy(plan, fresh, class_token=True), "drift_threshold": threshold, "plan_reused": 0}
+        score = pitome.merge.reuse_energy_score(info, merged, margin=0.5, class_token=True)
+        assert info["plan_reused"] == reused
+        assert (score is info["energy"]) == bool(reused)
+        assert score.shape == (2, 56)
+    # a score of another token count is never reused
+    info = {"energy": fresh, "drift_threshold": float("inf"), "plan_reused": 0}
+    assert pitome.merge.reuse_energy_score(info, merged, margin=0.5, class_token=True).shape == (2, 56)
+    assert info["plan_reused"] == 0
+
+
+def test_reuse_plan_counts_the_reused_layers():
+    x = torch.randn(2, 3, 64, 64)
+    outputs = {}
+    for threshold in (float("inf"), 0.0):
+        torch.manual_seed(0)
+        model = timm.create_model("deit_tiny_patch16_224", pretrained=False, img_size=64).eval()
+        pitome.patch.deit(model, reuse_plan=True, drift_threshold=threshold)
+        model.ratio = 0.9
+        info = call_info(model._info, CALL_STATE)
+        with torch.no_grad():
+            out, _ = model(x, info=info)
+        outputs[threshold] = (out, info)
+    merging = sum(r > 0 for r in outputs[0.0][1]["schedule"].r)
+    # inf: every merge after the first reuses the carried energy, 0: the ranking always moved
+    assert outputs[float("inf")][1]["plan_reused"] == merging - 1
+    assert outputs[0.0][1]["plan_reused"] == 0
+    assert model._info["plan_reused"] == 0
+    assert outputs[float("inf")][0].shape == outputs[0.0][0].shape == (2, 1000)
+    assert outputs[float("inf")][1]["size"].shape == outputs[0.0][1]["size"].shape
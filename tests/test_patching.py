@@ -0,0 +1,40 @@
+import timm
+import torch
+
+from algo.patching import get_patch, patched, sweep, unpatch
+
+
+def _deit():
+    torch.manual_seed(0)
+    return timm.create_model("deit_tiny_patch16_224", pretrained=False, img_size=64).eval()
+
+
+def test_unpatch_restores_the_model():
+    model = _deit()
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        expected = model(x)
+    classes = [type(m) for m in model.modules()]
+    get_patch("pitome", "deit")(model)
+    model.ratio = 0.8
+    with torch.no_grad():
+        model(x)
+    unpatch(model)
+    assert [type(m) for m in model.modules()] == classes
+    assert not hasattr(model, "_info") and not hasattr(model, "_patch_history")
+    with torch.no_grad():
+        assert torch.equal(model(x), expected)
+
+
+def test_sweep_swaps_algorithms_in_place():
+    model = _deit()
+    x = torch.randn(2, 3, 64, 64)
+    patches = {algo: get_patch(algo, "deit") for algo in ("pitome", "tome")}
+    rows = sweep(model, patches, [1.0, 0.8], lambda m: {"flop": m(x)[1]})
+    assert [(row["algo"], row["ratio"]) for row in rows] == [
+        ("pitome", 1.0), ("pitome", 0.8), ("tome", 1.0), ("tome", 0.8)
+    ]
+    assert rows[1]["flop"] < rows[0]["flop"] and rows[3]["flop"] < rows[2]["flop"]
+    with patched(model, get_patch("tome", "deit"), ratio=0.8):
+        assert type(model).__name__ == "ToMeVisionTransformer"
+    assert type(model) is type(_deit())
@@ -0,0 +1,46 @@
+import timm
+import torch
+import torch.nn as nn
+from torch.ao.nn.quantized.dynamic import Linear as QuantizedLinear
+from transformers import BertConfig, BertModel
+
+from algo import pitome
+from algo.quantize import quantize_dynamic
+
+
+class EvaAttention(nn.Module):
+    # the layout of the eva_vit attention: qkv.weight is read with separate q / v biases
+    def __init__(self, dim: int = 8):
+        super().__init__()
+        self.qkv = nn.Linear(dim, 3 * dim, bias=False)
+        self.q_bias = nn.Parameter(torch.zeros(dim))
+        self.v_bias = nn.Parameter(torch.zeros(dim))
+        self.proj = nn.Linear(dim, dim)
+
+
+def test_eva_qkv_stays_float():
+    model = quantize_dynamic(nn.Sequential(EvaAttention()))
+    assert type(model[0].qkv) is nn.Linear
+    assert isinstance(model[0].proj, QuantizedLinear)
+
+
+def test_bert_pooler_stays_float():
+    config = BertConfig(num_hidden_layers=1, hidden_size=32, num_attention_heads=2, intermediate_size=64)
+    model = quantize_dynamic(BertModel(config).eval())
+    layer = model.encoder.layer[0]
+    assert isinstance(layer.attention.self.query, QuantizedLinear)
+    assert isinstance(layer.attention.output.dense, QuantizedLinear)
+    assert isinstance(layer.intermediate.dense, QuantizedLinear)
+    assert type(model.pooler.dense) is nn.Linear
+
+
+def test_quantized_pitome_deit():
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False, img_size=64).eval()
+    pitome.patch.deit(model)
+    model.ratio = 0.8
+    quantized = quantize_dynamic(model)
+    assert isinstance(quantized.blocks[0].attn.qkv, QuantizedLinear)
+    assert type(quantized.head) is nn.Linear
+    with torch.no_grad():
+        out, _ = quantized(torch.randn(2, 3, 64, 64))
+    assert out.shape == (2, 1000) and torch.isfinite(out).all()
@@ -0,0 +1,98 @@
+import pytest
+import timm
+import torch
+from transformers import BertConfig, BertModel
+
+from algo import pitome, tome
+from algo.pitome.patch.timm import CALL_STATE
+from algo.plan import RaggedBatch
+from algo.state import call_info
+
+
+def _deit(apply_patch):
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False, img_size=64).eval()
+    apply_patch(model, trace_source=True)
+    for block in model.blocks:
+        # random weights: avoid the exact energy ties of pitome's margin
+        block.margin = -1.0
+    return model
+
+
+@pytest.mark.parametrize("apply_patch", [pitome.patch.deit, tome.patch.deit])
+def test_mixed_ratios_match_every_sample_alone(apply_patch):
+    model = _deit(apply_patch)
+    ratios = [1.0, 0.9, 0.7, 0.9]
+    x = torch.randn(len(ratios), 3, 64, 64)
+    with torch.no_grad():
+        model.ratio = ratios
+        out, _ = model(x)
+        size, source = model._info["size"], model._info["source"].to_dense()
+        for i, ratio in enumerate(ratios):
+            model.ratio = ratio
+            expected, _ = model(x[i:i + 1])
+            torch.testing.assert_close(out[i:i + 1], expected, atol=1e-5, rtol=1e-5)
+            if model._info["source"] is None:
+                # nothing merged
+                assert (size[i, :17] == 1).all()
+                torch.testing.assert_close(source[i, :17], torch.eye(17))
+                continue
+            tokens = model._info["size"].shape[1]
+            torch.testing.assert_close(size[i:i + 1, :tokens], model._info["size"])
+            # the padding tokens have no size and no source token
+            assert (size[i, tokens:] == 0).all()
+            torch.testing.assert_close(source[i:i + 1, :tokens], model._info["source"].to_dense())
+            assert (source[i, tokens:] == 0).all()
+
+
+@pytest.mark.parametrize("apply_patch", [pitome.patch.deit, tome.patch.deit])
+def test_ratio_count_must_match_batch_size(apply_patch):
+    model = _deit(apply_patch)
+    model.ratio = [0.9, 0.8, 0.7]
+    with pytest.raises(ValueError, match="3 per-sample ratios for a batch of 2"):
+        model(torch.randn(2, 3, 64, 64))
+
+
+def test_bert_ratio_count_must_match_batch_size():
+    model = BertModel(BertConfig(num_hidden_layers=2, hidden_size=64, num_attention_heads=4, intermediate_size=128)).eval()
+    pitome.patch.bert(model.encoder)
+    model.encoder.ratio = [0.9, 0.8, 0.7]
+    with pytest.raises(ValueError, match="3 per-sample ratios for a batch of 2"):
+        model(torch.randint(1000, 2000, (2, 16)), return_dict=False)
+
+
+def test_split_regroups_samples_with_the_same_tokens():
+    ragged = RaggedBatch([0.9, 0.9, 0.9], 10)
+    ragged.split([2, 1, 1], "r")
+    assert sorted(group["idx"].tolist() for group in ragged.groups) == [[0], [1, 2]]
+    for group in ragged.groups:
+        group["tokens"] -= group["r"]
+    ragged.split([0, 1, 1], "r")
+    for group in ragged.groups:
+        group["tokens"] -= group["r"]
+    # every sample has 8 tokens left and merges 1 more: one group again
+    ragged.split([1, 1, 1], "r")
+    assert [group["idx"].tolist() for group in ragged.groups] == [[0, 1, 2]]
+
+
+def test_threshold_mode_tokens_and_flops():
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False).eval()
+    pitome.patch.deit(model, threshold=0.5)
+    model.ratio = 0.9
+    # flat images are all redundant tokens and merge the whole budget, noise merges less
+    x = torch.cat([torch.zeros(2, 3, 224, 224), torch.randn(2, 3, 224, 224)])
+    info = call_info(model._info, CALL_STATE)
+    with torch.no_grad():
+        model(x, info=info)
+        alone = []
+        for i in range(x.shape[0]):
+            sample = call_info(model._info, CALL_STATE)
+            model(x[i:i + 1], info=sample)
+            alone.append(sample)
+    tokens = info["ragged"].tokens()
+    assert tokens == [sample["size"].shape[1] for sample in alone]
+    assert tokens[0] == tokens[1] < tokens[2]
+    # FLOPs per image: the mean of what every sample costs on its own
+    assert info["total_flop"] == pytest.approx(sum(sample["total_flop"] for sample in alone) / len(alone))
+    assert info["total_flop"] < model.calculate_block_flop((1, 197, 192)) * len(model.blocks)
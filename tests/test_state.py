@@ -0,0 +1,56 @@
+import pytest
+import timm
+import torch
+
+from algo import pitome, tome
+from algo.pitome.patch.timm import CALL_STATE
+from algo.pitome.utils import stress_test
+from algo.state import call_info
+
+
+def _deit():
+    torch.manual_seed(0)
+    return timm.create_model("deit_tiny_patch16_224", pretrained=False).eval()
+
+
+@pytest.mark.parametrize("apply_patch, kwargs", [
+    (pitome.patch.deit, {}),
+    (pitome.patch.deit, {"reuse_plan": True}),
+    (pitome.patch.deit, {"threshold": 0.5}),
+    (tome.patch.deit, {}),
+])
+def test_concurrent_calls_match_sequential(apply_patch, kwargs):
+    model = _deit()
+    apply_patch(model, **kwargs)
+    model.ratio = 0.9
+    torch.manual_seed(1)
+    # different batch sizes so that a shared state would mix up token counts
+    inputs = [torch.randn(b, 3, 224, 224) for b in (1, 2, 3, 4)]
+    assert stress_test(model, inputs, num_threads=6, repeats=2)
+
+
+def test_call_state_is_local():
+    model = _deit()
+    pitome.patch.deit(model, trace_source=True)
+    model.ratio = 0.9
+    info = call_info(model._info, CALL_STATE)
+    with torch.no_grad():
+        model(torch.randn(2, 3, 224, 224), info=info)
+        model(torch.randn(3, 3, 224, 224))
+    # the state of the first call stays in its own info, model._info has the latest call
+    assert info["size"].shape[0] == 2 and info["source"] is not None
+    assert model._info["size"].shape[0] == 3
+    # only the read-out keys are published, never the intermediate state of the call
+    assert info["schedule"] is not None and model._info.get("schedule") is None
+
+
+def test_publish_keeps_the_configuration():
+    model = _deit()
+    tome.patch.deit(model)
+    model.ratio = 0.9
+    ratio = model._info["ratio"]
+    with torch.no_grad():
+        _, flop = model(torch.randn(2, 3, 224, 224))
+    # the per-call ratio list is emptied by the blocks, the configured one is kept
+    assert model._info["ratio"] == ratio
+    assert model._info["total_flop"] == flop and model._info["size"].shape[0] == 2
@@ -0,0 +1,56 @@
+import timm
+import torch
+import torch.nn.functional as F
+
+from algo import pitome
+from algo.pitome.merge import init_stream
+
+
+def _deit():
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False, img_size=64).eval()
+    pitome.patch.deit(model)
+    return model
+
+
+def _static_clip(num_frames):
+    # a smooth frame, so that neighbouring patches are similar, repeated over time
+    frame = F.interpolate(torch.randn(2, 3, 4, 4), size=64, mode="bilinear")
+    return frame[:, None].expand(-1, num_frames, -1, -1, -1)
+
+
+def test_static_frames_shrink_the_token_budget():
+    model = _deit()
+    stream = init_stream(temporal_window=3, threshold=0.7)
+    flops = []
+    with torch.no_grad():
+        for out, flop in model.forward_stream(_static_clip(4), stream=stream):
+            assert out.shape == (2, 1000)
+            flops.append(flop)
+            if len(flops) == 1:
+                # nothing to merge with in the first frame
+                assert model._info["size"] is None
+                continue
+            # no merging in the blocks: the size of the frame is the one of the temporal merge
+            size = model._info["size"]
+            assert size.shape[1] == stream["num_tokens"][-1]
+            torch.testing.assert_close(size.sum(dim=1), torch.full((2, 1), 17.0))
+    num_tokens = stream["num_tokens"]
+    assert num_tokens[0] == 17 and num_tokens[-1] < 17
+    assert all(a >= b for a, b in zip(num_tokens, num_tokens[1:]))
+    assert flops[-1] < flops[0]
+
+
+def test_size_carries_across_frames():
+    model = _deit()
+    stream = init_stream(temporal_window=3, threshold=0.7)
+    with torch.no_grad():
+        for i, _ in enumerate(model.forward_stream(_static_clip(5), stream=stream)):
+            weight = stream["memory"]["weight"]
+            if i == 0:
+                assert (weight == 1).all()
+                continue
+            size = model._info["size"][:, 1:]
+            # every static token carries the size of its memory token, capped by the window
+            assert (weight > size).all()
+            assert (weight <= stream["temporal_window"] * size).all()
@@ -0,0 +1,39 @@
+import importlib
+
+import timm
+import torch
+import torch.nn as nn
+
+from algo.pitome.patch import unmerge
+
+
+class SizeProbe(nn.Module):
+    def forward(self, x, size=None):
+        self.size = size
+        return x * 2
+
+
+def test_unmerge_restores_the_input_tokens():
+    torch.manual_seed(0)
+    x = torch.randn(2, 50, 16)
+    for text in (False, True):
+        module = SizeProbe()
+        assert unmerge(module, ratio=0.6, text=text) is None
+        out = module(x)
+        assert out.shape == x.shape
+        # the module saw the merged tokens and their size
+        assert module.size.shape == (2, 30, 1)
+        torch.testing.assert_close(module.size.sum(dim=1), torch.full((2, 1), 50.0))
+
+
+def test_unmerge_is_exact_at_ratio_one(monkeypatch):
+    torch.manual_seed(0)
+    block = timm.create_model("deit_tiny_patch16_224", pretrained=False).blocks[0].eval()
+    x = torch.randn(2, 197, 192)
+    with torch.no_grad():
+        expected = block(x)
+    unmerge(block, ratio=1.0, class_token=True)
+    # no plan is built at all
+    monkeypatch.setattr(importlib.import_module("algo.pitome.patch.unmerge"), "pitome_vision", None)
+    with torch.no_grad():
+        assert torch.equal(block(x), expected)
@@ -0,0 +1,79 @@
+import pytest
+import torch
+from transformers import BertConfig, BertModel, DistilBertConfig, DistilBertModel
+
+from algo import pitome
+from algo.pitome.merge import pack_tokens, pitome_text, pitome_text_varlen
+
+
+def _batch(lengths, dim=16):
+    torch.manual_seed(0)
+    T = max(lengths)
+    mask = (torch.arange(T)[None] < torch.tensor(lengths)[:, None]).long()
+    return torch.randn(len(lengths), T, dim), mask
+
+
+@pytest.mark.parametrize("backend", ["exact", "projection", "lsh"])
+def test_varlen_plan_matches_every_sequence_alone(backend):
+    lengths, r = [40, 33, 12, 2], 10
+    metric, mask = _batch(lengths)
+    x = torch.randn(*metric.shape[:2], 8)
+    packed_metric, cu_seqlens = pack_tokens(metric, mask)
+    plan, new_cu_seqlens = pitome_text_varlen(packed_metric, cu_seqlens, r=r, class_token=True, backend=backend, window=8)
+    out = plan.merge(pack_tokens(x, mask)[0], mode="mean")
+    for i, length in enumerate(lengths):
+        # shorter sequences merge proportionally fewer tokens
+        r_i = min(r * (length - 1) // (max(lengths) - 1), (length - 1) // 2)
+        expected = x[i:i + 1, :length]
+        if r_i > 0:
+            alone = pitome_text(metric[i:i + 1, :length], class_token=True, return_plan=True, r=r_i, backend=backend, window=8)
+            expected = alone.merge(expected, mode="mean")
+        torch.testing.assert_close(out[:, new_cu_seqlens[i]:new_cu_seqlens[i + 1]], expected)
+
+
+def test_varlen_groups_stay_in_their_sequence():
+    lengths = [40, 33, 12, 2]
+    metric, mask = _batch(lengths)
+    packed_metric, cu_seqlens = pack_tokens(metric, mask)
+    plan, new_cu_seqlens = pitome_text_varlen(packed_metric, cu_seqlens, r=10, class_token=True)
+    sequence = torch.repeat_interleave(torch.arange(len(lengths)), torch.tensor(lengths))
+    start, end = new_cu_seqlens[:-1].long()[sequence], new_cu_seqlens[1:].long()[sequence]
+    assert ((plan.group_idx[0] >= start) & (plan.group_idx[0] < end)).all()
+
+
+@pytest.mark.parametrize("backend", ["exact", "lsh"])
+def test_padded_plan_never_merges_pads_into_real_tokens(backend):
+    # the short samples have fewer real tokens than the 2r merged ones
+    metric, mask = _batch([40, 33, 12, 2])
+    plan = pitome_text(metric, ratio=0.6, class_token=True, attention_mask=mask, return_plan=True, backend=backend, window=8)
+    real = plan.merge(mask[..., None].float(), mode="mean")[..., 0]
+    assert ((real == 0) | (real == 1)).all()
+
+
+def _bert():
+    model = BertModel(BertConfig(num_hidden_layers=4, hidden_size=64, num_attention_heads=4, intermediate_size=128)).eval()
+    pitome.patch.bert(model.encoder, varlen=True)
+    return model, model.encoder
+
+
+def _distilbert():
+    model = DistilBertModel(DistilBertConfig(n_layers=4, dim=64, n_heads=4, hidden_dim=128)).eval()
+    pitome.patch.distilbert(model.transformer, varlen=True)
+    return model, model.transformer
+
+
+@pytest.mark.parametrize("make_model", [_bert, _distilbert])
+def test_packed_encoder_matches_padded(make_model):
+    torch.manual_seed(0)
+    model, encoder = make_model()
+    encoder.ratio = 0.8
+    ids = torch.randint(1000, 2000, (3, 40))
+    mask = (torch.arange(40)[None] < torch.tensor([40, 40, 25])[:, None]).long()
+    with torch.no_grad():
+        packed = model(ids, attention_mask=mask, return_dict=False)[0]
+        # the full length samples merge the same tokens as the padded path
+        encoder._info["varlen"] = False
+        padded = model(ids[:2], attention_mask=mask[:2], return_dict=False)[0]
+    assert encoder._info["cu_seqlens"] is None
+    assert packed.shape[1] == padded.shape[1]
+    torch.testing.assert_close(packed[:2], padded)
@@ -0,0 +1,21 @@
+import numpy as np
+import timm
+import torch
+from PIL import Image
+
+from algo import tome
+
+
+def test_tome_visualization_from_traced_source():
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False).eval()
+    tome.patch.deit(model, trace_source=True)
+    model.ratio = 0.9
+    img = Image.fromarray(np.random.RandomState(0).randint(0, 255, (224, 224, 3), dtype=np.uint8))
+    x = torch.from_numpy(np.array(img)).permute(2, 0, 1)[None].float() / 255
+    with torch.no_grad():
+        model(x)
+    source = model._info["source"]
+    vis = tome.make_visualization(img, source)
+    # the compact source and its dense adjacency matrix give the same picture
+    assert np.array_equal(np.array(vis), np.array(tome.make_visualization(img, source.to_dense())))
+    assert vis.size == img.size